@@ -0,0 +1,399 @@
+"""
+Benchmarks of the query builder, the renderers, the exports and the endpoints of the data explorer
+
+Runs on synthetic data sets (a wide table, long texts, text arrays and json documents). Without a database,
+SQL generation, row rendering and the Google sheet conversion are measured on rows that are served by a stub
+cursor. With a Postgres database, the synthetic tables are created in the `mara_data_explorer_benchmark` schema
+and additionally the throughput of CSV downloads and the latency of the endpoints are measured.
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --database-name dwh --database-user postgres --rows 100000 --output results.json
+
+The results are written as json (see `run`), so that they can be compared between releases.
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib.metadata
+import importlib.util
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+import flask
+import mara_db.config
+import mara_db.dbs
+from mara_page import acl
+
+import mara_data_explorer.config
+from mara_data_explorer import data_set, governor, pool, views
+from mara_data_explorer.query import Query, Filter
+
+# the alias of the benchmark database in `mara_db.config.databases()`
+DATABASE_ALIAS = 'mara_data_explorer_benchmark'
+
+# the schema of the synthetic tables
+DATABASE_SCHEMA = 'mara_data_explorer_benchmark'
+
+
+class SyntheticColumn():
+    def __init__(self, column_name: str, database_type: str, sql: str, value: callable):
+        """
+        A column of a synthetic data set
+
+        Args:
+            column_name: The name of the column
+            database_type: The postgres type as returned by `format_type`
+            sql: An expression that computes the value of row `i` (from `generate_series`)
+            value: A function that computes a similar value from a row number and a `random.Random`
+        """
+        self.column_name = column_name
+        self.database_type = database_type
+        self.sql = sql
+        self.value = value
+
+
+def _text(length: int) -> (str, callable):
+    """The sql expression and value function of a text column with values of `length` characters"""
+    return (f"repeat(md5(i :: TEXT), {length // 32 + 1}) :: VARCHAR({length})",
+            lambda i, rnd: (f'{rnd.getrandbits(128):032x}' * (length // 32 + 1))[:length])
+
+
+def _synthetic_columns(name: str) -> [SyntheticColumn]:
+    """The columns of the synthetic data sets"""
+    columns = [SyntheticColumn('id', 'integer', 'i', lambda i, rnd: i)]
+    if name == 'wide':
+        kinds = [
+            ('number', 'numeric', '(random() * 10000) :: NUMERIC(10, 2)',
+             lambda i, rnd: round(rnd.random() * 10000, 2)),
+            ('category', 'text', "'category ' || (i % 25)", lambda i, rnd: f'category {i % 25}'),
+            ('date', 'timestamp with time zone', "now() - i * INTERVAL '1 minute'",
+             lambda i, rnd: datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+                            - datetime.timedelta(minutes=i)),
+            ('text', 'text', 'md5(i :: TEXT)', lambda i, rnd: f'{rnd.getrandbits(128):032x}'),
+            ('tags', 'text[]', "ARRAY['tag ' || (i % 7), 'tag ' || (i % 11)]",
+             lambda i, rnd: [f'tag {i % 7}', f'tag {i % 11}']),
+            ('document', 'jsonb', "jsonb_build_object('id', i, 'name', md5(i :: TEXT))",
+             lambda i, rnd: {'id': i, 'name': f'{rnd.getrandbits(128):032x}'})]
+        for n in range(100):
+            kind, database_type, sql, value = kinds[n % len(kinds)]
+            columns.append(SyntheticColumn(f'{kind} {n}', database_type, sql, value))
+    elif name == 'long-text':
+        for n in range(5):
+            columns.append(SyntheticColumn(f'text {n}', 'text', *_text(2000)))
+    elif name == 'arrays':
+        for n in range(5):
+            columns.append(SyntheticColumn(
+                f'tags {n}', 'text[]', 'ARRAY(SELECT md5((i * j) :: TEXT) FROM generate_series(1, 20) j)',
+                lambda i, rnd: [f'{rnd.getrandbits(128):032x}' for _ in range(20)]))
+    elif name == 'json':
+        for n in range(3):
+            columns.append(SyntheticColumn(
+                f'document {n}', 'jsonb',
+                "jsonb_build_object('id', i, 'tags', ARRAY['a', 'b', 'c'], "
+                "'nested', jsonb_build_object('x', random(), 'y', md5(i :: TEXT), 'z', ARRAY[1, 2, 3]))",
+                lambda i, rnd: {'id': i, 'tags': ['a', 'b', 'c'],
+                                'nested': {'x': rnd.random(), 'y': f'{rnd.getrandbits(128):032x}', 'z': [1, 2, 3]}}))
+    else:
+        raise ValueError(f'Unknown synthetic data set "{name}"')
+    return columns
+
+
+SYNTHETIC_DATA_SET_NAMES = ['wide', 'long-text', 'arrays', 'json']
+
+
+class StubDataSet(data_set.DataSet):
+    def __init__(self, synthetic_columns: [SyntheticColumn], rows: [[]], **kwargs):
+        """A data set with fixed columns whose queries are answered with `rows` by a `StubCursor`"""
+        super().__init__(**kwargs)
+        self._stub_columns = data_set._columns([(column.column_name, column.database_type)
+                                                for column in synthetic_columns], self.id)
+        self.rows = rows
+
+    @property
+    def columns(self) -> {str: data_set.Column}:
+        return self._stub_columns
+
+
+class StubCursor():
+    def __init__(self, column_names: [str], rows: [[]]):
+        """A psycopg2 like cursor (and connection) that returns the same rows for every query"""
+        self.column_names = column_names
+        self.rows = rows
+        self.description = None
+        self.itersize = None
+        self.connection = self
+        self._position = 0
+
+    def cursor(self, name: str = None) -> 'StubCursor':
+        return StubCursor(self.column_names, self.rows)
+
+    def execute(self, sql: str, parameters: [] = None):
+        self._position = 0
+
+    def fetchmany(self, size: int) -> [[]]:
+        self.description = [(column_name,) for column_name in self.column_names]
+        rows = self.rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self) -> [[]]:
+        return self.fetchmany(len(self.rows))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def _stub_cursor_context(data_set: StubDataSet):
+    yield StubCursor(list(data_set.columns.keys()), data_set.rows)
+
+
+def _many_filters(data_set: data_set.DataSet, number_of_filters: int) -> [Filter]:
+    """Filters on all filterable columns of a data set, with several values each"""
+    filters = []
+    columns = [column for column in data_set.columns.values() if column.type in ['text', 'number', 'date', 'text[]']]
+    for n in range(number_of_filters):
+        column = columns[n % len(columns)]
+        if column.type == 'text':
+            filters.append(Filter(column.column_name, ['=', '~', '!='][n % 3], [f'value {k}' for k in range(5)]))
+        elif column.type == 'number':
+            filters.append(Filter(column.column_name, ['>', '<=', '!='][n % 3], n * 10))
+        elif column.type == 'date':
+            filters.append(Filter(column.column_name, '>=', '2020-01-01'))
+        else:
+            filters.append(Filter(column.column_name, ['=', '!='][n % 2], ['tag 1', 'tag 2', 'tag 3']))
+    return filters
+
+
+@contextlib.contextmanager
+def _patched(module, **attributes):
+    """Replaces attributes of a module within the context and restores the original ones afterwards"""
+    originals = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(module, name, value)
+
+
+def measure(name: str, function: callable, repeat: int, unit: str = None) -> {}:
+    """
+    Runs a function once for warming up and then `repeat` times
+
+    Args:
+        name: The name of the benchmark
+        function: A function without arguments. When it returns an int, then this is the number of processed
+                  items (e.g. rows or bytes) of a call
+        repeat: How often to run the function
+        unit: What the returned number of items counts
+
+    Returns: The timings of the function in seconds and its throughput
+    """
+    function()
+    timings, items = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = function()
+        timings.append(time.perf_counter() - start)
+
+    result = {'name': name, 'repeat': repeat,
+              'min_seconds': min(timings), 'median_seconds': statistics.median(timings),
+              'mean_seconds': statistics.mean(timings), 'max_seconds': max(timings)}
+    if isinstance(items, int):
+        result.update({'items': items, 'unit': unit,
+                       'items_per_second': items / result['median_seconds'] if result['median_seconds'] else None})
+    print(f"{name:<55} {result['median_seconds'] * 1000:10.3f} ms"
+          + (f"  {result['items_per_second']:14,.0f} {unit}/s" if result.get('items_per_second') else ''),
+          file=sys.stderr)
+    return result
+
+
+def _create_tables(rows: int):
+    """(Re-)creates the synthetic tables in the benchmark database"""
+    with pool.cursor_context(DATABASE_ALIAS) as cursor:
+        cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {DATABASE_SCHEMA}')
+        for name in SYNTHETIC_DATA_SET_NAMES:
+            print(f'Creating table {DATABASE_SCHEMA}.{name} with {rows} rows', file=sys.stderr)
+            table = f'"{DATABASE_SCHEMA}"."{name}"'
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+            cursor.execute(f'CREATE TABLE {table} AS SELECT '
+                           + ', '.join(f'{column.sql} AS "{column.column_name}"' for column in _synthetic_columns(name))
+                           + f' FROM generate_series(1, {int(rows)}) i')
+            cursor.execute(f'ANALYZE {table}')
+
+
+def run(rows: int = 10000, repeat: int = 10, database: bool = False) -> {}:
+    """
+    Runs all benchmarks
+
+    Args:
+        rows: The number of rows of the synthetic data sets
+        repeat: How often each benchmark is run
+        database: When true, then the data sets are queried from the database with the alias `DATABASE_ALIAS`,
+                  otherwise from a stub cursor
+
+    Returns: A dictionary with information about the environment and a list of `results` (see `measure`)
+    """
+    random_ = random.Random(0)
+    data_sets = []
+    for name in SYNTHETIC_DATA_SET_NAMES:
+        arguments = dict(id=name, name=name, database_alias=DATABASE_ALIAS, database_schema=DATABASE_SCHEMA,
+                         database_table=name, default_column_names=[], result_cache_ttl=0)
+        if database:
+            data_sets.append(data_set.DataSet(**arguments))
+        else:
+            synthetic_columns = _synthetic_columns(name)
+            data_sets.append(StubDataSet(
+                synthetic_columns, [tuple(column.value(i, random_) for column in synthetic_columns)
+                                    for i in range(rows)], **arguments))
+
+    # the configuration and the stub cursor are restored afterwards, so that `run` can be called from other code
+    with contextlib.ExitStack() as patches:
+        patches.enter_context(_patched(mara_data_explorer.config, data_sets=lambda: data_sets,
+                                       column_statistics_max_age=lambda: 0))
+        if database:
+            _create_tables(rows)
+        else:
+            patches.enter_context(_patched(governor, cursor_context=_stub_cursor_context))
+        results = _benchmarks(data_sets, repeat, database)
+
+    try:
+        version = importlib.metadata.version('mara-data-explorer')
+    except Exception:
+        version = None
+
+    return {'package_version': version, 'python_version': platform.python_version(),
+            'platform': platform.platform(), 'started_at': datetime.datetime.now().isoformat(),
+            'rows': rows, 'database': database, 'results': results}
+
+
+def _benchmarks(data_sets: [data_set.DataSet], repeat: int, database: bool) -> [{}]:
+    """Runs all benchmarks on the data sets (see `run`)"""
+    results = []
+    for ds in data_sets:
+        column_names = list(ds.columns.keys())
+        query = Query(ds.id, column_names=column_names, sort_column_name='id', sort_order='DESC',
+                      filters=_many_filters(ds, 50))
+        sql_rows = query.data_set.rows if not database else None
+
+        # query builder
+        results.append(measure(f'sql.to_sql.{ds.id}', lambda: query.to_sql(limit=100, offset=1000), repeat * 10))
+        results.append(measure(f'sql.filter_to_sql.{ds.id}',
+                               lambda: len([query.filter_to_sql(filter) for filter in query.filters]),
+                               repeat * 10, 'filters'))
+
+        # conversions
+        if database:
+            with pool.cursor_context(DATABASE_ALIAS) as cursor:
+                cursor.execute(Query(ds.id, column_names=column_names).to_sql(limit=1000))
+                sql_rows = cursor.fetchall()
+        preview_query = Query(ds.id, column_names=column_names)
+        results.append(measure(f'render.preview_row.{ds.id}',
+                               lambda: len([str(views._render_preview_row(preview_query, row))
+                                            for row in sql_rows[:1000]]), repeat, 'rows'))
+        results.append(measure(f'sheet.as_rows_for_google_sheet.{ds.id}',
+                               lambda: sum(1 for _ in preview_query.as_rows_for_google_sheet(
+                                   array_format='curly', header=False)), repeat, 'rows'))
+
+        if database:
+            def csv():
+                size = 0
+                for chunk in preview_query.as_csv(delimiter=',', decimal_mark='.', include_personal_data=True):
+                    size += len(chunk)
+                return size
+
+            results.append(measure(f'csv.as_csv.{ds.id}', csv, repeat, 'bytes'))
+
+            if importlib.util.find_spec('pyarrow'):
+                from mara_data_explorer import arrow_export
+
+                def parquet():
+                    return sum(len(chunk) for chunk in arrow_export.as_parquet(preview_query, True))
+
+                results.append(measure(f'parquet.as_parquet.{ds.id}', parquet, repeat, 'bytes'))
+
+    if database:
+        results += _endpoint_benchmarks(data_sets, repeat)
+    return results
+
+
+def _endpoint_benchmarks(data_sets: [data_set.DataSet], repeat: int) -> [{}]:
+    """Measures the latency of the endpoints with a flask test client (without authentication)"""
+    with _patched(acl, current_user_email=lambda: 'benchmark@localhost',
+                  current_user_has_permission=lambda resource: True), \
+            _patched(views, current_user_has_permission=lambda query: True):
+        return _measure_endpoints(data_sets, repeat)
+
+
+def _measure_endpoints(data_sets: [data_set.DataSet], repeat: int) -> [{}]:
+    app = flask.Flask('mara_data_explorer_benchmark')
+    app.register_blueprint(views.blueprint)
+    client = app.test_client()
+    prefix = views.blueprint.url_prefix
+
+    results = []
+    for ds in data_sets:
+        column_names = list(ds.columns.keys())
+        query = Query(ds.id, column_names=column_names[:10], filters=_many_filters(ds, 3)).to_dict()
+
+        def post(path: str, body: {}):
+            def request():
+                response = client.post(prefix + path, json=body)
+                assert response.status_code == 200, response.data
+                return None
+            return request
+
+        results.append(measure(f'endpoint.preview.{ds.id}',
+                               post('/.preview', {'query': query, 'limit': 100, 'offset': 0}), repeat))
+        results.append(measure(f'endpoint.row_count.{ds.id}', post('/.row-count', query), repeat))
+        results.append(measure(f'endpoint.filter_row_count.{ds.id}', post('/.filter-row-count-0', query), repeat))
+        results.append(measure(f'endpoint.query_state.{ds.id}',
+                               post('/.query-state', {'query': query, 'limit': 100, 'offset': 0,
+                                                      'filter_positions': [0, 1, 2]}), repeat))
+        results.append(measure(f'endpoint.distribution_charts.{ds.id}',
+                               post('/.distribution-charts', {'query': query,
+                                                              'positions': list(range(min(10, len(column_names))))}),
+                               repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the data explorer')
+    parser.add_argument('--rows', type=int, default=10000, help='The number of rows of each synthetic data set')
+    parser.add_argument('--repeat', type=int, default=10, help='How often each benchmark is run')
+    parser.add_argument('--output', help='The json file to write the results to (default: stdout)')
+    parser.add_argument('--database-name', help='Run against this Postgres database instead of a stub cursor')
+    parser.add_argument('--database-host', help='The host of the Postgres database')
+    parser.add_argument('--database-port', type=int, help='The port of the Postgres database')
+    parser.add_argument('--database-user', help='The user of the Postgres database (password from PGPASSWORD)')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as patches:
+        if args.database_name:
+            databases = dict(mara_db.config.databases())
+            databases[DATABASE_ALIAS] = mara_db.dbs.PostgreSQLDB(
+                host=args.database_host, port=args.database_port, user=args.database_user,
+                database=args.database_name)
+            patches.enter_context(_patched(mara_db.config, databases=lambda: databases))
+
+        results = run(rows=args.rows, repeat=args.repeat, database=bool(args.database_name))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+    else:
+        json.dump(results, sys.stdout, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,18 +12,21 @@ def MARA_FLASK_BLUEPRINTS():
 
 
 def MARA_AUTOMIGRATE_SQLALCHEMY_MODELS():
-    from . import query
-    return [query.Query]
+    from . import query, statistics
+    return [query.Query, statistics.ColumnStatistics]
 
 
 def MARA_ACL_RESOURCES():
     from . import views
     return {'Explore': views.acl_resource,
-            'Personal Data': views.personal_data_acl_resource}
+            'Personal Data': views.personal_data_acl_resource,
+            'Query Profiling': views.profiling_acl_resource}
 
 
 def MARA_CLICK_COMMANDS():
-    return []
+    from . import cli
+    return [cli.invalidate_result_cache, cli.create_autocomplete_indexes, cli.cleanup_exports,
+            cli.refresh_column_statistics, cli.refresh_rollup, cli.warm_up_column_metadata]
 
 
 def MARA_NAVIGATION_ENTRIES():
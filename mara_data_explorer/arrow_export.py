@@ -0,0 +1,243 @@
+"""Streaming of query results as Parquet or Arrow IPC files (requires the optional `pyarrow` package)"""
+
+import io
+import json
+
+from . import config, governor, pool
+
+# the formats that can be downloaded and exported: format -> (file extension, mime type)
+FORMATS = {'parquet': ('parquet', 'application/vnd.apache.parquet'),
+           'arrow': ('arrow', 'application/vnd.apache.arrow.file')}
+
+# the compression codecs that are supported per format
+COMPRESSIONS = {'parquet': ['zstd', 'snappy', 'gzip', 'none'],
+                'arrow': ['zstd', 'lz4', 'none']}
+
+
+def arrow_type(column: 'data_set.Column', numeric_precision: (int, int) = None) -> 'pyarrow.DataType':
+    """
+    The Arrow type of a data set column, derived from its database type
+
+    Args:
+        column: The column
+        numeric_precision: The precision and scale of a `numeric` column, when it has them (see `numeric_precisions`)
+    """
+    import pyarrow
+
+    database_type = column.database_type
+    if database_type == 'bigint':
+        return pyarrow.int64()
+    elif database_type == 'integer':
+        return pyarrow.int32()
+    elif database_type == 'smallint':
+        return pyarrow.int16()
+    elif database_type == 'real':
+        return pyarrow.float32()
+    elif database_type == 'numeric':
+        if not numeric_precision:
+            # numbers without a precision can have any number of digits, they are kept exactly as strings
+            return pyarrow.string()
+        precision, scale = numeric_precision
+        return pyarrow.decimal128(precision, scale) if precision <= 38 else pyarrow.decimal256(precision, scale)
+    elif database_type == 'double precision' or column.type == 'number':
+        return pyarrow.float64()
+    elif database_type == 'date':
+        return pyarrow.date32()
+    elif database_type in ['timestamp', 'timestamp without time zone']:
+        return pyarrow.timestamp('us')
+    elif database_type == 'time without time zone':
+        return pyarrow.time64('us')
+    elif database_type == 'time with time zone':
+        # Arrow has no time type with a time zone
+        return pyarrow.string()
+    elif database_type == 'timestamp with time zone' or column.type == 'date':
+        return pyarrow.timestamp('us', tz='UTC')
+    elif column.type == 'text[]':
+        return pyarrow.list_(pyarrow.string())
+    else:
+        # text, json (serialized) and geometry (hex encoded WKB)
+        return pyarrow.string()
+
+
+def schema(query: 'query.Query', include_personal_data: bool) -> 'pyarrow.Schema':
+    """The Arrow schema of the result of a query, columns with restricted personal data become strings"""
+    import pyarrow
+
+    precisions = numeric_precisions(query.data_set)
+    fields = []
+    for column_name in query.column_names:
+        if not include_personal_data and column_name in query.data_set.personal_data_column_names:
+            fields.append(pyarrow.field(column_name, pyarrow.string()))
+        else:
+            fields.append(pyarrow.field(column_name, arrow_type(query.data_set.columns[column_name],
+                                                                precisions.get(column_name))))
+    return pyarrow.schema(fields)
+
+
+def numeric_precisions(data_set: 'data_set.DataSet') -> {str: (int, int)}:
+    """The precision and scale of the `numeric` columns of a data set that have them, by column name"""
+    if not any(column.database_type == 'numeric' for column in data_set.columns.values()):
+        return {}
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        cursor.execute(f"""
+SELECT column_name, numeric_precision, numeric_scale
+FROM information_schema.columns
+WHERE table_schema = {'%s'} AND table_name = {'%s'} AND data_type = 'numeric' AND numeric_precision IS NOT NULL""",
+                       (data_set.database_schema, data_set.database_table))
+        return {column_name: (precision, scale) for column_name, precision, scale in cursor.fetchall()}
+
+
+def record_batches(query: 'query.Query', include_personal_data: bool, batch_size: int = None,
+                   result_schema: 'pyarrow.Schema' = None):
+    """
+    Runs a query and returns its result as Arrow record batches
+
+    The rows are fetched from a server-side cursor in batches and converted column by column, so that only
+    a single batch is kept in memory.
+
+    Args:
+        query: The query to run
+        include_personal_data: When True, include columns that contain personal data
+        batch_size: How many rows to fetch and convert at once, `config.arrow_batch_size()` when None
+        result_schema: The schema of the batches, `schema(query, include_personal_data)` when None
+
+    Returns: A generator of `pyarrow.RecordBatch`
+    """
+    import pyarrow
+
+    batch_size = batch_size or config.arrow_batch_size()
+    result_schema = result_schema or schema(query, include_personal_data)
+    converters = [_converter(field.type, query.data_set.columns[column_name].type == 'json'
+                             and (include_personal_data
+                                  or column_name not in query.data_set.personal_data_column_names))
+                  for field, column_name in zip(result_schema, query.column_names)]
+
+    with governor.cursor_context(query.data_set) as cursor:
+        with cursor.connection.cursor(name='arrow_export') as server_side_cursor:
+            server_side_cursor.itersize = batch_size
+            server_side_cursor.execute(*query.to_parameterized_sql(include_personal_data=include_personal_data))
+            while True:
+                rows = server_side_cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield pyarrow.RecordBatch.from_arrays(
+                    [pyarrow.array(convert(values) if convert else values, type=field.type)
+                     for values, field, convert in zip(zip(*rows), result_schema, converters)],
+                    schema=result_schema)
+
+
+def _converter(type: 'pyarrow.DataType', is_json: bool) -> callable:
+    """A function that prepares the values of a column for `pyarrow.array`, None when they can be used as is"""
+    import pyarrow
+
+    if is_json:
+        # json columns are fetched as python objects
+        return lambda values: [None if value is None else json.dumps(value) for value in values]
+    elif pyarrow.types.is_floating(type):
+        # numeric columns are fetched as decimals
+        return lambda values: [None if value is None else float(value) for value in values]
+    elif pyarrow.types.is_decimal(type):
+        # Arrow decimals can not represent NaN and infinity
+        return lambda values: [value if value is not None and value.is_finite() else None for value in values]
+    elif pyarrow.types.is_string(type):
+        # e.g. times with time zone and numbers without a precision
+        return lambda values: [value if value is None or isinstance(value, str) else str(value) for value in values]
+    return None
+
+
+def as_parquet(query: 'query.Query', include_personal_data: bool, compression: str = 'zstd',
+               progress: callable = None):
+    """
+    Streams the result of a query as a Parquet file, with one row group per record batch
+
+    Args:
+        query: The query to run
+        include_personal_data: When True, include columns that contain personal data
+        compression: `zstd`, `snappy`, `gzip` or `none`
+        progress: An optional function that is called with the number of rows of each written batch
+
+    Returns: A generator of file chunks (bytes)
+    """
+    import pyarrow.parquet
+
+    _check_compression('parquet', compression)
+    sink = _ChunkSink()
+    result_schema = schema(query, include_personal_data)
+    with pyarrow.parquet.ParquetWriter(sink, result_schema, compression=compression) as writer:
+        for batch in record_batches(query, include_personal_data, result_schema=result_schema):
+            writer.write_batch(batch)
+            if progress:
+                progress(batch.num_rows)
+            yield from sink.flush_chunks()
+    yield from sink.flush_chunks()
+
+
+def as_arrow_ipc(query: 'query.Query', include_personal_data: bool, compression: str = 'zstd',
+                 progress: callable = None):
+    """
+    Streams the result of a query as an Arrow IPC file (readable with `pyarrow.ipc.open_file` or
+    `pandas.read_feather`)
+
+    Args:
+        query: The query to run
+        include_personal_data: When True, include columns that contain personal data
+        compression: `zstd`, `lz4` or `none`
+        progress: An optional function that is called with the number of rows of each written batch
+
+    Returns: A generator of file chunks (bytes)
+    """
+    import pyarrow.ipc
+
+    _check_compression('arrow', compression)
+    sink = _ChunkSink()
+    options = pyarrow.ipc.IpcWriteOptions(compression=None if compression == 'none' else compression)
+    result_schema = schema(query, include_personal_data)
+    with pyarrow.ipc.new_file(sink, result_schema, options=options) as writer:
+        for batch in record_batches(query, include_personal_data, result_schema=result_schema):
+            writer.write_batch(batch)
+            if progress:
+                progress(batch.num_rows)
+            yield from sink.flush_chunks()
+    yield from sink.flush_chunks()
+
+
+def as_file(query: 'query.Query', format: str, include_personal_data: bool, compression: str = 'zstd',
+            progress: callable = None):
+    """Streams the result of a query in one of the `FORMATS` (see `as_parquet` and `as_arrow_ipc`)"""
+    if format == 'parquet':
+        return as_parquet(query, include_personal_data, compression, progress)
+    elif format == 'arrow':
+        return as_arrow_ipc(query, include_personal_data, compression, progress)
+    else:
+        raise ValueError(f'Unsupported format "{format}"')
+
+
+def _check_compression(format: str, compression: str):
+    if compression not in COMPRESSIONS[format]:
+        raise ValueError(f'Unsupported compression "{compression}" for format {format} '
+                         f'(supported: {", ".join(COMPRESSIONS[format])})')
+
+
+class _ChunkSink(io.RawIOBase):
+    """A writable file that collects the written bytes until they are taken with `flush_chunks`"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush_chunks(self) -> [bytes]:
+        """The bytes that have been written since the last call"""
+        chunks, self._chunks = self._chunks, []
+        return [b''.join(chunks)] if chunks else []
@@ -0,0 +1,218 @@
+"""Fast auto-completion of filter values from in-memory dictionaries of distinct column values"""
+
+import array
+import logging
+import re
+import threading
+import time
+
+from . import config, pool
+
+logger = logging.getLogger(__name__)
+
+
+class ValueDictionary():
+    def __init__(self, values: [str]):
+        """
+        The sorted distinct values of a column with a trigram index for substring lookups
+
+        Args:
+            values: The distinct values of the column
+        """
+        self.values = sorted(set(values))
+        self._lower_values = [value.lower() for value in self.values]
+        self.built_at = time.time()
+
+        # trigram -> positions of all values that contain it (in ascending order)
+        self._trigrams = {}
+        for pos, value in enumerate(self._lower_values):
+            for trigram in {value[i:i + 3] for i in range(len(value) - 2)}:
+                positions = self._trigrams.get(trigram)
+                if positions is None:
+                    positions = self._trigrams[trigram] = array.array('I')
+                positions.append(pos)
+
+    def lookup(self, term: str, limit: int = 50) -> [str]:
+        """
+        Returns the first `limit` values (in sort order) that match `ILIKE '%term%'` like the `~` filter, i.e.
+        that contain `term` case insensitive, with `%` and `_` as wildcards (escaped with a backslash)
+        """
+        literals, matches = _ilike_matcher(term.lower())
+        trigrams = {literal[i:i + 3] for literal in literals for i in range(len(literal) - 2)}
+        if not trigrams:
+            candidates = range(len(self.values))
+        else:
+            # intersect the positions of the rarest trigrams first
+            postings = sorted((self._trigrams.get(trigram, ()) for trigram in trigrams), key=len)
+            candidates = set(postings[0])
+            for positions in postings[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(positions)
+            candidates = sorted(candidates)
+
+        result = []
+        for pos in candidates:
+            # the trigrams of the term can appear in a value without the term itself
+            if matches(self._lower_values[pos]):
+                result.append(self.values[pos])
+                if len(result) >= limit:
+                    break
+        return result
+
+    def __len__(self):
+        return len(self.values)
+
+
+def _ilike_matcher(term: str) -> ([str], callable):
+    """
+    The literal parts of an `ILIKE '%term%'` pattern (between wildcards) and a function that tells whether
+    a (lower case) value matches the pattern
+    """
+    if not re.search(r'[%_\\]', term):
+        return [term], lambda value: term in value
+
+    literals, literal, regex, escaped = [], '', '', False
+    for char in '%' + term + '%':
+        if char == '\\' and not escaped:
+            escaped = True
+            continue
+        if char in '%_' and not escaped:
+            literals.append(literal)
+            literal = ''
+            regex += '.*' if char == '%' else '.'
+        else:
+            literal += char
+            regex += re.escape(char)
+        escaped = False
+    literals.append(literal)
+    pattern = re.compile(regex, re.DOTALL)
+    return literals, lambda value: pattern.fullmatch(value) is not None
+
+
+# how many seconds to wait before building a dictionary again after it has failed
+BUILD_RETRY_INTERVAL = 60
+
+# (data set id, column name) -> (when it was built, ValueDictionary or None when there are too many values)
+_dictionaries = {}
+_building = set()  # (data set id, column name) of dictionaries that are currently built
+_failed = {}  # (data set id, column name) -> when to retry building a dictionary that failed
+_lock = threading.Lock()
+
+
+def lookup(data_set: 'data_set.DataSet', column_name: str, term: str, limit: int = 50) -> [str]:
+    """
+    Looks up the values of a text or text array column that contain `term` in the dictionary of the column.
+
+    Returns None when no dictionary is available (yet), e.g. because the column has too many distinct values
+    or because the dictionary is still being built in the background. Outdated dictionaries are used while
+    they are rebuilt in the background (columns with too many values are checked again when outdated). When building a dictionary fails (e.g. while the database is not
+    available), then it is retried after `BUILD_RETRY_INTERVAL` seconds at the earliest.
+    """
+    if config.autocomplete_dictionary_max_values() <= 0:
+        return None
+
+    key = (data_set.id, column_name)
+    with _lock:
+        built_at, dictionary = _dictionaries.get(key, (None, None))
+        outdated = built_at is None or time.time() - built_at > config.autocomplete_dictionary_ttl()
+        if outdated and key not in _building and time.time() >= _failed.get(key, 0):
+            _building.add(key)
+            threading.Thread(target=_build, args=(data_set, column_name), daemon=True).start()
+
+    return dictionary.lookup(term, limit) if dictionary is not None else None
+
+
+def invalidate(data_set_id: str = None):
+    """Removes the dictionaries of a data set (or of all data sets) so that they are rebuilt on the next lookup"""
+    with _lock:
+        for key in list(_dictionaries.keys()):
+            if data_set_id is None or key[0] == data_set_id:
+                del _dictionaries[key]
+        for key in list(_failed.keys()):
+            if data_set_id is None or key[0] == data_set_id:
+                del _failed[key]
+
+
+def _build(data_set: 'data_set.DataSet', column_name: str):
+    key = (data_set.id, column_name)
+    try:
+        dictionary = build_dictionary(data_set, column_name)
+        with _lock:
+            _dictionaries[key] = (time.time(), dictionary)
+            _failed.pop(key, None)
+    except Exception:
+        logger.exception(f'Auto-completion dictionary of "{data_set.id}"."{column_name}" could not be built')
+        with _lock:
+            _failed[key] = time.time() + BUILD_RETRY_INTERVAL
+    finally:
+        with _lock:
+            _building.discard(key)
+
+
+def build_dictionary(data_set: 'data_set.DataSet', column_name: str) -> ValueDictionary:
+    """
+    Reads the distinct values of a text or text array column into a dictionary.
+    Returns None when the column has more than `config.autocomplete_dictionary_max_values()` distinct values.
+    """
+    max_values = config.autocomplete_dictionary_max_values()
+    if data_set.columns[column_name].type == 'text[]':
+        values = f'unnest("{column_name}")'
+    else:
+        values = f'"{column_name}"'
+
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        cursor.execute(f"""
+SELECT value
+FROM (SELECT DISTINCT {values} AS value FROM "{data_set.database_schema}"."{data_set.database_table}") t
+WHERE value IS NOT NULL AND value <> ''
+LIMIT {int(max_values) + 1}""")
+        values = [row[0] for row in cursor.fetchall()]
+
+    return ValueDictionary(values) if len(values) <= max_values else None
+
+
+def create_trigram_indexes(data_set: 'data_set.DataSet'):
+    """
+    Creates `pg_trgm` GIN indexes on all text columns of a data set, which speeds up the
+    `ILIKE '%term%'` queries that are used when a column has no dictionary
+    """
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for column in data_set.columns.values():
+            if column.type == 'text':
+                cursor.execute(f'''
+CREATE INDEX IF NOT EXISTS "{data_set.database_table}__{column.column_name}__trgm"
+  ON "{data_set.database_schema}"."{data_set.database_table}" USING GIN ("{column.column_name}" gin_trgm_ops)''')
+
+
+def create_attributes_table(data_set: 'data_set.DataSet'):
+    """
+    (Re-)creates the `{database_table}_attributes` table with the distinct values of all text and text array
+    columns of a data set (used for auto-completion when `use_attributes_table` is set)
+    """
+    table = f'"{data_set.database_schema}"."{data_set.database_table}"'
+    attributes_table = f'"{data_set.database_schema}"."{data_set.database_table}_attributes"'
+    selects = []
+    for column in data_set.columns.values():
+        if column.type in ['text', 'text[]']:
+            value = f'unnest("{column.column_name}")' if column.type == 'text[]' else f'"{column.column_name}"'
+            # the column name is passed as a parameter
+            selects.append(f'SELECT DISTINCT %s :: TEXT AS attribute, {value} :: TEXT AS value FROM {table}')
+    if not selects:
+        return
+
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute(f'DROP TABLE IF EXISTS {attributes_table}')
+        cursor.execute(f'''
+CREATE TABLE {attributes_table} AS
+SELECT attribute, value
+FROM (''' + '\n      UNION ALL\n      '.join(selects) + f''') t
+WHERE value IS NOT NULL AND value <> \'\'''',
+                       [column.column_name for column in data_set.columns.values()
+                        if column.type in ['text', 'text[]']])
+        cursor.execute(f'''
+CREATE INDEX "{data_set.database_table}_attributes__value__trgm"
+  ON {attributes_table} USING GIN (value gin_trgm_ops)''')
+        cursor.execute(f'CREATE INDEX ON {attributes_table} (attribute)')
@@ -0,0 +1,226 @@
+"""Caching of query results (previews, row counts, distributions)"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+import time
+
+from . import config
+
+
+class Cache():
+    """Base class for result caches"""
+
+    def get(self, key: str) -> (bool, object):
+        """Returns a tuple of whether the key was found and the cached value"""
+        raise NotImplementedError()
+
+    def set(self, key: str, value: object, ttl: float, data_set_id: str):
+        """Stores a value for `ttl` seconds"""
+        raise NotImplementedError()
+
+    def invalidate(self, data_set_id: str = None):
+        """Removes all cached results of a data set, or of all data sets when `data_set_id` is None"""
+        raise NotImplementedError()
+
+
+class LRUCache(Cache):
+    def __init__(self, max_entries: int = 1000):
+        """
+        An in-process cache that evicts the least recently used entries
+
+        As every process has its own cache, it can only be invalidated from within the same process.
+
+        Args:
+            max_entries: How many results to keep at most
+        """
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # key -> (expires_at, data_set_id, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> (bool, object):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            elif entry[0] < time.time():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[2]
+
+    def set(self, key: str, value: object, ttl: float, data_set_id: str):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, data_set_id, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, data_set_id: str = None):
+        with self._lock:
+            if data_set_id is None:
+                self._entries.clear()
+            else:
+                for key in [key for key, entry in self._entries.items() if entry[1] == data_set_id]:
+                    del self._entries[key]
+
+
+class SQLiteCache(Cache):
+    def __init__(self, path: str, max_entries: int = 10000):
+        """
+        A cache in a local SQLite file that is shared by all processes on the same machine
+
+        Args:
+            path: The SQLite database file
+            max_entries: How many results to keep at most, the least recently used ones are evicted first
+        """
+        self.path = path
+        self.max_entries = max_entries
+        with self._connection() as connection:
+            connection.execute('''
+CREATE TABLE IF NOT EXISTS result_cache (
+  key          TEXT PRIMARY KEY,
+  data_set_id  TEXT,
+  expires_at   REAL,
+  last_used_at REAL,
+  value        BLOB)''')
+
+    @contextlib.contextmanager
+    def _connection(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:  # commits or rolls back
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key: str) -> (bool, object):
+        now = time.time()
+        with self._connection() as connection:
+            row = connection.execute('SELECT value FROM result_cache WHERE key = ? AND expires_at >= ?',
+                                     (key, now)).fetchone()
+            if row is None:
+                return False, None
+            connection.execute('UPDATE result_cache SET last_used_at = ? WHERE key = ?', (now, key))
+            return True, pickle.loads(row[0])
+
+    def set(self, key: str, value: object, ttl: float, data_set_id: str):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?, ?)',
+                               (key, data_set_id, now + ttl, now, pickle.dumps(value)))
+            connection.execute('DELETE FROM result_cache WHERE expires_at < ?', (now,))
+            connection.execute('''
+DELETE FROM result_cache
+WHERE key IN (SELECT key FROM result_cache
+              ORDER BY last_used_at
+              LIMIT max(0, (SELECT count(*) FROM result_cache) - ?))''', (self.max_entries,))
+
+    def invalidate(self, data_set_id: str = None):
+        with self._connection() as connection:
+            if data_set_id is None:
+                connection.execute('DELETE FROM result_cache')
+            else:
+                connection.execute('DELETE FROM result_cache WHERE data_set_id = ?', (data_set_id,))
+
+
+def cache_key(data_set_id: str, key: []) -> str:
+    """A hash of a data set id and a json serializable representation of a computation"""
+    return hashlib.sha256(json.dumps([data_set_id, key], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cached(data_set: 'data_set.DataSet', key: [], compute: callable):
+    """
+    Returns the cached result of a computation on a data set, or computes and caches it
+
+    Args:
+        data_set: The data set that is queried
+        key: A json serializable, canonical representation of the computation
+        compute: A function without arguments that computes the result
+    """
+    found, value = lookup(data_set, key)
+    if not found:
+        value = compute()
+        store(data_set, key, value)
+    return value
+
+
+def cached_stale_while_revalidate(data_set: 'data_set.DataSet', key: [], compute: callable):
+    """
+    Like `cached`, but results that have expired less than `config.result_cache_stale_ttl()` seconds ago
+    are returned immediately and recomputed in a background thread
+
+    Args:
+        data_set: The data set that is queried
+        key: A json serializable, canonical representation of the computation
+        compute: A function without arguments that computes the result
+    """
+    cache = config.result_cache()
+    ttl = _ttl(data_set)
+    stale_ttl = config.result_cache_stale_ttl()
+    if not cache or not ttl or not stale_ttl:
+        return cached(data_set, key, compute)
+
+    key = cache_key(data_set.id, ['stale-while-revalidate', key])
+
+    def compute_and_store():
+        value = compute()
+        cache.set(key, (time.time(), value), ttl=ttl + stale_ttl, data_set_id=data_set.id)
+        return value
+
+    def revalidate():
+        try:
+            compute_and_store()
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(key)
+
+    found, entry = cache.get(key)
+    if not found:
+        return compute_and_store()
+
+    computed_at, value = entry
+    if time.time() - computed_at > ttl:
+        with _revalidating_lock:
+            if key not in _revalidating:
+                _revalidating.add(key)
+                threading.Thread(target=revalidate, daemon=True).start()
+    return value
+
+
+_revalidating = set()  # keys of stale results that are currently recomputed
+_revalidating_lock = threading.Lock()
+
+
+def lookup(data_set: 'data_set.DataSet', key: []) -> (bool, object):
+    """Returns a tuple of whether the result of a computation on a data set is cached and the cached result"""
+    cache = config.result_cache()
+    if not cache or not _ttl(data_set):
+        return False, None
+    return cache.get(cache_key(data_set.id, key))
+
+
+def store(data_set: 'data_set.DataSet', key: [], value: object):
+    """Caches the result of a computation on a data set"""
+    cache = config.result_cache()
+    ttl = _ttl(data_set)
+    if cache and ttl:
+        cache.set(cache_key(data_set.id, key), value, ttl=ttl, data_set_id=data_set.id)
+
+
+def invalidate(data_set_id: str = None):
+    """
+    Removes all cached results of a data set (or of all data sets), e.g. after its table has been reloaded.
+    Can be called from ETL pipelines.
+    """
+    cache = config.result_cache()
+    if cache:
+        cache.invalidate(data_set_id)
+
+
+def _ttl(data_set: 'data_set.DataSet') -> float:
+    return data_set.result_cache_ttl if data_set.result_cache_ttl is not None else config.result_cache_ttl()
@@ -0,0 +1,96 @@
+"""Command line interface for data sets"""
+
+import click
+
+
+@click.command()
+@click.option('--data-set-id', help='The id of the data set. When omitted, the results of all data sets are removed.')
+def invalidate_result_cache(data_set_id: str):
+    """Removes cached query results, e.g. after the table of a data set has been reloaded"""
+    from . import autocomplete, cache
+
+    cache.invalidate(data_set_id)
+    autocomplete.invalidate(data_set_id)
+
+
+@click.command()
+@click.option('--max-age', type=float, help='The age in seconds (default: config.export_retention()).')
+def cleanup_exports(max_age: float):
+    """Removes finished export jobs and their files"""
+    from . import export
+
+    export.cleanup(max_age)
+
+
+@click.command()
+@click.option('--data-set-id', required=True, help='The id of the data set.')
+@click.option('--trigram-indexes/--no-trigram-indexes', default=True,
+              help='Create pg_trgm indexes on all text columns (default: true).')
+@click.option('--attributes-table/--no-attributes-table', default=False,
+              help='(Re-)create the `_attributes` table of the data set (default: false).')
+def create_autocomplete_indexes(data_set_id: str, trigram_indexes: bool, attributes_table: bool):
+    """Creates database objects that speed up the auto-completion of filter values"""
+    from . import autocomplete
+    from .data_set import find_data_set
+
+    data_set = find_data_set(data_set_id)
+    if not data_set:
+        raise click.BadParameter(f'Data set "{data_set_id}" does not exist', param_hint='--data-set-id')
+    if trigram_indexes:
+        autocomplete.create_trigram_indexes(data_set)
+    if attributes_table:
+        autocomplete.create_attributes_table(data_set)
+
+
+@click.command()
+@click.option('--data-set-id', help='The id of the data set. When omitted, the statistics of all data sets are computed.')
+def refresh_column_statistics(data_set_id: str):
+    """(Re-)computes the column statistics catalog, e.g. after the table of a data set has been reloaded"""
+    from . import config, statistics
+    from .data_set import find_data_set
+
+    if data_set_id:
+        data_set = find_data_set(data_set_id)
+        if not data_set:
+            raise click.BadParameter(f'Data set "{data_set_id}" does not exist', param_hint='--data-set-id')
+        data_sets = [data_set]
+    else:
+        data_sets = config.data_sets()
+
+    for data_set in data_sets:
+        click.echo(f'Computing statistics of {data_set.id}')
+        statistics.refresh(data_set)
+
+
+@click.command()
+@click.option('--data-set-id', help='The id of the data set. When omitted, the rollups of all data sets are created.')
+def refresh_rollup(data_set_id: str):
+    """(Re-)creates the rollup tables of data sets with `rollup_column_names`, e.g. after a table has been reloaded"""
+    from . import config, rollup
+    from .data_set import find_data_set
+
+    if data_set_id:
+        data_set = find_data_set(data_set_id)
+        if not data_set:
+            raise click.BadParameter(f'Data set "{data_set_id}" does not exist', param_hint='--data-set-id')
+        if not data_set.rollup_column_names:
+            raise click.BadParameter(f'Data set "{data_set_id}" has no rollup columns', param_hint='--data-set-id')
+        data_sets = [data_set]
+    else:
+        data_sets = [data_set for data_set in config.data_sets() if data_set.rollup_column_names]
+
+    for data_set in data_sets:
+        click.echo(f'Creating rollup of {data_set.id}')
+        rollup.refresh(data_set)
+
+
+@click.command()
+def warm_up_column_metadata():
+    """Loads the columns of all data sets into the column metadata cache"""
+    from . import data_set
+
+    errors = data_set.warm_up_column_metadata()
+    for data_set_id, error in errors.items():
+        click.echo(f'{data_set_id}: {error}', err=True)
+    if errors:
+        raise click.Abort()
@@ -0,0 +1,61 @@
+"""Streaming compression of downloads (gzip, or zstd with the optional `zstandard` package)"""
+
+import concurrent.futures
+import zlib
+
+from . import config
+
+# the supported compressions of csv downloads, the first one is the default
+CSV_COMPRESSIONS = ['gzip', 'zstd', 'none']
+
+# compression -> file extension of compressed files
+FILE_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+
+def compress(chunks, compression: str):
+    """
+    Compresses a stream of chunks
+
+    The chunks are compressed in a separate thread while the next chunk is read and the previous compressed
+    chunk is sent to the client, so that reading, compressing and sending run in parallel (zlib and
+    zstandard release the GIL). zstd additionally compresses with `config.zstd_compression_threads()` threads.
+
+    Args:
+        chunks: A generator of bytes (e.g. `Query.as_csv`), which is closed when the result is closed
+        compression: `gzip`, `zstd` or `none`
+
+    Returns: A generator of compressed chunks (bytes)
+    """
+    if compression == 'none':
+        yield from chunks
+        return
+
+    compressor = _compressor(compression)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='compression') as executor:
+        try:
+            pending = None  # the compression of the previous chunk
+            for chunk in chunks:
+                # chunks are compressed one after the other by the single thread of the executor
+                future = executor.submit(compressor.compress, chunk)
+                if pending and pending.result():
+                    yield pending.result()
+                pending = future
+            if pending and pending.result():
+                yield pending.result()
+            yield compressor.flush()
+        finally:
+            chunks.close()
+
+
+def _compressor(compression: str):
+    """A compression object with `compress` and `flush` methods"""
+    if compression == 'gzip':
+        # wbits = 31: gzip header and trailer
+        return zlib.compressobj(config.export_compression_level(), zlib.DEFLATED, 31)
+    elif compression == 'zstd':
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=config.zstd_compression_level(),
+                                        threads=config.zstd_compression_threads()).compressobj()
+    else:
+        raise ValueError(f'Unsupported compression "{compression}"')
@@ -1,6 +1,8 @@
 """Definition and configuration of data sets"""
 
 import functools
+import os
+import tempfile
 
 from . import data_set
 
@@ -37,3 +39,230 @@ def google_sheet_oauth2_client_config():
     }
     """
     return None
+
+
+def google_sheet_max_rows() -> int:
+    """How many rows are exported to a Google sheet at most (also limited by the 10M cells of a spreadsheet)"""
+    return 1000000
+
+
+def google_sheet_rows_per_sheet() -> int:
+    """Larger Google sheet exports are split into several sheets (tabs) with this many rows each"""
+    return 100000
+
+
+def google_sheet_upload_threads() -> int:
+    """How many batches of rows are uploaded to a Google sheet in parallel"""
+    return 4
+
+
+def google_sheet_requests_per_minute() -> int:
+    """The maximum rate of write requests to the Google sheets API (see the quotas of the Google project)"""
+    return 60
+
+
+def connection_pool_size() -> (int, int):
+    """
+    The minimum and maximum number of pooled connections per database alias and process.
+    When the maximum is 0, then a new connection is opened for each query.
+    """
+    return (0, 5)
+
+
+def connection_pool_idle_timeout() -> float:
+    """How many seconds a pooled connection can be idle before it is closed"""
+    return 300
+
+
+def connection_pool_health_check_interval() -> float:
+    """Pooled connections that have been idle for longer than this many seconds are checked before they are used"""
+    return 30
+
+
+def connection_pool_checkout_timeout() -> float:
+    """How many seconds to wait for a free pooled connection before giving up"""
+    return 60
+
+
+@functools.lru_cache(maxsize=None)
+def result_cache() -> 'cache.Cache':
+    """
+    The cache for query results (previews, row counts, distributions). None disables caching.
+
+    The default in-process cache can not be invalidated from other processes, use
+    `cache.SQLiteCache('/path/to/file.sqlite')` for a cache that is shared between processes.
+    """
+    from . import cache
+    return cache.LRUCache(max_entries=1000)
+
+
+def prepared_statements() -> bool:
+    """
+    When true, queries on data sets are run as server-side prepared statements (one per query shape and
+    connection), which saves planning time for repeated queries. Only useful together with connection pooling.
+    """
+    return False
+
+
+def prepared_statements_per_connection() -> int:
+    """How many prepared statements a connection keeps at most (the least recently used are deallocated)"""
+    return 100
+
+
+def result_cache_ttl() -> float:
+    """How many seconds query results are cached (can be overwritten per data set)"""
+    return 300
+
+
+def export_directory() -> str:
+    """
+    The directory where export jobs store their state and files. Needs to be on a local disk, or on a disk that
+    is shared between all machines that run the web app.
+    """
+    return os.path.join(tempfile.gettempdir(), 'mara-data-explorer-exports')
+
+
+def export_workers() -> int:
+    """How many export jobs can run in parallel per process"""
+    return 4
+
+
+def export_max_jobs_per_user() -> int:
+    """How many unfinished export jobs a user can have at the same time"""
+    return 2
+
+
+def export_retention() -> float:
+    """After how many seconds finished export jobs and their files are removed"""
+    return 24 * 60 * 60
+
+
+def export_parallelism() -> int:
+    """
+    How many ranges of a csv export are exported at the same time (each with a separate database connection),
+    for data sets with a `partition_column_name`
+    """
+    return 4
+
+
+def export_compression_level() -> int:
+    """The gzip compression level (1-9) of exported and downloaded csv files"""
+    return 6
+
+
+def zstd_compression_level() -> int:
+    """The zstd compression level (1-22) of downloaded csv files"""
+    return 3
+
+
+def zstd_compression_threads() -> int:
+    """How many threads compress a zstd download (0 for compressing in the streaming thread only)"""
+    return 2
+
+
+def arrow_batch_size() -> int:
+    """How many rows are fetched and converted at once for Parquet and Arrow downloads and exports"""
+    return 50000
+
+
+def autocomplete_dictionary_max_values() -> int:
+    """
+    Columns with up to this many distinct values are auto-completed from an in-memory dictionary,
+    columns with more values are queried directly. 0 disables dictionaries.
+    """
+    return 100000
+
+
+def autocomplete_dictionary_ttl() -> float:
+    """After how many seconds the dictionaries for auto-completion are rebuilt (in the background)"""
+    return 3600
+
+
+def distribution_sampling_min_row_count() -> int:
+    """Distribution charts of data sets with fewer rows are always computed exactly, even when sampling is enabled"""
+    return 1000000
+
+
+def column_statistics_max_age() -> float:
+    """
+    For how many seconds the precomputed column statistics of a data set (see `statistics.refresh`) are used for
+    answering unfiltered distributions and estimated row counts. 0 disables the statistics catalog.
+    """
+    return 7 * 24 * 60 * 60
+
+
+def column_metadata_directory() -> str:
+    """
+    The directory where the columns of data set tables are cached, so that they are shared between processes.
+    None disables caching on disk.
+    """
+    return os.path.join(tempfile.gettempdir(), 'mara-data-explorer-columns')
+
+
+def column_metadata_ttl() -> float:
+    """After how many seconds the cached columns of a data set are revalidated against the database table"""
+    return 60
+
+
+def result_cache_stale_ttl() -> float:
+    """
+    For how many seconds after expiring cached previews of the index page are still shown while they are
+    recomputed in the background. 0 disables this.
+    """
+    return 3600
+
+
+def preview_concurrency() -> int:
+    """How many previews of the index page are computed at the same time per database alias"""
+    return 4
+
+
+def statement_timeout() -> float:
+    """After how many seconds queries on data sets are canceled (can be overwritten per data set), 0 disables this"""
+    return 0
+
+
+def max_concurrent_queries() -> int:
+    """How many expensive requests (row counts, distributions, downloads) can run at the same time per process"""
+    return 16
+
+
+def max_concurrent_queries_per_user() -> int:
+    """How many expensive requests of a single user can run at the same time per process"""
+    return 4
+
+
+def query_queue_timeout() -> float:
+    """How many seconds an expensive request waits for other requests to finish before it fails"""
+    return 60
+
+
+def profiling() -> bool:
+    """Whether the durations of queries, rendering and requests are recorded (see `profiling`)"""
+    return True
+
+
+def metrics_token() -> str:
+    """
+    A secret with which Prometheus can scrape `/explore/.metrics` without a user session (sent as an
+    `Authorization: Bearer <token>` header). None allows only users with the "Query Profiling" ACL resource.
+    """
+    return None
+
+
+def profiling_max_samples() -> int:
+    """How many recent durations per endpoint, data set and kind of work are kept for computing percentiles"""
+    return 1000
+
+
+def profiling_max_query_shapes() -> int:
+    """How many distinct query shapes are kept (the least recently seen are dropped first)"""
+    return 500
+
+
+def profiling_slow_query_threshold() -> float:
+    """
+    Queries that take longer than this many seconds are run a second time with `EXPLAIN (ANALYZE, BUFFERS)` in
+    the background (at most once per hour and query shape) for showing their plan. 0 disables this.
+    """
+    return 0
@@ -1,23 +1,35 @@
 """Representation and management of data sets"""
 
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
 import mara_db.dbs
-import mara_db.postgresql
-from . import config
+from . import cache, config, governor, pool, profiling
+
+logger = logging.getLogger(__name__)
 
 
 class Column():
     """Base class for different database column types"""
 
-    def __init__(self, column_name, type: str):
+    def __init__(self, column_name, type: str, database_type: str = None):
         """
         A column of a data set
 
         Args:
             column_name: the corresponding column_name in the database table
             type: The type of the column
+            database_type: The type of the column in the database, e.g. `bigint` for a `number` column
         """
         self.column_name = column_name
         self.type = type
+        self.database_type = database_type
 
     def sortable(self) -> bool:
         """Whether the column is sortable"""
@@ -35,7 +47,11 @@ class DataSet():
                  database_alias: str, database_schema: str, database_table: str,
                  default_column_names: [str],
                  personal_data_column_names: [str] = None, use_attributes_table: bool = False,
-                 custom_column_renderers: dict = None):
+                 custom_column_renderers: dict = None, result_cache_ttl: float = None,
+                 unique_column_names: [str] = None, estimate_row_counts: bool = False,
+                 distribution_sample_percent: float = None, distribution_sample_row_count: int = None,
+                 distribution_sample_method: str = 'SYSTEM', statement_timeout: float = None,
+                 rollup_column_names: [str] = None, partition_column_name: str = None):
         """
         Description of a database table with default output columns
 
@@ -51,6 +67,29 @@ class DataSet():
                                   is used for auto-completion
             custom_column_renderers: A mapping of columns to functions that render columns differently,
                                      e.g. `{'my-column': lambda value: f'<span style='color:red'>{value}</span>'}`
+            result_cache_ttl: How many seconds query results are cached. When None, then
+                              `config.result_cache_ttl()` is used, 0 disables caching.
+            unique_column_names: Columns (without NULL values) that together uniquely identify a row. Enables
+                                 keyset pagination of the preview, which makes deep pages as fast as the first one
+                                 (ideally there is an index on these columns)
+            estimate_row_counts: When true, then the UI shows row counts that are estimated from table statistics
+                                 and query plans, exact counts are only computed on demand
+            distribution_sample_percent: When set, then distribution charts are computed from a random sample of
+                                         this percentage of the table rows (unless the table is smaller than
+                                         `config.distribution_sampling_min_row_count()`)
+            distribution_sample_row_count: Like `distribution_sample_percent`, but the percentage is chosen so
+                                           that the sample has roughly this many rows
+            distribution_sample_method: The `TABLESAMPLE` method, `SYSTEM` (fast, samples whole pages) or
+                                        `BERNOULLI` (slower, samples individual rows)
+            statement_timeout: After how many seconds queries on the data set are canceled. When None, then
+                               `config.statement_timeout()` is used, 0 disables the timeout.
+            rollup_column_names: A few low-cardinality text, number or date columns that are pre-aggregated in a
+                                 `{{database_schema}}.{{database_table}}_rollup` table (see `rollup.refresh`).
+                                 Row counts and text and date distributions with filters on only these
+                                 columns are then answered from the rollup table.
+            partition_column_name: A number, date or timestamp column (ideally indexed) by which csv exports are
+                                   split into ranges that are exported in parallel (see
+                                   `Query.as_partitioned_csv`, other columns are exported without ranges)
         """
         self.id = id
         self.name = name
@@ -61,46 +100,132 @@ class DataSet():
         self.personal_data_column_names = personal_data_column_names or []
         self.use_attributes_table = use_attributes_table
         self.custom_column_renderers = custom_column_renderers or {}
+        self.result_cache_ttl = result_cache_ttl
+        self.unique_column_names = unique_column_names or []
+        self.estimate_row_counts = estimate_row_counts
+        assert (distribution_sample_method in ['SYSTEM', 'BERNOULLI'])
+        self.distribution_sample_percent = distribution_sample_percent
+        self.distribution_sample_row_count = distribution_sample_row_count
+        self.distribution_sample_method = distribution_sample_method
+        self.statement_timeout = statement_timeout
+        self.rollup_column_names = rollup_column_names or []
+        self.partition_column_name = partition_column_name
 
         self._columns = {}
+        self._column_types = []  # tuples of column name and database type
+        self._columns_fingerprint = None  # a hash of the column names and types
+        self._columns_checked_at = None
+        self._columns_lock = threading.Lock()
 
     @property
     def columns(self) -> {str: Column}:
-        """Retrieves all columns of a data set from the database table"""
-        if not self._columns:
-            with mara_db.postgresql.postgres_cursor_context(self.database_alias) as cursor:
-                cursor.execute(f"""
+        """
+        Retrieves all columns of a data set from the database table. The columns are cached in memory and in
+        `config.column_metadata_directory()` and revalidated every `config.column_metadata_ttl()` seconds.
+        """
+        if self._columns_checked_at is None or time.time() - self._columns_checked_at > config.column_metadata_ttl():
+            with self._columns_lock:
+                if self._columns_checked_at is None \
+                        or time.time() - self._columns_checked_at > config.column_metadata_ttl():
+                    self._refresh_columns()
+        return self._columns
+
+    def _refresh_columns(self):
+        """
+        Revalidates the cached columns with a fingerprint of the table definition, reloads them when changed.
+        When the table can not be queried, then cached columns are used until the next revalidation.
+        """
+        if self._columns_checked_at is None:
+            state = self._read_column_metadata()
+            if state:
+                self._columns_fingerprint = state['fingerprint']
+                self._column_types = state['columns']
+                self._columns = _columns(self._column_types,
+                                         f'{self.database_alias}.{self.database_schema}.{self.database_table}')
+                if time.time() - state['checked_at'] <= config.column_metadata_ttl():
+                    # recently checked by another process
+                    self._columns_checked_at = state['checked_at']
+                    return
+
+        try:
+            with pool.cursor_context(self.database_alias) as cursor:
+                cursor = profiling.profiled_cursor(cursor, self)
+                # a single cheap query when the columns are known already
+                if self._columns_fingerprint is not None:
+                    cursor.execute(f"""
+SELECT md5(string_agg(att.attname || ' ' || pg_catalog.format_type(atttypid, NULL), ',' ORDER BY attnum))
+FROM pg_attribute att
+  JOIN pg_class tbl ON tbl.oid = att.attrelid
+  JOIN pg_namespace ns ON tbl.relnamespace = ns.oid
+WHERE tbl.relname = {'%s'} AND ns.nspname = {'%s'} AND attnum > 0 AND NOT attisdropped""",
+                                   (self.database_table, self.database_schema))
+                    changed = cursor.fetchone()[0] != self._columns_fingerprint
+                else:
+                    changed = True
+
+                if changed:
+                    cursor.execute(f"""
 SELECT
   att.attname,
   pg_catalog.format_type(atttypid, NULL) AS display_type
 FROM pg_attribute att
   JOIN pg_class tbl ON tbl.oid = att.attrelid
   JOIN pg_namespace ns ON tbl.relnamespace = ns.oid
-WHERE tbl.relname = {'%s'} AND ns.nspname = {'%s'} AND attnum > 0
+WHERE tbl.relname = {'%s'} AND ns.nspname = {'%s'} AND attnum > 0 AND NOT attisdropped
 ORDER BY attnum""", (self.database_table, self.database_schema))
-                for column_name, column_type in cursor.fetchall():
-                    if column_type in ['character varying', 'text']:
-                        type = 'text'
-                    elif column_type in ['bigint', 'integer', 'real', 'smallint', 'double precision', 'numeric']:
-                        type = 'number'
-                    elif column_type in ['timestamp', 'timestamp with time zone', 'timestamp without time zone',
-                                         'time with time zone', 'time without time zone', 'date']:
-                        type = 'date'
-                    elif column_type in ['json', 'jsonb']:
-                        type = 'json'
-                    elif column_type == 'text[]':
-                        type = 'text[]'
-                    elif column_type == 'geometry':
-                        type = 'geometry'
-                    else:
-                        raise ValueError(
-                            f'Unimplemented column type "{column_type}" of "{self.database_alias}.{self.database_schema}.{self.database_table}.{column_name}"')
-                    self._columns[column_name] = Column(column_name, type)
-        return self._columns
+                    column_types = [list(row) for row in cursor.fetchall()]
+                    columns = _columns(column_types,
+                                       f'{self.database_alias}.{self.database_schema}.{self.database_table}')
+                    self._column_types, self._columns = column_types, columns
+                    self._columns_fingerprint = _columns_fingerprint(column_types)
+        except Exception:
+            if self._columns_fingerprint is None:
+                raise
+            # e.g. the database is not available, the columns are served from the cache until the next check
+            logger.exception(f'Columns of "{self.id}" could not be revalidated')
+            self._columns_checked_at = time.time()
+            return
+
+        self._columns_checked_at = time.time()
+        self._write_column_metadata()
+
+    def _column_metadata_path(self) -> str:
+        directory = config.column_metadata_directory()
+        if directory:
+            return os.path.join(directory, hashlib.sha1(
+                json.dumps([self.id, self.database_alias, self.database_schema, self.database_table])
+                    .encode()).hexdigest() + '.json')
+
+    def _read_column_metadata(self) -> {}:
+        path = self._column_metadata_path()
+        if path:
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+        return None
+
+    def _write_column_metadata(self):
+        """Atomically writes the cached columns to disk, so that they can be used by other processes"""
+        path = self._column_metadata_path()
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+                json.dump({'fingerprint': self._columns_fingerprint, 'columns': self._column_types,
+                           'checked_at': self._columns_checked_at}, f)
+            os.replace(f.name, path)
 
     def autocomplete_text_column(self, column_name, term):
         """Returns a list of values from `column` that contain `term` """
-        with mara_db.postgresql.postgres_cursor_context(self.database_alias) as cursor:
+        from . import autocomplete
+
+        # the in-memory dictionary of the column, when it has one
+        values = autocomplete.lookup(self, column_name, term)
+        if values is not None:
+            return values or ["\tNo match"]
+
+        with governor.cursor_context(self) as cursor:
             if self.columns[column_name].type == 'text[]':
                 cursor.execute(f"""
 SELECT f
@@ -130,15 +255,53 @@ LIMIT 50""", (f'%{term}%',))
             else:
                 return [row[0] for row in result]
 
-    def row_count(self):
-        """Compute the total number of rows of the data set"""
+    def row_count(self, estimate: bool = False):
+        """
+        Compute the total number of rows of the data set
+
+        Args:
+            estimate: When true, then the number of rows is taken from the statistics catalog (see
+                      `statistics.refresh`) or the table statistics (`pg_class.reltuples`), and only counted
+                      when neither is available
+        """
+        from . import statistics
+
         if self.columns:
-            with mara_db.postgresql.postgres_cursor_context(self.database_alias) as cursor:
-                cursor.execute(f'SELECT count(*) FROM "{self.database_schema}"."{self.database_table}"')
-                return cursor.fetchone()[0]
+            if estimate:
+                row_count = statistics.row_count(self)
+                if row_count is not None:
+                    return row_count
+                row_count = cache.cached(self, ['estimated_row_count'], self._estimated_row_count)
+                if row_count is not None:
+                    return row_count
+            return cache.cached(self, ['row_count'], self._row_count)
         else:
             return 0
 
+    def _row_count(self):
+        from . import rollup
+
+        use_rollup = rollup.covers(self, [])
+        with governor.cursor_context(self) as cursor:
+            if use_rollup:
+                cursor.execute(f'SELECT coalesce(sum("{rollup.COUNT_COLUMN_NAME}"), 0) :: BIGINT '
+                               f'FROM {rollup.table_name(self)}')
+            else:
+                cursor.execute(f'SELECT count(*) FROM "{self.database_schema}"."{self.database_table}"')
+            return cursor.fetchone()[0]
+
+    def _estimated_row_count(self):
+        with pool.cursor_context(self.database_alias) as cursor:
+            cursor = profiling.profiled_cursor(cursor, self)
+            cursor.execute(f"""
+SELECT tbl.reltuples :: BIGINT
+FROM pg_class tbl
+  JOIN pg_namespace ns ON tbl.relnamespace = ns.oid
+WHERE tbl.relname = {'%s'} AND ns.nspname = {'%s'}""", (self.database_table, self.database_schema))
+            row = cursor.fetchone()
+            # -1 (or 0 before Postgres 14) when the table has never been vacuumed or analyzed
+            return row[0] if row and row[0] > 0 else None
+
     def __repr__(self):
         return f'<DataSet "{self.name}">'
 
@@ -147,3 +310,58 @@ def find_data_set(id: str) -> DataSet:
     """Returns a data set by its id"""
     for ds in config.data_sets():
         if ds.id == id: return ds
+
+
+def warm_up_column_metadata(data_sets: [DataSet] = None, max_workers: int = 8) -> {str: Exception}:
+    """
+    Loads (or revalidates) the columns of data sets in parallel, e.g. at startup
+
+    Args:
+        data_sets: The data sets to load, all data sets from `config.data_sets()` when None
+        max_workers: How many data sets are loaded at the same time
+
+    Returns: The exceptions of data sets whose columns could not be loaded by data set id
+    """
+    errors = {}
+
+    def load(data_set: DataSet):
+        try:
+            data_set.columns
+        except Exception as e:
+            errors[data_set.id] = e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix='column-metadata') as executor:
+        list(executor.map(load, config.data_sets() if data_sets is None else data_sets))
+    return errors
+
+
+def _columns(column_types: [(str, str)], table_name: str) -> {str: Column}:
+    """Creates columns from tuples of column names and database types"""
+    columns = {}
+    for column_name, column_type in column_types:
+        if column_type in ['character varying', 'text']:
+            type = 'text'
+        elif column_type in ['bigint', 'integer', 'real', 'smallint', 'double precision', 'numeric']:
+            type = 'number'
+        elif column_type in ['timestamp', 'timestamp with time zone', 'timestamp without time zone',
+                             'time with time zone', 'time without time zone', 'date']:
+            type = 'date'
+        elif column_type in ['json', 'jsonb']:
+            type = 'json'
+        elif column_type == 'text[]':
+            type = 'text[]'
+        elif column_type == 'geometry':
+            type = 'geometry'
+        else:
+            raise ValueError(f'Unimplemented column type "{column_type}" of "{table_name}.{column_name}"')
+        columns[column_name] = Column(column_name, type, column_type)
+    return columns
+
+
+def _columns_fingerprint(column_types: [(str, str)]) -> str:
+    """The same hash of column names and types as computed in the database by `DataSet._refresh_columns`"""
+    if not column_types:
+        return None
+    return hashlib.md5(','.join(f'{column_name} {column_type}' for column_name, column_type in column_types)
+                       .encode()).hexdigest()
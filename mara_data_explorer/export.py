@@ -0,0 +1,306 @@
+"""Asynchronous export jobs (CSV, Parquet and Arrow files and Google sheets) that run in a background thread pool"""
+
+import concurrent.futures
+import datetime
+import fcntl
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from mara_page import acl
+from . import config, governor
+
+
+class ExportLimitExceeded(Exception):
+    """Raised when a user already has the maximum number of unfinished export jobs"""
+
+
+class ExportJob():
+    def __init__(self, job_id: str, kind: str, data_set_id: str, user: str, file_name: str,
+                 status: str = 'queued', rows_written: int = 0, bytes_written: int = 0, error: str = None,
+                 url: str = None, pid: int = None,
+                 created_at: float = None, updated_at: float = None, finished_at: float = None):
+        """
+        An export of a query result that runs in the background. The state of a job is stored as a json file in
+        `config.export_directory()`, so that it can be polled from all processes on the same machine (or on all
+        machines that share the directory). The process that runs a job saves its state at least every
+        `HEARTBEAT_INTERVAL` seconds, so that jobs of processes that died can be detected.
+
+        Args:
+            job_id: A unique id of the job
+            kind: `csv`, `parquet`, `arrow` or `google-sheet`
+            data_set_id: The id of the exported data set
+            user: The email of the user who started the export
+            file_name: The name of the exported file or sheet
+            status: One of `queued`, `running`, `done` or `failed`
+            rows_written: How many rows have been exported so far
+            bytes_written: How many bytes have been exported so far (uncompressed for csv files)
+            error: The error message of a failed job
+            url: The url of the Google sheet of a finished job
+            pid: The id of the process that runs the job (for information only, the process can run on another
+                 machine)
+            created_at: When the job was submitted (unix time)
+            updated_at: When the state of the job was last saved
+            finished_at: When the job has finished
+        """
+        self.job_id = job_id
+        self.kind = kind
+        self.data_set_id = data_set_id
+        self.user = user
+        self.file_name = file_name
+        self.status = status
+        self.rows_written = rows_written
+        self.bytes_written = bytes_written
+        self.error = error
+        self.url = url
+        self.pid = pid
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        self.finished_at = finished_at
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ['done', 'failed']
+
+    @property
+    def has_file(self) -> bool:
+        """Whether the job exports to a file that can be downloaded"""
+        return self.kind != 'google-sheet'
+
+    @property
+    def file_path(self) -> str:
+        """The exported file (gzip compressed for csv exports)"""
+        if self.kind == 'csv':
+            return os.path.join(config.export_directory(), f'{self.job_id}.csv.gz')
+        return os.path.join(config.export_directory(), f'{self.job_id}.{self.kind}')
+
+    def save(self):
+        """Atomically writes the state of the job to disk"""
+        with _save_lock:
+            self.updated_at = time.time()
+            path = _state_file_path(self.job_id)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.to_dict(), f)
+            os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, job_id: str) -> 'ExportJob':
+        """Reads the state of a job from disk, returns None when it does not exist (anymore)"""
+        if not re.fullmatch('[0-9a-f]{32}', job_id):
+            return None
+        try:
+            with open(_state_file_path(job_id)) as f:
+                job = cls(**json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if not job.finished and time.time() - job.updated_at > HEARTBEAT_INTERVAL * 6:
+            # e.g. the web server has been restarted
+            job.status, job.error = 'failed', 'The export was interrupted'
+        return job
+
+    def to_dict(self) -> {}:
+        return {'job_id': self.job_id, 'kind': self.kind, 'data_set_id': self.data_set_id, 'user': self.user,
+                'file_name': self.file_name, 'status': self.status, 'rows_written': self.rows_written,
+                'bytes_written': self.bytes_written, 'error': self.error, 'url': self.url, 'pid': self.pid,
+                'created_at': self.created_at, 'updated_at': self.updated_at, 'finished_at': self.finished_at}
+
+    def __repr__(self):
+        return f'<ExportJob {self.job_id} "{self.file_name}" {self.status}>'
+
+
+def submit_csv_export(query: 'query.Query', delimiter: str, decimal_mark: str,
+                      include_personal_data: bool) -> ExportJob:
+    """Starts exporting a query to a gzip compressed csv file"""
+    file_name = query.data_set_id + ('-' + query.query_id if query.query_id else '') \
+                + '-' + datetime.date.today().isoformat() + '.csv'
+
+    def run(job: ExportJob, progress: callable):
+        quoted = False  # whether the previous chunk ended inside of a quoted value
+        with gzip.open(job.file_path + '.tmp', 'wb', compresslevel=config.export_compression_level()) as f:
+            # exported in parallel for data sets with a partition column
+            for chunk in query.as_partitioned_csv(delimiter, decimal_mark, include_personal_data, user=job.user):
+                f.write(chunk)
+                # the header is subtracted when the export is done
+                rows, quoted = _count_csv_rows(chunk, quoted)
+                progress(rows, len(chunk))
+        os.replace(job.file_path + '.tmp', job.file_path)
+        job.rows_written = max(job.rows_written - 1, 0)
+
+    return _submit('csv', query.data_set_id, file_name, run)
+
+
+def submit_arrow_export(query: 'query.Query', format: str, compression: str,
+                        include_personal_data: bool) -> ExportJob:
+    """Starts exporting a query to a Parquet or Arrow IPC file, see `arrow_export.as_file`"""
+    from . import arrow_export
+
+    file_name = query.data_set_id + ('-' + query.query_id if query.query_id else '') \
+                + '-' + datetime.date.today().isoformat() + '.' + arrow_export.FORMATS[format][0]
+
+    def run(job: ExportJob, progress: callable):
+        with open(job.file_path + '.tmp', 'wb') as f:
+            for chunk in arrow_export.as_file(query, format, include_personal_data, compression,
+                                              progress=lambda rows: progress(rows, 0)):
+                f.write(chunk)
+                progress(0, len(chunk))
+        os.replace(job.file_path + '.tmp', job.file_path)
+
+    return _submit(format, query.data_set_id, file_name, run)
+
+
+def submit_google_sheet_export(query: 'query.Query', service_factory: callable, decimal_mark: str, array_format: str,
+                               include_personal_data: bool) -> ExportJob:
+    """Starts uploading a query to a new Google sheet, see `google_sheet.upload_query`"""
+    from . import google_sheet
+
+    title = query.data_set_id + ('-' + query.query_id if query.query_id else '') \
+            + '-' + datetime.date.today().isoformat()
+
+    def run(job: ExportJob, progress: callable):
+        spreadsheet_id = google_sheet.upload_query(
+            query, service_factory, title=title, decimal_mark=decimal_mark, array_format=array_format,
+            include_personal_data=include_personal_data,
+            progress=lambda row_count: progress(row_count - job.rows_written, 0))
+        job.url = 'https://docs.google.com/spreadsheets/d/' + str(spreadsheet_id)
+
+    return _submit('google-sheet', query.data_set_id, title, run)
+
+
+def list_jobs(user: str = None) -> [ExportJob]:
+    """All jobs (of a user), the most recent first"""
+    jobs = []
+    if os.path.isdir(config.export_directory()):
+        for file_name in os.listdir(config.export_directory()):
+            if file_name.endswith('.json'):
+                job = ExportJob.load(file_name[:-len('.json')])
+                if job and (user is None or job.user == user):
+                    jobs.append(job)
+    return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+
+def cleanup(max_age: float = None):
+    """
+    Removes finished jobs and their files that are older than `max_age` seconds
+
+    Args:
+        max_age: The age in seconds, `config.export_retention()` when None
+    """
+    max_age = config.export_retention() if max_age is None else max_age
+    for job in list_jobs():
+        if job.finished and time.time() - (job.finished_at or job.updated_at) > max_age:
+            for path in [job.file_path, job.file_path + '.tmp', _state_file_path(job.job_id)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+# how often (in seconds) the process that runs a job saves its state
+HEARTBEAT_INTERVAL = 10
+
+_executor = None
+_executor_pid = None
+_submit_lock = threading.Lock()
+_save_lock = threading.Lock()
+_running_jobs = set()  # the unfinished jobs of the current process
+
+
+def _submit(kind: str, data_set_id: str, file_name: str, run: callable) -> ExportJob:
+    """Creates a job and runs it in the thread pool of the process"""
+    global _executor, _executor_pid
+
+    os.makedirs(config.export_directory(), exist_ok=True)
+    cleanup()
+
+    user = acl.current_user_email()
+    # the limit is enforced across all processes (and machines) that share the export directory
+    with _submit_lock, open(os.path.join(config.export_directory(), '.submit.lock'), 'w') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        if len([job for job in list_jobs(user) if not job.finished]) >= config.export_max_jobs_per_user():
+            raise ExportLimitExceeded(
+                f'There are already {config.export_max_jobs_per_user()} unfinished exports, please wait until '
+                f'one of them is done')
+
+        job = ExportJob(job_id=uuid.uuid4().hex, kind=kind, data_set_id=data_set_id, user=user,
+                        file_name=file_name, pid=os.getpid())
+        job.save()
+
+        # thread pools can not be shared with forked processes
+        if _executor_pid != os.getpid():
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.export_workers(),
+                                                              thread_name_prefix='export')
+            _executor_pid = os.getpid()
+            _running_jobs.clear()
+            threading.Thread(target=_heartbeat, name='export-heartbeat', daemon=True).start()
+        _running_jobs.add(job)
+        _executor.submit(_run, job, run)
+    return job
+
+
+def _heartbeat():
+    """Saves the state of the unfinished jobs of the process regularly, also while they wait or make no progress"""
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        for job in list(_running_jobs):
+            job.save()
+
+
+def _run(job: ExportJob, run: callable):
+    last_saved_at = time.monotonic()
+
+    def progress(rows: int, bytes: int):
+        nonlocal last_saved_at
+        job.rows_written += rows
+        job.bytes_written += bytes
+        # don't write the state file more than once per second
+        if time.monotonic() - last_saved_at > 1:
+            job.save()
+            last_saved_at = time.monotonic()
+
+    try:
+        # the job stays queued (without a time limit) while the user has too many other running queries
+        with governor.concurrency_slot(job.user, blocking=True), \
+                governor.superseding(job.user, 'export ' + job.job_id):
+            job.status = 'running'
+            job.save()
+            run(job, progress)
+        job.status = 'done'
+    except Exception as e:
+        job.status, job.error = 'failed', str(e) or repr(e)
+        for path in [job.file_path, job.file_path + '.tmp']:
+            if os.path.exists(path):
+                os.remove(path)
+    job.finished_at = time.time()
+    job.save()
+    _running_jobs.discard(job)
+
+
+def _state_file_path(job_id: str) -> str:
+    return os.path.join(config.export_directory(), f'{job_id}.json')
+
+
+def _count_csv_rows(chunk: bytes, quoted: bool) -> (int, bool):
+    """
+    Counts the rows that end in a chunk of a csv file, without the line breaks inside of quoted values
+
+    Args:
+        chunk: A part of a csv file
+        quoted: Whether the previous chunk ended inside of a quoted value
+
+    Returns: The number of rows and whether the chunk ends inside of a quoted value
+    """
+    if b'"' not in chunk:
+        return (0 if quoted else chunk.count(b'\n')), quoted
+    rows = 0
+    # escaped quotes are doubled and don't change whether a line break is inside of a quoted value
+    *lines, rest = chunk.split(b'\n')
+    for line in lines:
+        quoted ^= line.count(b'"') % 2 == 1
+        if not quoted:
+            rows += 1
+    return rows, quoted ^ (rest.count(b'"') % 2 == 1)
@@ -0,0 +1,176 @@
+"""Uploading query results to Google sheets"""
+
+import concurrent.futures
+import random
+import threading
+import time
+
+from . import config
+
+# a spreadsheet can have at most 10M cells
+MAX_CELLS = 10000000
+
+# http status codes of failed requests that are retried
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+def upload_query(query: 'query.Query', service_factory: callable, title: str, decimal_mark: str, array_format: str,
+                 include_personal_data: bool, progress: callable = None, batch_size: int = 10000,
+                 max_retries: int = 5, backoff: float = 1.0) -> str:
+    """
+    Creates a Google sheet and uploads the result of a query to it
+
+    While rows are read from the database and converted, batches of `batch_size` rows are uploaded to
+    non-overlapping ranges by `config.google_sheet_upload_threads()` threads in parallel. Results with more
+    than `config.google_sheet_rows_per_sheet()` rows are split into several sheets (tabs), each with a header row.
+
+    Args:
+        query: The query to upload
+        service_factory: A function without arguments that returns a new service for the sheets v4 API
+                         (e.g. `googleapiclient.discovery.build('sheets', 'v4', credentials=credentials)`), called
+                         once per upload thread as services are not thread safe
+        title: The title of the new spreadsheet
+        decimal_mark: The decimal mark of numbers, determines the locale of the spreadsheet
+        array_format: Array to string format for array types
+        include_personal_data: When True, include columns that contain personal data
+        progress: An optional function that is called with the number of uploaded rows after each batch
+        batch_size: How many rows to send in one request
+        max_retries: How often requests that failed with a 429 or 5xx status are retried
+        backoff: The initial number of seconds to wait before a retry, doubled with each retry
+
+    Returns: The id of the new spreadsheet
+    """
+    rows_per_sheet = config.google_sheet_rows_per_sheet()
+    number_of_columns = max(len(query.column_names or []), 1)
+    # every sheet has an additional header row, so that the grids of all sheets together have at most
+    # max_rows + ceil(max_rows / rows_per_sheet) rows
+    max_rows = min(config.google_sheet_max_rows(),
+                   MAX_CELLS // number_of_columns * rows_per_sheet // (rows_per_sheet + 1))
+
+    rate_limiter = _RateLimiter(config.google_sheet_requests_per_minute())
+
+    def execute(request: callable):
+        """Executes a request, retries it when the API is overloaded or the quota is exceeded"""
+        for attempt in range(max_retries + 1):
+            rate_limiter.wait()
+            try:
+                return request().execute()
+            except Exception as e:
+                status = getattr(getattr(e, 'resp', None), 'status', None)
+                if attempt == max_retries or not status or int(status) not in RETRY_STATUSES:
+                    raise
+                time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+    def sheet_properties(sheet_index: int) -> {}:
+        # all cells of the grid count against the limit, so the last sheet has only room for the remaining rows
+        rows = min(rows_per_sheet, max_rows - sheet_index * rows_per_sheet)
+        return {'sheetId': sheet_index, 'title': f'Sheet {sheet_index + 1}',
+                'gridProperties': {'rowCount': rows + 1, 'columnCount': number_of_columns}}
+
+    service = service_factory()
+    spreadsheet_id = execute(lambda: service.spreadsheets().create(
+        body={'properties': {'title': title,
+                             # Determine decimal-mark through the Google sheet locale
+                             'locale': 'de_DE' if decimal_mark == ',' else 'en_US'},
+              'sheets': [{'properties': sheet_properties(0)}]},
+        fields='spreadsheetId'))['spreadsheetId']
+
+    # each upload thread has its own service
+    thread_local = threading.local()
+
+    def upload(sheet_index: int, start_row: int, values: [[]]):
+        if not hasattr(thread_local, 'service'):
+            thread_local.service = service_factory()
+        body = {'data': [{'values': values, 'range': f"'Sheet {sheet_index + 1}'!A{start_row}",
+                          'majorDimension': 'ROWS'}],
+                # USER_ENTERED: The values will be parsed as if the user typed them into the UI.
+                # Numbers will stay as numbers, but strings may be converted to numbers, dates, etc.
+                'valueInputOption': 'USER_ENTERED'}
+        execute(lambda: thread_local.service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id, body=body))
+
+    errors = []
+    uploaded_rows = 0
+    lock = threading.Lock()
+    # limits the number of batches that are read but not uploaded yet
+    pending_batches = threading.BoundedSemaphore(config.google_sheet_upload_threads() * 2)
+
+    def submit(executor, sheet_index: int, start_row: int, values: [[]], number_of_rows: int):
+        if errors:  # stop reading when an upload has failed
+            raise errors[0]
+        pending_batches.acquire()
+        future = executor.submit(upload, sheet_index, start_row, values)
+
+        def done(future):
+            nonlocal uploaded_rows
+            pending_batches.release()
+            with lock:
+                if future.exception():
+                    errors.append(future.exception())
+                elif number_of_rows:
+                    uploaded_rows += number_of_rows
+                    if progress:
+                        progress(uploaded_rows)
+
+        future.add_done_callback(done)
+
+    rows = query.as_rows_for_google_sheet(array_format=array_format, header=True, limit=max_rows,
+                                          include_personal_data=include_personal_data, batch_size=batch_size)
+    try:
+        header = next(iter(rows), None)
+        row_count = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.google_sheet_upload_threads(),
+                                                   thread_name_prefix='google-sheet-upload') as executor:
+            if header:
+                submit(executor, 0, 1, [header], 0)
+
+            batch = []
+            for row in rows:
+                if not batch:
+                    sheet_index, start_row = divmod(row_count, rows_per_sheet)
+                    if start_row == 0 and sheet_index > 0:
+                        execute(lambda: service.spreadsheets().batchUpdate(
+                            spreadsheetId=spreadsheet_id,
+                            body={'requests': [{'addSheet': {'properties': sheet_properties(sheet_index)}}]}))
+                        submit(executor, sheet_index, 1, [header], 0)
+                batch.append(row)
+                row_count += 1
+                if len(batch) == batch_size or row_count % rows_per_sheet == 0:
+                    submit(executor, sheet_index, start_row + 2, batch, len(batch))
+                    batch = []
+            if batch:
+                submit(executor, sheet_index, start_row + 2, batch, len(batch))
+    finally:
+        # releases the database connection when the upload has failed
+        if hasattr(rows, 'close'):
+            rows.close()
+
+    if errors:
+        raise errors[0]
+
+    # remove the empty rows of the last sheet
+    if row_count % rows_per_sheet:
+        execute(lambda: service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'requests': [{'updateSheetProperties': {
+                'properties': {'sheetId': (row_count - 1) // rows_per_sheet,
+                               'gridProperties': {'rowCount': row_count % rows_per_sheet + 1}},
+                'fields': 'gridProperties.rowCount'}}]}))
+
+    return spreadsheet_id
+
+
+class _RateLimiter():
+    def __init__(self, requests_per_minute: int):
+        """Spaces out requests (across threads) so that at most `requests_per_minute` are started per minute"""
+        self.interval = 60.0 / requests_per_minute
+        self._next_request_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
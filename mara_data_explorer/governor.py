@@ -0,0 +1,173 @@
+"""Governance of queries on data sets: statement timeouts, cancellation of superseded queries and concurrency limits"""
+
+import contextlib
+import contextvars
+import hashlib
+import json
+import threading
+import time
+
+from . import config, pool, profiling
+
+
+class QueueTimeout(Exception):
+    """Raised when a query could not be started in time because too many other queries were running"""
+
+
+# the postgres `application_name` of the queries of the current request, see `superseding`
+_application_name = contextvars.ContextVar('application_name', default=None)
+
+# whether the queries in the current context run without a statement timeout, see `without_statement_timeout`
+_without_statement_timeout = contextvars.ContextVar('without_statement_timeout', default=False)
+
+
+@contextlib.contextmanager
+def cursor_context(data_set: 'data_set.DataSet') -> 'psycopg2.extensions.cursor':
+    """
+    A cursor on the database of a data set (see `pool.cursor_context`), with the statement timeout of the data set.
+    Inside of `superseding`, queries of earlier requests with the same key that are still running are canceled.
+    All statements are profiled (see `profiling.profiled_cursor`).
+    """
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        statement_timeout = _statement_timeout(data_set)
+        application_name = _application_name.get()
+
+        # both settings are reset at the end of the transaction
+        settings, parameters = [], []
+        if statement_timeout:
+            settings.append("set_config('statement_timeout', %s, TRUE)")
+            parameters.append(str(int(statement_timeout * 1000)))
+        if application_name:
+            settings.append("set_config('application_name', %s, TRUE)")
+            settings.append('(SELECT count(pg_cancel_backend(pid)) FROM pg_stat_activity '
+                            'WHERE application_name = %s AND pid <> pg_backend_pid())')
+            parameters += [application_name, application_name]
+        if settings:
+            cursor.execute('SELECT ' + ', '.join(settings), parameters)
+        yield profiling.profiled_cursor(cursor, data_set)
+
+
+def transaction_settings(data_set: 'data_set.DataSet') -> [str]:
+    """
+    The statement timeout of a data set and the application name of the current `superseding` context as
+    `SET LOCAL` statements, for transactions that are not run with `cursor_context` (e.g. by psql). Unlike
+    `cursor_context`, they don't cancel other queries, but the queries can be canceled with `cancel`.
+    """
+    statements = []
+    statement_timeout = _statement_timeout(data_set)
+    if statement_timeout:
+        statements.append(f'SET LOCAL statement_timeout = {int(statement_timeout * 1000)};')
+    application_name = _application_name.get()
+    if application_name:
+        # a hash, see `_application_name_of`
+        statements.append(f"SET LOCAL application_name = '{application_name}';")
+    return statements
+
+
+def _statement_timeout(data_set: 'data_set.DataSet') -> float:
+    if _without_statement_timeout.get():
+        return None
+    return data_set.statement_timeout if data_set.statement_timeout is not None else config.statement_timeout()
+
+
+@contextlib.contextmanager
+def without_statement_timeout():
+    """
+    Runs all queries that are run with `cursor_context` inside of the context without a statement timeout, e.g.
+    for maintenance jobs that scan whole tables (see `statistics.refresh`)
+    """
+    token = _without_statement_timeout.set(True)
+    try:
+        yield
+    finally:
+        _without_statement_timeout.reset(token)
+
+
+@contextlib.contextmanager
+def superseding(user: str, key: str, part: str = None):
+    """
+    Marks all queries that are run with `cursor_context` inside of the context with a user and key (e.g. the url
+    of a request on a specific page) as their `application_name`. A query with the same user and key cancels
+    the queries of earlier requests, which works across processes and machines.
+
+    Args:
+        user: The email of the current user
+        key: Identifies requests that supersede each other, None disables cancellation
+        part: For requests that run several queries concurrently, the part of the request that the queries
+              belong to. Queries of different parts don't cancel each other, but all of them are canceled
+              together by `cancel` with the key of the request.
+    """
+    token = _application_name.set(_application_name_of(user, key, part) if key else None)
+    try:
+        yield
+    finally:
+        _application_name.reset(token)
+
+
+def cancel(data_set: 'data_set.DataSet', user: str, key: str) -> int:
+    """
+    Cancels the running queries of a user and key (see `superseding`), including the queries of all parts
+    of the request, e.g. when a request has been aborted by the client
+
+    Returns: The number of canceled queries
+    """
+    application_name = _application_name_of(user, key)
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        cursor.execute('SELECT count(pg_cancel_backend(pid)) FROM pg_stat_activity '
+                       "WHERE application_name = %s OR application_name LIKE %s || ' %%'",
+                       (application_name, application_name))
+        return cursor.fetchone()[0]
+
+
+def _application_name_of(user: str, key: str, part: str = None) -> str:
+    """The hash of the user and key, followed by a hash of the part (at most 63 characters)"""
+    application_name = 'mara-data-explorer ' + hashlib.sha1(json.dumps([user, key]).encode()).hexdigest()[:32]
+    if part is not None:
+        application_name += ' ' + hashlib.sha1(part.encode()).hexdigest()[:8]
+    return application_name
+
+
+_running_queries = {}  # user -> number of running queries
+_running_queries_total = 0
+_condition = threading.Condition()
+
+
+@contextlib.contextmanager
+def concurrency_slot(user: str, blocking: bool = False, timeout: float = None):
+    """
+    Waits until fewer than `config.max_concurrent_queries_per_user()` queries of the user and fewer than
+    `config.max_concurrent_queries()` queries overall are running (in the current process)
+
+    Args:
+        user: The email of the current user
+        blocking: When true, then waits without a time limit (e.g. for background jobs that nobody waits for)
+        timeout: How many seconds to wait when not blocking, `config.query_queue_timeout()` when None
+
+    Raises: QueueTimeout when not blocking and no slot became free in time
+    """
+    global _running_queries_total
+
+    max_queries, max_queries_per_user = config.max_concurrent_queries(), config.max_concurrent_queries_per_user()
+    deadline = None if blocking \
+        else time.monotonic() + (config.query_queue_timeout() if timeout is None else timeout)
+    with _condition:
+        while (max_queries and _running_queries_total >= max_queries) \
+                or (max_queries_per_user and _running_queries.get(user, 0) >= max_queries_per_user):
+            if deadline is None:
+                _condition.wait()
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise QueueTimeout('Too many running queries, please try again later')
+            _condition.wait(remaining)
+        _running_queries[user] = _running_queries.get(user, 0) + 1
+        _running_queries_total += 1
+    try:
+        yield
+    finally:
+        with _condition:
+            _running_queries[user] -= 1
+            if not _running_queries[user]:
+                del _running_queries[user]
+            _running_queries_total -= 1
+            _condition.notify_all()
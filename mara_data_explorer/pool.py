@@ -0,0 +1,265 @@
+"""Pooled connections to the databases of data sets"""
+
+import collections
+import contextlib
+import hashlib
+import os
+import re
+import threading
+import time
+import weakref
+
+import mara_db.dbs
+import mara_db.postgresql
+from . import config
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out from a pool in time"""
+
+
+class ConnectionPool():
+    def __init__(self, db_alias: str, min_size: int, max_size: int,
+                 idle_timeout: float, health_check_interval: float, checkout_timeout: float):
+        """
+        A thread safe pool of psycopg2 connections to a single database
+
+        Args:
+            db_alias: The alias of the mara_db connection to use
+            min_size: How many idle connections to keep open at least
+            max_size: How many connections can be open at most
+            idle_timeout: After how many seconds an idle connection is closed (but never below `min_size`)
+            health_check_interval: Connections that have been idle for longer than this many seconds are
+                                   checked with a `SELECT 1` before they are handed out
+            checkout_timeout: How many seconds to wait for a free connection before giving up
+        """
+        self.db_alias = db_alias
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = []  # tuples of (connection, time of check-in), the most recently used last
+        self._size = 0  # idle + checked out connections
+        self._condition = threading.Condition()
+
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.checkouts = 0
+        self.checkout_wait_seconds = 0.0
+        self.failed_health_checks = 0
+
+    def checkout(self) -> 'psycopg2.extensions.connection':
+        """Returns an idle connection or opens a new one, blocks when `max_size` connections are in use"""
+        start_time = time.monotonic()
+        with self._condition:
+            while True:
+                self._close_expired_connections()
+                if self._idle:
+                    connection, checked_in_at = self._idle.pop()
+                    break
+                elif self._size < self.max_size:
+                    self._size += 1
+                    connection, checked_in_at = None, None
+                    break
+                remaining = self.checkout_timeout - (time.monotonic() - start_time)
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise PoolTimeout(f'No free connection to "{self.db_alias}" after {self.checkout_timeout} seconds')
+            self.checkouts += 1
+            self.checkout_wait_seconds += time.monotonic() - start_time
+
+        if connection is not None and time.monotonic() - checked_in_at > self.health_check_interval \
+                and not self._is_healthy(connection):
+            # keep the slot for the replacement connection
+            self._close(connection, release_slot=False)
+            connection = None
+
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+        return connection
+
+    def checkin(self, connection: 'psycopg2.extensions.connection'):
+        """Gives a connection back to the pool, broken connections or those in a transaction are discarded"""
+        import psycopg2.extensions
+
+        if connection.closed or connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self._close(connection)
+        else:
+            with self._condition:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+
+    def close_all(self):
+        """Closes all idle connections"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def metrics(self) -> {str: float}:
+        """Current state and usage statistics of the pool"""
+        with self._condition:
+            return {'size': self._size,
+                    'idle': len(self._idle),
+                    'in_use': self._size - len(self._idle),
+                    'min_size': self.min_size,
+                    'max_size': self.max_size,
+                    'connections_created': self.connections_created,
+                    'connections_closed': self.connections_closed,
+                    'checkouts': self.checkouts,
+                    'checkout_wait_seconds': self.checkout_wait_seconds,
+                    'failed_health_checks': self.failed_health_checks}
+
+    def _connect(self):
+        import psycopg2
+
+        db = mara_db.dbs.db(self.db_alias)
+        assert (isinstance(db, mara_db.dbs.PostgreSQLDB))
+        connection = psycopg2.connect(dbname=db.database, user=db.user, password=db.password,
+                                      host=db.host, port=db.port,
+                                      **{key: getattr(db, key) for key in ['sslmode', 'sslrootcert', 'sslcert', 'sslkey']
+                                         if getattr(db, key, None)})
+        with self._condition:
+            self.connections_created += 1
+        return connection
+
+    def _close(self, connection, release_slot: bool = True):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self.connections_closed += 1
+            if release_slot:
+                self._size -= 1
+                self._condition.notify()
+
+    def _is_healthy(self, connection) -> bool:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except Exception:
+            with self._condition:
+                self.failed_health_checks += 1
+            return False
+
+    def _close_expired_connections(self):
+        """Closes connections that have been idle for too long, needs to be called with the lock held"""
+        now = time.monotonic()
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.pop(0)
+            try:
+                connection.close()
+            except Exception:
+                pass
+            self._size -= 1
+            self.connections_closed += 1
+
+    def __repr__(self):
+        return f'<ConnectionPool "{self.db_alias}" {self._size}/{self.max_size}>'
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def connection_pool(db_alias: str) -> ConnectionPool:
+    """Returns the connection pool of a database alias, or None when pooling is disabled"""
+    global _pools_pid
+
+    min_size, max_size = config.connection_pool_size()
+    if max_size <= 0:
+        return None
+
+    with _pools_lock:
+        # connections can not be shared with forked processes (e.g. gunicorn workers)
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if db_alias not in _pools:
+            _pools[db_alias] = ConnectionPool(db_alias, min_size=min_size, max_size=max_size,
+                                              idle_timeout=config.connection_pool_idle_timeout(),
+                                              health_check_interval=config.connection_pool_health_check_interval(),
+                                              checkout_timeout=config.connection_pool_checkout_timeout())
+        return _pools[db_alias]
+
+
+@contextlib.contextmanager
+def cursor_context(db_alias: str) -> 'psycopg2.extensions.cursor':
+    """
+    Creates a context with a psycopg2 cursor for a database alias. Like
+    `mara_db.postgresql.postgres_cursor_context`, but the connection is checked out from a pool.
+    """
+    pool = connection_pool(db_alias)
+    if not pool:
+        with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:
+            yield cursor
+        return
+
+    connection = pool.checkout()
+    cursor = connection.cursor()
+    try:
+        yield cursor
+        connection.commit()
+    except Exception as e:
+        try:
+            connection.rollback()
+        except Exception:
+            pass
+        raise e
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+        pool.checkin(connection)
+
+
+# names of the prepared statements of each connection, least recently used first
+_prepared_statements = weakref.WeakKeyDictionary()
+
+
+def execute(cursor: 'psycopg2.extensions.cursor', sql: str, parameters: [] = None):
+    """
+    Executes a statement with `%s` placeholders. When `config.prepared_statements()` is enabled, then the
+    statement is prepared once per connection (identified by a hash of its text) and executed with `EXECUTE`.
+    Each connection keeps at most `config.prepared_statements_per_connection()` statements, the least recently
+    used ones are deallocated.
+    """
+    if not config.prepared_statements():
+        cursor.execute(sql, parameters or [])
+        return
+
+    name = 'mara_data_explorer_' + hashlib.sha1(sql.encode()).hexdigest()[:20]
+    prepared_statements = _prepared_statements.setdefault(cursor.connection, collections.OrderedDict())
+    if name in prepared_statements:
+        prepared_statements.move_to_end(name)
+    else:
+        while prepared_statements and len(prepared_statements) >= config.prepared_statements_per_connection():
+            cursor.execute(f'DEALLOCATE {prepared_statements.popitem(last=False)[0]}')
+        # `%s` placeholders become `$1`, `$2`, .. and escaped `%%` become `%`
+        counter = iter(range(1, len(parameters or []) + 1))
+        cursor.execute(f'PREPARE {name} AS '
+                       + re.sub('%[s%]', lambda m: f'${next(counter)}' if m.group(0) == '%s' else '%', sql))
+        prepared_statements[name] = True
+    if parameters:
+        cursor.execute(f'EXECUTE {name} (' + ', '.join(['%s'] * len(parameters)) + ')', parameters)
+    else:
+        cursor.execute(f'EXECUTE {name}')
+
+
+def pool_metrics() -> {str: {str: float}}:
+    """Metrics of all connection pools of the current process by database alias"""
+    with _pools_lock:
+        pools = dict(_pools) if _pools_pid == os.getpid() else {}
+    return {db_alias: pool.metrics() for db_alias, pool in pools.items()}
@@ -0,0 +1,250 @@
+"""Instrumentation of database queries and rendering: timings per endpoint and data set, the slowest query shapes
+and captured query plans of slow queries (kept in memory per process)"""
+
+import collections
+import contextlib
+import hashlib
+import math
+import re
+import threading
+import time
+
+from . import config
+
+
+class QueryShape():
+    def __init__(self, shape: str, sql: str, data_set_id: str):
+        """
+        Statistics of all queries that only differ in their parameters and literals
+
+        Args:
+            shape: A hash of the normalized SQL statement
+            sql: The normalized statement (literals replaced by `?`)
+            data_set_id: The id of the queried data set
+        """
+        self.shape = shape
+        self.sql = sql
+        self.data_set_id = data_set_id
+        self.endpoints = set()
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seen_at = None
+        self.plan = None  # the output of `EXPLAIN (ANALYZE, BUFFERS)` of a slow execution
+        self.plan_captured_at = None
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return f'<QueryShape {self.shape} "{self.data_set_id}" {self.count}x>'
+
+
+class Timings():
+    def __init__(self, max_samples: int):
+        """The most recent durations of a kind of work (for percentiles) and the totals since process start"""
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+        self.total_seconds = 0.0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total_seconds += seconds
+
+    def percentile(self, percent: float) -> float:
+        """The nearest-rank percentile of the recent durations"""
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[max(0, math.ceil(percent / 100 * len(samples)) - 1)]
+
+
+_timings = {}  # (endpoint, data set id, kind) -> Timings
+_shapes = collections.OrderedDict()  # shape -> QueryShape, the least recently seen first
+_prepared_statements = {}  # name of a prepared statement (see `pool.execute`) -> its sql
+_lock = threading.Lock()
+
+
+def record(kind: str, data_set_id: str, seconds: float, endpoint: str = None):
+    """
+    Records the duration of some work
+
+    Args:
+        kind: What was done, e.g. `query`, `render rows` or `request`
+        data_set_id: The id of the data set (if any)
+        seconds: How long it took
+        endpoint: The name of the flask endpoint, the endpoint of the current request when None
+    """
+    if not config.profiling():
+        return
+    key = (endpoint or current_endpoint(), data_set_id, kind)
+    with _lock:
+        timings = _timings.get(key)
+        if not timings:
+            timings = _timings[key] = Timings(config.profiling_max_samples())
+        timings.add(seconds)
+
+
+@contextlib.contextmanager
+def span(kind: str, data_set_id: str = None):
+    """Records the duration of the work inside of the context (see `record`)"""
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        record(kind, data_set_id, time.monotonic() - start_time)
+
+
+def current_endpoint() -> str:
+    """The name of the view of the current request (without the blueprint), `background` outside of requests"""
+    import flask
+
+    if flask.has_request_context() and flask.request.endpoint:
+        return flask.request.endpoint.split('.')[-1]
+    return 'background'
+
+
+class ProfiledCursor():
+    def __init__(self, cursor: 'psycopg2.extensions.cursor', data_set: 'data_set.DataSet'):
+        """A wrapper of a psycopg2 cursor that records the duration and the shape of each executed statement"""
+        self._cursor = cursor
+        self._data_set = data_set
+
+    def execute(self, sql: str, parameters: [] = None):
+        if not config.profiling():
+            return self._cursor.execute(sql, parameters)
+
+        match = re.match(r'\s*(PREPARE|EXECUTE) (\w+)(?: AS )?', sql)
+        if match and match.group(1) == 'PREPARE':
+            _prepared_statements[match.group(2)] = sql[match.end():]
+            return self._cursor.execute(sql, parameters)
+
+        start_time = time.monotonic()
+        try:
+            return self._cursor.execute(sql, parameters)
+        finally:
+            seconds = time.monotonic() - start_time
+            if match:
+                # prepared statements are profiled with the sql of the statement (but can not be explained)
+                _record_query(self._data_set, _prepared_statements.get(match.group(2), sql), None, seconds,
+                              explainable=False)
+            else:
+                _record_query(self._data_set, sql, parameters, seconds)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+
+def profiled_cursor(cursor: 'psycopg2.extensions.cursor', data_set: 'data_set.DataSet') -> ProfiledCursor:
+    """Wraps a cursor so that all statements that are executed with it are profiled"""
+    return ProfiledCursor(cursor, data_set)
+
+
+def _record_query(data_set: 'data_set.DataSet', sql: str, parameters: [], seconds: float,
+                  explainable: bool = True):
+    endpoint = current_endpoint()
+    record('query', data_set.id, seconds, endpoint)
+
+    normalized_sql = normalize_sql(sql)
+    shape = hashlib.sha1(normalized_sql.encode()).hexdigest()[:12]
+    with _lock:
+        query_shape = _shapes.pop(shape, None) or QueryShape(shape, normalized_sql, data_set.id)
+        _shapes[shape] = query_shape
+        while len(_shapes) > config.profiling_max_query_shapes():
+            _shapes.popitem(last=False)
+        query_shape.endpoints.add(endpoint)
+        query_shape.count += 1
+        query_shape.total_seconds += seconds
+        query_shape.max_seconds = max(query_shape.max_seconds, seconds)
+        query_shape.last_seen_at = time.time()
+
+        # at most one plan per shape and hour
+        threshold = config.profiling_slow_query_threshold()
+        capture_plan = explainable and threshold and seconds >= threshold \
+                       and re.match(r'\s*SELECT', sql, re.IGNORECASE) \
+                       and (query_shape.plan_captured_at is None or time.time() - query_shape.plan_captured_at > 3600)
+        if capture_plan:
+            query_shape.plan_captured_at = time.time()
+
+    if capture_plan:
+        threading.Thread(target=_capture_plan, args=(data_set, query_shape, sql, parameters),
+                         name='capture-query-plan', daemon=True).start()
+
+
+def _capture_plan(data_set: 'data_set.DataSet', query_shape: QueryShape, sql: str, parameters: []):
+    """Runs a slow query again with `EXPLAIN (ANALYZE, BUFFERS)` (on a separate connection)"""
+    from . import governor
+
+    try:
+        with governor.cursor_context(data_set) as cursor:
+            cursor._cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+    except Exception as e:
+        plan = f'The plan could not be captured: {e}'
+    with _lock:
+        query_shape.plan = plan
+
+
+def normalize_sql(sql: str) -> str:
+    """Replaces the literals of a statement with `?` and collapses whitespace, so that queries that only differ
+    in their parameters have the same text"""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'(?<![\w"])-?\d+(?:\.\d+)?(?![\w"])', '?', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def latencies() -> [{}]:
+    """The percentiles of the recent durations by endpoint, data set and kind, the slowest (p90) first"""
+    with _lock:
+        result = [{'endpoint': endpoint, 'data_set_id': data_set_id, 'kind': kind,
+                   'count': timings.count, 'total_seconds': timings.total_seconds,
+                   'p50': timings.percentile(50), 'p90': timings.percentile(90), 'p99': timings.percentile(99),
+                   'max': max(timings.samples) if timings.samples else None}
+                  for (endpoint, data_set_id, kind), timings in _timings.items()]
+    return sorted(result, key=lambda row: row['p90'] or 0, reverse=True)
+
+
+def slowest_query_shapes(limit: int = 20) -> [QueryShape]:
+    """The query shapes with the highest total duration"""
+    with _lock:
+        shapes = list(_shapes.values())
+    return sorted(shapes, key=lambda shape: shape.total_seconds, reverse=True)[:limit]
+
+
+def reset():
+    """Removes all recorded timings and query shapes"""
+    with _lock:
+        _timings.clear()
+        _shapes.clear()
+
+
+def prometheus_metrics() -> str:
+    """The recorded timings and the metrics of the connection pools in the Prometheus text format"""
+    from . import pool
+
+    def labels(**values) -> str:
+        return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in values.items()) + '}'
+
+    lines = ['# HELP mara_data_explorer_duration_seconds Durations of queries, rendering and requests',
+             '# TYPE mara_data_explorer_duration_seconds summary']
+    for row in sorted(latencies(), key=lambda row: (row['endpoint'], row['data_set_id'] or '', row['kind'])):
+        key = dict(endpoint=row['endpoint'], data_set=row['data_set_id'] or '', kind=row['kind'])
+        for quantile, value in [('0.5', row['p50']), ('0.9', row['p90']), ('0.99', row['p99'])]:
+            lines.append(f'mara_data_explorer_duration_seconds{labels(**key, quantile=quantile)} {value}')
+        lines.append(f'mara_data_explorer_duration_seconds_sum{labels(**key)} {row["total_seconds"]}')
+        lines.append(f'mara_data_explorer_duration_seconds_count{labels(**key)} {row["count"]}')
+
+    for db_alias, metrics in sorted(pool.pool_metrics().items()):
+        for name, value in sorted(metrics.items()):
+            metric = 'mara_data_explorer_pool_' + re.sub(r'\W', '_', name)
+            lines.append(f'{metric}{labels(database_alias=db_alias)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -2,10 +2,16 @@
 
 import datetime
 import json
+import os
 import re
+import shlex
+import signal
 import subprocess
+import tempfile
+import time
 import math
 import decimal
+import logging
 
 import sqlalchemy
 from .data_set import find_data_set
@@ -13,8 +19,10 @@ from sqlalchemy.ext.declarative import declarative_base
 
 import mara_db.dbs
 import mara_db.shell
-import mara_db.postgresql
 from mara_page import acl
+from . import cache, config, governor, pool
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -93,23 +101,114 @@ class Query(Base):
         self.updated_at = updated_at
         self.updated_by = updated_by
 
-    def run(self, limit=None, offset=None, include_personal_data: bool = True):
+    def run(self, limit=None, offset=None, include_personal_data: bool = True,
+            stale_while_revalidate: bool = False):
         """
         Runs the query and returns the result
         Args:
             limit: How many rows to return at max
             offset: Which row to start with
             include_personal_data: When True, include columns that contain personal data
+            stale_while_revalidate: When True, an expired cached result is returned while it is recomputed
+                                    in the background (see `cache.cached_stale_while_revalidate`)
 
         Returns: An array of values
         """
         if not self.column_names:  # table probably does not exists or no columns are selected
             return []
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            cursor.execute(self.to_sql(limit=limit, offset=offset, include_personal_data=include_personal_data))
+        return (cache.cached_stale_while_revalidate if stale_while_revalidate else cache.cached)(
+            self.data_set,
+            self._cache_key('run', column_names=self.column_names,
+                            sort_column_name=self.sort_column_name, sort_order=self.sort_order,
+                            limit=limit, offset=offset, include_personal_data=include_personal_data),
+            lambda: self._run(limit=limit, offset=offset, include_personal_data=include_personal_data))
+
+    def _run(self, limit, offset, include_personal_data):
+        with governor.cursor_context(self.data_set) as cursor:
+            pool.execute(cursor, *self.to_parameterized_sql(limit=limit, offset=offset,
+                                                            include_personal_data=include_personal_data))
             return cursor.fetchall()
 
-    def to_sql(self, limit=None, offset=None, decimal_mark: str = '.', include_personal_data: bool = True):
+    def run_keyset_page(self, limit: int, after: [str] = None, include_personal_data: bool = True) -> ([], [str]):
+        """
+        Runs the query for a single page with keyset pagination: Instead of skipping rows with an offset,
+        the page starts after the sort key of the last row of the previous page, which makes each page equally
+        expensive regardless of its depth. Requires `keyset_column_names` to be not empty.
+
+        Args:
+            limit: How many rows to return at max
+            after: The sort key of the last row of the previous page, None for the first page
+            include_personal_data: When True, include columns that contain personal data
+
+        Returns: A tuple of the rows of the page and the sort key of its last row (None when there are no rows)
+        """
+        if not self.column_names:  # table probably does not exists or no columns are selected
+            return [], None
+        return cache.cached(self.data_set,
+                            self._cache_key('run_keyset_page', column_names=self.column_names,
+                                            sort_column_name=self.sort_column_name, sort_order=self.sort_order,
+                                            limit=limit, after=after, include_personal_data=include_personal_data),
+                            lambda: self._run_keyset_page(limit=limit, after=after,
+                                                          include_personal_data=include_personal_data))
+
+    def _run_keyset_page(self, limit, after, include_personal_data):
+        with governor.cursor_context(self.data_set) as cursor:
+            pool.execute(cursor, *self.to_parameterized_sql(limit=limit, include_personal_data=include_personal_data,
+                                                            keyset=True, after=after))
+            rows = cursor.fetchall()
+            number_of_columns = len(self.column_names)
+            # the sort key is appended to the selected columns
+            return ([row[:number_of_columns] for row in rows],
+                    [None if value is None else str(value) for value in rows[-1][number_of_columns:]] if rows else None)
+
+    def keyset_column_names(self, include_personal_data: bool = True) -> [str]:
+        """
+        The columns that uniquely sort the query for keyset pagination: the sort column (if any) plus the unique
+        columns of the data set. Empty when the data set has no unique columns or when the sort key would reveal
+        personal data.
+        """
+        column_names = []
+        if self.data_set.unique_column_names:
+            if self.sort_order and self.sort_column_name:
+                column_names.append(self.sort_column_name)
+            column_names += [column_name for column_name in self.data_set.unique_column_names
+                             if column_name not in column_names]
+        if not include_personal_data and set(column_names) & set(self.data_set.personal_data_column_names):
+            return []
+        return column_names
+
+    def to_sql(self, limit=None, offset=None, decimal_mark: str = '.', include_personal_data: bool = True,
+               keyset: bool = False, after: [str] = None, additional_conditions: [(str, [])] = None) -> str:
+        """
+        Renders the query as a self-contained SQL statement with all filter values inlined as literals,
+        e.g. for displaying it or for running it through psql. See `to_parameterized_sql` for the arguments.
+        """
+        sql, parameters = self.to_parameterized_sql(limit=limit, offset=offset, decimal_mark=decimal_mark,
+                                                    include_personal_data=include_personal_data,
+                                                    keyset=keyset, after=after,
+                                                    additional_conditions=additional_conditions)
+        return _render_sql(sql, parameters) if sql else None
+
+    def to_parameterized_sql(self, limit=None, offset=None, decimal_mark: str = '.',
+                             include_personal_data: bool = True,
+                             keyset: bool = False, after: [str] = None,
+                             additional_conditions: [(str, [])] = None) -> (str, []):
+        """
+        Renders the query as an SQL statement with `%s` placeholders for all filter values
+
+        Args:
+            limit: How many rows to return at max
+            offset: Which row to start with
+            decimal_mark: The decimal mark to use for numbers
+            include_personal_data: When True, include columns that contain personal data
+            keyset: When true, then the keyset columns are appended to the selected columns and the rows
+                    are sorted by them (see `run_keyset_page`)
+            after: For keyset pagination, the sort key of the last row of the previous page
+            additional_conditions: Further conditions besides the filters as tuples of SQL expressions and their
+                                   parameters (see `filters_to_sql`)
+
+        Returns: A tuple of the statement and its parameters, (None, []) when no columns are selected
+        """
         if self.column_names:
             columns = []
             for column_name in self.column_names:
@@ -120,238 +219,895 @@ class Query(Base):
                 else:
                     columns.append(f'"{column_name}"')
 
+            conditions = list(additional_conditions or [])
+            if keyset:
+                keyset_column_names = self.keyset_column_names()
+                columns += [f'"{column_name}" AS "__key_{i}"' for i, column_name in enumerate(keyset_column_names)]
+                if after is not None:
+                    conditions.append(self._keyset_condition(keyset_column_names, after))
+
+            where, parameters = self.filters_to_sql(additional_conditions=conditions)
             sql = f"""
 SELECT """ + ',\n       '.join(columns) + f"""
 FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
-""" + self.filters_to_sql()
-            if self.sort_order and self.sort_column_name:
+""" + where
+            if keyset:
+                sql += '\nORDER BY ' + ', '.join(
+                    f'"{column_name}" {self.sort_order if self.sort_order and self.sort_column_name else "ASC"} NULLS LAST'
+                    for column_name in keyset_column_names) + '\n'
+            elif self.sort_order and self.sort_column_name:
                 sql += f'\nORDER BY "{self.sort_column_name}" {self.sort_order} NULLS LAST\n';
 
+            # bound as parameters, so that all pages share a prepared statement
             if limit is not None:
-                sql += f'\nLIMIT {int(limit)}\n'
+                sql += '\nLIMIT %s::BIGINT\n'
+                parameters.append(int(limit))
             if offset is not None:
-                sql += f'\nOFFSET {int(offset)}\n'
+                sql += '\nOFFSET %s::BIGINT\n'
+                parameters.append(int(offset))
 
-            return sql
+            return sql, parameters
         else:
-            return None
+            return None, []
+
+    def _keyset_condition(self, keyset_column_names: [str], after: [str]) -> (str, []):
+        """Renders a condition for the rows that come after the sort key `after` in keyset order"""
+        operator = '<' if self.sort_order == 'DESC' and self.sort_column_name else '>'
 
-    def filters_to_sql(self) -> str:
-        """Renders a SQL WHERE condition for the query"""
-        if self.filters:
-            return 'WHERE ' + '\n  AND '.join([self.filter_to_sql(filter) for filter in self.filters]) + '\n'
+        def row(column_names):
+            return ('(' + ', '.join(f'"{column_name}"' for column_name in column_names) + f') {operator} ('
+                    + ', '.join(['%s'] * len(column_names)) + ')')
+
+        if self.sort_order and self.sort_column_name:
+            # the sort column can contain NULLs, which come last
+            if after[0] is None:
+                return (f'("{keyset_column_names[0]}" IS NULL AND '
+                        + (row(keyset_column_names[1:]) if len(keyset_column_names) > 1 else 'FALSE') + ')',
+                        list(after[1:]))
+            else:
+                return f'({row(keyset_column_names)} OR "{keyset_column_names[0]}" IS NULL)', list(after)
         else:
-            return ''
+            return row(keyset_column_names), list(after)
+
+    def filters_to_sql(self, filters: [Filter] = None, additional_conditions: [(str, [])] = None) -> (str, []):
+        """
+        Renders a SQL WHERE condition for the query
+
+        Args:
+            filters: The filters to render, all filters of the query when None
+            additional_conditions: Further conditions as tuples of SQL expressions and their parameters
 
-    def filter_to_sql(self, filter: Filter):
-        """Renders a filter to a part of an SQL WHERE expression"""
+        Returns: A tuple of the WHERE clause with `%s` placeholders (empty when there are no conditions)
+                 and its parameters
+        """
+        conditions = [self.filter_to_sql(filter) for filter in (self.filters if filters is None else filters)]
+        conditions += additional_conditions or []
+        if conditions:
+            return ('WHERE ' + '\n  AND '.join(sql for sql, _ in conditions) + '\n',
+                    [parameter for _, parameters in conditions for parameter in parameters])
+        else:
+            return '', []
+
+    def filter_to_sql(self, filter: Filter) -> (str, []):
+        """Renders a filter to a part of an SQL WHERE expression with `%s` placeholders and its parameters"""
         type = self.data_set.columns[filter.column_name].type
         if type == 'text':
             if filter.operator == '~':
-                return f'"{filter.column_name}" ILIKE ANY(ARRAY[' \
-                       + ', '.join(f"'%{value}%'" for value in filter.value or ['']) + ']::TEXT[])'
+                return (f'"{filter.column_name}" ILIKE ANY(%s::TEXT[])',
+                        [[f'%{value}%' for value in filter.value or ['']]])
+            elif filter.operator == '=':
+                return f'"{filter.column_name}" = ANY(%s::TEXT[])', [list(filter.value or [''])]
             else:
-                return f'''"{filter.column_name}" {'IN' if filter.operator == '=' else 'NOT IN'} (''' \
-                       + ', '.join(f"'{value}'" for value in filter.value or ['']) + ')'
+                return f'"{filter.column_name}" <> ALL(%s::TEXT[])', [list(filter.value or [''])]
         elif type == 'text[]':
-            clause = f'''"{filter.column_name}" && ARRAY[''' \
-                     + ', '.join(f"'{value}'" for value in filter.value or ['']) + ']::TEXT[]'
+            clause = f'"{filter.column_name}" && %s::TEXT[]'
             if filter.operator == '!=':
-                clause = ' not (' + clause + ')'
-            return clause
-        elif type == 'number':
-            return f'''"{filter.column_name}" {filter.operator} {filter.value}'''
-        elif type == 'date':
-            return f'''"{filter.column_name}"::Date {filter.operator} '{filter.value}' '''
+                clause = 'NOT (' + clause + ')'
+            return clause, [list(filter.value or [''])]
+        elif type in ['number', 'date']:
+            if filter.operator not in _comparison_operators:
+                raise ValueError(f'Unsupported operator "{filter.operator}" for {type} column "{filter.column_name}"')
+            if type == 'number':
+                try:
+                    value = decimal.Decimal(str(filter.value))
+                except decimal.InvalidOperation:
+                    value = None
+                # signaling NaNs can not be compared
+                if value is None or value.is_snan():
+                    raise ValueError(f'Invalid number "{filter.value}" in filter on "{filter.column_name}"')
+                # explicitly typed, as prepared statements would otherwise round the value to the column type.
+                # Integral values are compared as BIGINT, so that indexes on integer columns can be used
+                if value == value.to_integral_value() and -2 ** 63 <= value < 2 ** 63:
+                    return f'"{filter.column_name}" {filter.operator} %s::BIGINT', [int(value)]
+                return f'"{filter.column_name}" {filter.operator} %s::NUMERIC', [value]
+            else:
+                return f'"{filter.column_name}"::Date {filter.operator} %s::DATE', [str(filter.value)]
         else:
-            return '1=1'
+            return '1=1', []
 
-    def row_count(self):
-        """Compute how many rows will be returned by the current set of filters"""
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            cursor.execute(f'SELECT count(*) FROM "{self.data_set.database_schema}"."{self.data_set.database_table}" '
-                           + self.filters_to_sql())
-            return cursor.fetchone()[0]
+    def row_count(self, estimate: bool = False):
+        """
+        Compute how many rows will be returned by the current set of filters
+
+        Args:
+            estimate: When true, then the number of rows is estimated by the query planner instead of counted
+                      (unless it can be counted exactly from the rollup table of the data set)
+        """
+        if not self.filters:
+            return self.data_set.row_count(estimate=estimate)
+        if estimate and not self._rollup_covers(self.filters):
+            return self._estimated_row_count(self.filters)
+        return cache.cached(self.data_set, self._cache_key('row_count'), self._row_count)
+
+    def _row_count(self):
+        return self._count_rows(self.filters)
+
+    def row_count_is_estimate(self, estimate: bool) -> bool:
+        """Whether `row_count` with `estimate` returns an estimate (and not an exact count from the rollup table)"""
+        return estimate and (not self.filters or not self._rollup_covers(self.filters))
 
-    def filter_row_count(self, filter_pos):
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            cursor.execute(
-                f'SELECT count(*) FROM "{self.data_set.database_schema}"."{self.data_set.database_table}" WHERE '
-                + self.filter_to_sql(self.filters[filter_pos]))
+    def filter_row_count(self, filter_pos, estimate: bool = False):
+        """
+        Compute how many rows match a single filter of the query
+
+        Args:
+            filter_pos: The position of the filter
+            estimate: When true, then the number of rows is estimated by the query planner instead of counted
+                      (unless it can be counted exactly from the rollup table of the data set)
+        """
+        filter = self.filters[filter_pos]
+        if estimate and not self._rollup_covers([filter]):
+            return self._estimated_row_count([filter])
+        return cache.cached(self.data_set, self._cache_key('filter_row_count', filters=[filter]),
+                            lambda: self._filter_row_count(filter))
+
+    def _filter_row_count(self, filter: Filter):
+        return self._count_rows([filter])
+
+    def filter_row_count_is_estimate(self, filter_pos, estimate: bool) -> bool:
+        """Whether `filter_row_count` with `estimate` returns an estimate (see `row_count_is_estimate`)"""
+        return estimate and not self._rollup_covers([self.filters[filter_pos]])
+
+    def _count_rows(self, filters: [Filter]) -> int:
+        """Counts the rows matching a list of filters, in the rollup table of the data set when it covers them"""
+        from . import rollup
+
+        if self._rollup_covers(filters):
+            table = rollup.table_name(self.data_set)
+            count = f'coalesce(sum("{rollup.COUNT_COLUMN_NAME}"), 0) :: BIGINT'
+        else:
+            table = f'"{self.data_set.database_schema}"."{self.data_set.database_table}"'
+            count = 'count(*)'
+
+        with governor.cursor_context(self.data_set) as cursor:
+            where, parameters = self.filters_to_sql(filters)
+            pool.execute(cursor, f'SELECT {count} FROM {table} ' + where, parameters)
             return cursor.fetchone()[0]
 
-    def as_csv(self, delimiter, decimal_mark, include_personal_data):
-        query = self.to_sql(decimal_mark=decimal_mark, include_personal_data=include_personal_data).replace('"', '\\"')
+    def _rollup_covers(self, filters: [Filter], column_names: [str] = None) -> bool:
+        """Whether the rollup table of the data set can answer queries with these filters (and columns)"""
+        from . import rollup
+
+        return rollup.covers(self.data_set, [filter.column_name for filter in filters] + (column_names or []))
+
+    def _estimated_row_count(self, filters: [Filter]) -> int:
+        """Estimates the number of rows matching a list of filters from the query plan"""
+        if not filters:
+            return self.data_set.row_count(estimate=True)
+
+        def estimate():
+            with governor.cursor_context(self.data_set) as cursor:
+                where, parameters = self.filters_to_sql(filters)
+                cursor.execute(
+                    f'EXPLAIN (FORMAT JSON) SELECT 1 FROM "{self.data_set.database_schema}"."{self.data_set.database_table}" '
+                    + where, parameters)
+                return int(cursor.fetchone()[0][0]['Plan']['Plan Rows'])
+
+        return cache.cached(self.data_set, self._cache_key('estimated_row_count', filters=filters), estimate)
+
+    def as_csv(self, delimiter, decimal_mark, include_personal_data, chunk_size: int = 64 * 1024):
+        """
+        Streams the result of the query as csv
+
+        The output of `COPY ... TO STDOUT` is read from a piped psql process in chunks, so that memory
+        stays flat no matter how big the result is. A chunk is only read when the previous one has been
+        consumed (backpressure). When the generator is closed before it is exhausted (e.g. because the
+        client disconnected), then the psql process is killed.
+
+        Args:
+            delimiter: The field delimiter
+            decimal_mark: The decimal mark to use for numbers
+            include_personal_data: When True, include columns that contain personal data
+            chunk_size: How many bytes to read at once
+
+        Returns: A generator of csv chunks (bytes)
+        """
+        query = self.to_sql(decimal_mark=decimal_mark, include_personal_data=include_personal_data)
         command = mara_db.shell.query_command(self.data_set.database_alias, echo_queries=False) \
-                  + f''' --command="COPY ({query}) TO STDOUT WITH DELIMITER E'{delimiter}' CSV HEADER;"'''
+                  + ' --command=' + shlex.quote(f"COPY ({query}) TO STDOUT WITH DELIMITER E'{delimiter}' CSV HEADER;")
+
+        # run in a separate process group so that the shell and psql can be killed together
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+        try:
+            while True:
+                chunk = process.stdout.read1(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=process.stderr.read())
+        finally:
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+    def as_partitioned_csv(self, delimiter, decimal_mark, include_personal_data, parallelism: int = None,
+                           chunk_size: int = 64 * 1024, user: str = None):
+        """
+        Like `as_csv`, but the result is exported by several `COPY` statements that run concurrently
+
+        The result is split into ranges of the `partition_column_name` of the data set, and each range is
+        exported by a separate psql process (with its own connection), at most `parallelism` at the same time.
+        All of them read from the same snapshot of the database, which is exported with `pg_export_snapshot()`
+        from a transaction that stays open until the export is finished. The ranges are spooled to temporary
+        files in `config.export_directory()` and streamed in order, so that the result is a single csv file
+        with one header, ordered by the partition column (and within ranges by the sort column of the query).
+
+        The ranges run with the statement timeout of the data set and the application name of the current
+        `governor.superseding` context (see `governor.transaction_settings`). The first running range counts
+        against the concurrency slot of the caller, each further one needs a slot of its own (see
+        `governor.concurrency_slot`), and is only started when one is free.
+
+        Falls back to `as_csv` when the data set has no partition column (or one that is not a number, date or
+        timestamp column), when the query is sorted by another column or when `parallelism` is 1.
+
+        Args:
+            delimiter: The field delimiter
+            decimal_mark: The decimal mark to use for numbers
+            include_personal_data: When True, include columns that contain personal data
+            parallelism: How many ranges are exported at the same time, `config.export_parallelism()` when None
+            chunk_size: How many bytes to read at once
+            user: The user whose concurrency limits the ranges count against, None for not counting them
+
+        Returns: A generator of csv chunks (bytes)
+        """
+        parallelism = parallelism or config.export_parallelism()
+        partition_column_name = self.data_set.partition_column_name
+        # only ranges of numbers, dates and timestamps can be computed
+        partition_column = self.data_set.columns.get(partition_column_name) if partition_column_name else None
+        if not partition_column or partition_column.type not in ['number', 'date'] \
+                or partition_column.database_type in _time_types \
+                or parallelism <= 1 or not self.column_names \
+                or (self.sort_order and self.sort_column_name and self.sort_column_name != partition_column_name):
+            yield from self.as_csv(delimiter, decimal_mark, include_personal_data, chunk_size)
+            return
+
+        with pool.cursor_context(self.data_set.database_alias) as cursor:
+            # all partitions are exported from the snapshot of this transaction
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+            cursor.execute('SELECT pg_export_snapshot()')
+            snapshot_id = cursor.fetchone()[0]
+            for statement in governor.transaction_settings(self.data_set):
+                cursor.execute(statement)
+
+            where, parameters = self.filters_to_sql()
+            cursor.execute(f"""
+SELECT min("{partition_column_name}"), max("{partition_column_name}")
+FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
+{where}""", parameters)
+            lower, upper = cursor.fetchone()
+
+            # more ranges than connections, so that skewed ranges don't leave connections idle
+            conditions = _partition_conditions(partition_column_name, lower, upper, parallelism * 4)
+            if self.sort_order == 'DESC' and self.sort_column_name:
+                # rows with NULL values come last in both sort orders
+                conditions = conditions[:-1][::-1] + conditions[-1:]
+
+            commands = []
+            for pos, condition in enumerate(conditions):
+                sql = self.to_sql(decimal_mark=decimal_mark, include_personal_data=include_personal_data,
+                                  additional_conditions=[condition])
+                statements = ['BEGIN ISOLATION LEVEL REPEATABLE READ, READ ONLY;',
+                              f"SET TRANSACTION SNAPSHOT '{snapshot_id}';",
+                              *governor.transaction_settings(self.data_set),
+                              f"COPY ({sql}) TO STDOUT WITH DELIMITER E'{delimiter}' CSV"
+                              + (' HEADER;' if pos == 0 else ';'),
+                              'COMMIT;']
+                # only the header of the first range is written, --quiet omits the tags of the other statements
+                commands.append(mara_db.shell.query_command(self.data_set.database_alias, echo_queries=False)
+                                + ' --quiet' + ''.join(' --command=' + shlex.quote(statement)
+                                                       for statement in statements))
 
-        return subprocess.check_output(command, shell=True)
+            os.makedirs(config.export_directory(), exist_ok=True)
+            processes, files = [], []
+            slots = {}  # position of a range -> its concurrency slot
+
+            def start_processes():
+                """Starts the next ranges while less than `parallelism` psql processes are running"""
+                for pos in [pos for pos in slots if processes[pos].poll() is not None]:
+                    slots.pop(pos).__exit__(None, None, None)
+                while len(processes) < len(commands):
+                    running = len([process for process in processes if process.poll() is None])
+                    if running >= parallelism:
+                        break
+                    if user is not None and running > len(slots):
+                        # the slot of the caller is taken
+                        slot = governor.concurrency_slot(user, timeout=0)
+                        try:
+                            slot.__enter__()
+                        except governor.QueueTimeout:
+                            break
+                        slots[len(processes)] = slot
+                    file = tempfile.TemporaryFile(dir=config.export_directory(), prefix='partition-')
+                    files.append(file)
+                    # run in a separate process group so that the shell and psql can be killed together
+                    processes.append(subprocess.Popen(commands[len(processes)], shell=True, stdout=file,
+                                                      stderr=subprocess.PIPE, start_new_session=True))
+
+            try:
+                for pos, command in enumerate(commands):
+                    start_processes()
+                    while processes[pos].poll() is None:
+                        time.sleep(0.05)
+                        start_processes()
+                    if processes[pos].returncode != 0:
+                        raise subprocess.CalledProcessError(processes[pos].returncode, command,
+                                                            stderr=processes[pos].stderr.read())
+
+                    files[pos].seek(0)
+                    while True:
+                        chunk = files[pos].read(chunk_size)
+                        if not chunk:
+                            break
+                        yield chunk
+                        start_processes()
+                    files[pos].close()
+            finally:
+                for process in processes:
+                    if process.poll() is None:
+                        os.killpg(process.pid, signal.SIGKILL)
+                        process.wait()
+                    process.stderr.close()
+                for file in files:
+                    file.close()
+                for slot in slots.values():
+                    slot.__exit__(None, None, None)
 
     def as_rows_for_google_sheet(self, array_format, header: bool = True, limit=None,
-                                 include_personal_data: bool = True):
+                                 include_personal_data: bool = True, batch_size: int = 10000):
         """
         Runs the query and returns the result as Google sheet's data input (list of lists)
+
+        The rows are streamed from a server-side cursor in batches of `batch_size` rows, and the values of each
+        batch are converted column by column. So only a single batch is kept in memory, and the first rows can
+        be uploaded before the query has finished.
+
         Args:
             header: When True, include a header row with the column names
             limit: How many rows to return at max
-            offset: Which row to start with
             include_personal_data: When True, include columns that contain personal data
             array_format: Array to string format for array types
+            batch_size: How many rows to fetch from the database at once
 
-        Returns: Google sheet's data input as list of lists
+        Returns: A generator of rows (lists of values)
         """
         if not self.column_names:  # table probably does not exists or no columns are selected
             return []
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            cursor.execute(self.to_sql(limit=limit, include_personal_data=include_personal_data))
-            result = cursor.fetchall()
-            if header is True:
-                column_names = [desc[0] for desc in cursor.description]
-                yield column_names
-            for row in result:
-                row_list = []
-                for value in list(row):
-                    if isinstance(value, str):
-                        list_value_str = value.replace('\t', ' - ')
-                        # no more than 50k characters for a single cell value (Google API limit reference)
-                        row_list.append((list_value_str[:48995] + ' ... ') if len(list_value_str) > 50000 else value)
-                    elif isinstance(value, list):
-                        list_value_str = str(value).replace('\t', ' - ') if len(value) > 0 else ''
-                        # Adjust array format
-                        if array_format == 'curly':
-                            list_value_str = ('{' + list_value_str[1:-1] + '}').replace('{}', '')
-                        elif array_format == 'tuple':
-                            list_value_str = str(tuple(value)).replace('\t', ' - ') if len(value) > 0 else ''
-
-                        row_list.append(
-                            (list_value_str[:48995] + ' ... ') if len(list_value_str) > 50000 else list_value_str)
-                    elif isinstance(value, datetime.datetime):
-                        row_list.append(str(value.strftime("%d-%m-%Y")))
-                    else:
-                        row_list.append(value)
-                yield row_list
 
-    def number_distribution(self, column_name):
-        """Returns a frequency histogram for a number column"""
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            cursor.execute(f"""
+        # number columns don't need to be converted (unless they are replaced by a lock)
+        needs_conversion = [self.data_set.columns[column_name].type != 'number'
+                            or (not include_personal_data
+                                and column_name in self.data_set.personal_data_column_names)
+                            for column_name in self.column_names]
+
+        with governor.cursor_context(self.data_set) as cursor:
+            with cursor.connection.cursor(name='google_sheet_export') as server_side_cursor:
+                server_side_cursor.itersize = batch_size
+                server_side_cursor.execute(*self.to_parameterized_sql(limit=limit,
+                                                                      include_personal_data=include_personal_data))
+                first_batch = True
+                while True:
+                    rows = server_side_cursor.fetchmany(batch_size)
+                    if first_batch and header is True:
+                        # the description of a server-side cursor is only available after the first fetch
+                        yield [desc[0] for desc in server_side_cursor.description]
+                    first_batch = False
+                    if not rows:
+                        break
+
+                    columns = [[_google_sheet_value(value, array_format) for value in column]
+                               if convert else column
+                               for column, convert in zip(zip(*rows), needs_conversion)]
+                    for row in zip(*columns):
+                        yield list(row)
+
+    def distribution_sample_percent(self, column_name: str = None) -> float:
+        """
+        The percentage of table rows that distribution charts are computed from, according to the sampling
+        settings of the data set. None when distributions should be computed exactly, e.g. for small tables.
+
+        Args:
+            column_name: When set, then None is also returned when the distribution of this column can be
+                         computed exactly from the rollup table of the data set
+        """
+        from . import statistics
+
+        if not (self.data_set.distribution_sample_percent or self.data_set.distribution_sample_row_count):
+            return None
+
+        if column_name and self.data_set.columns[column_name].type in ['text', 'date'] \
+                and self._rollup_covers(self.filters, [column_name]):
+            return None
+
+        # unfiltered distributions are taken from the statistics catalog
+        if not self.filters and statistics.load(self.data_set):
+            return None
+
+        row_count = self.data_set.row_count(estimate=True)
+        if not row_count or row_count < config.distribution_sampling_min_row_count():
+            return None
+
+        if self.data_set.distribution_sample_row_count:
+            sample_percent = 100.0 * self.data_set.distribution_sample_row_count / row_count
+        else:
+            sample_percent = self.data_set.distribution_sample_percent
+
+        # rounded, so that slightly changing table statistics don't invalidate cached results
+        sample_percent = float(f'{sample_percent:.2g}')
+        return sample_percent if sample_percent < 100 else None
+
+    def _from_sql(self, sample_percent: float = None) -> str:
+        """The table of the data set, with a `TABLESAMPLE` clause when `sample_percent` is set"""
+        table = f'"{self.data_set.database_schema}"."{self.data_set.database_table}"'
+        if sample_percent:
+            # a fixed seed, so that all queries of a computation see the same sample
+            table += f' TABLESAMPLE {self.data_set.distribution_sample_method} ({sample_percent}) REPEATABLE (0)'
+        return table
+
+    def _distribution(self, column_name, sample_percent, compute: callable):
+        """
+        The distribution of a column from the statistics catalog when the query has no filters,
+        otherwise the cached result of `compute(column_name, sample_percent)`
+        """
+        from . import statistics
+
+        if not self.filters:
+            column_statistics = statistics.load(self.data_set).get(column_name)
+            if column_statistics and column_statistics.distribution is not None:
+                return column_statistics.to_distribution()
+        return cache.cached(self.data_set,
+                            self._cache_key('distribution', column_name=column_name, sample_percent=sample_percent),
+                            lambda: compute(column_name, sample_percent))
+
+    def number_distribution(self, column_name, sample_percent: float = None):
+        """Returns a frequency histogram for a number column, computed from a sample of the table when
+        `sample_percent` is set (see `distribution_sample_percent`)"""
+        return self._distribution(column_name, sample_percent, self._number_distribution)
+
+    def _number_distribution(self, column_name, sample_percent):
+        from . import statistics
+
+        where, parameters = self.filters_to_sql(additional_conditions=[(f'"{column_name}" IS NOT NULL', [])])
+
+        # with precomputed statistics, the bucket width can be chosen without probing the range of values first
+        column_statistics = statistics.load(self.data_set).get(column_name)
+        buckets = None
+        if column_statistics and column_statistics.min_value is not None \
+                and column_statistics.min_value != column_statistics.max_value:
+            buckets = _number_buckets(column_statistics.typed_min_value, column_statistics.typed_max_value)
+
+        with governor.cursor_context(self.data_set) as cursor:
+            if not buckets:
+                pool.execute(cursor, f"""
 SELECT min("{column_name}") :: NUMERIC AS min_value,
        max("{column_name}") :: NUMERIC AS max_value,
        count(*)                        AS number_of_values
-FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
-WHERE "{column_name}" IS NOT NULL
-      {('AND ' + ' AND '.join([self.filter_to_sql(filter) for filter in self.filters])) if self.filters else ''}
-""")
-            (min_value, max_value, number_of_values) = cursor.fetchone()
-            if min_value == None:
-                return []
-
-            min_buckets = 5
+FROM {self._from_sql(sample_percent)}
+{where}""", parameters)
+                (min_value, max_value, number_of_values) = cursor.fetchone()
+                if min_value == None:
+                    return []
 
-            # find the highest magnitude of 10
-            exponent = math.ceil(max(abs(min_value).log10(), abs(max_value).log10()))
+                # when there is only a single value
+                if min_value == max_value:
+                    return ([(float(min_value), float(max_value),
+                              float(_scale_count(number_of_values, sample_percent)))])
 
-            # when there is only a single value
-            if min_value == max_value:
-                return ([(float(min_value), float(max_value), float(number_of_values))])
+                buckets = _number_buckets(min_value, max_value)
 
             while True:
-                _10 = decimal.Decimal(10)
-
-                # truncate to the next lower magnitude of 10
-                min_ = math.floor(min_value / pow(_10, exponent))
-                max_ = math.ceil(max_value / pow(_10, exponent))
+                min_, max_, width = buckets
 
-                if (max_ - min_) > min_buckets:
-                    # compute buckets (tuples of min and max values)
-                    cursor.execute(f"""
-SELECT width_bucket("{column_name}", {min_ * pow(_10, exponent)}, {max_ * pow(_10, exponent)}, {max_ - min_}) as bucket,
-      count(*) AS n
-FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
-WHERE "{column_name}" IS NOT NULL
-      {('AND ' + ' AND '.join([self.filter_to_sql(filter) for filter in self.filters])) if self.filters else ''}
-GROUP by bucket
+                # compute buckets (tuples of min and max values) together with the range of all filtered values
+                pool.execute(cursor, f"""
+SELECT bucket, n, min(min_value) OVER (), max(max_value) OVER (), sum(n) OVER ()
+FROM (SELECT width_bucket("{column_name}", %s::NUMERIC, %s::NUMERIC, %s::INTEGER) AS bucket,
+             count(*) AS n,
+             min("{column_name}") :: NUMERIC AS min_value,
+             max("{column_name}") :: NUMERIC AS max_value
+      FROM {self._from_sql(sample_percent)}
+      {where}      GROUP BY 1) t
 ORDER BY bucket
-""")
-                    return ([(float((min_ + bucket - 1) * pow(_10, exponent)),
-                              float((min_ + bucket) * pow(_10, exponent)),
-                              n) for bucket, n in cursor.fetchall()])
-                else:
-                    exponent += -1
+""", [min_ * width, max_ * width, max_ - min_] + parameters)
+                rows = cursor.fetchall()
+                if not rows:
+                    return []
 
-    def date_distribution(self, column_name):
-        """Returns a frequency histogram for a date column"""
+                (_, _, min_value, max_value, number_of_values) = rows[0]
+                if min_value == max_value:
+                    return ([(float(min_value), float(max_value),
+                              float(_scale_count(number_of_values, sample_percent)))])
 
-        import arrow
+                # the filters can narrow down the range of values
+                actual_buckets = _number_buckets(min_value, max_value)
+                if actual_buckets == buckets:
+                    return ([(float((min_ + bucket - 1) * width),
+                              float((min_ + bucket) * width),
+                              _scale_count(n, sample_percent)) for bucket, n, _, _, _ in rows])
+                buckets = actual_buckets
 
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-                cursor.execute(f"""
+    def date_distribution(self, column_name, sample_percent: float = None):
+        """Returns a frequency histogram for a date column, computed from a sample of the table when
+        `sample_percent` is set (see `distribution_sample_percent`)"""
+        return self._distribution(column_name, sample_percent, self._date_distribution)
+
+    def _date_distribution(self, column_name, sample_percent):
+        distribution = self._rollup_distribution(column_name)
+        if distribution is not None:
+            return distribution
+
+        where, parameters = self.filters_to_sql(additional_conditions=[(f'"{column_name}" IS NOT NULL', [])])
+
+        # guess the resolution from the table statistics, so that in most cases a single scan is needed
+        estimated_range = self._estimated_date_range(column_name)
+        resolution = _date_resolution(*estimated_range) if estimated_range else None
+
+        with governor.cursor_context(self.data_set) as cursor:
+            if not resolution:
+                pool.execute(cursor, f"""
 SELECT min("{column_name}") :: TIMESTAMPTZ AS min_value,
        max("{column_name}") :: TIMESTAMPTZ AS max_value
-FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
-WHERE "{column_name}" IS NOT NULL
-      {('AND ' + ' AND '.join([self.filter_to_sql(filter) for filter in self.filters])) if self.filters else ''}
-""")
+FROM {self._from_sql(sample_percent)}
+{where}""", parameters)
                 (min_value, max_value) = cursor.fetchone()
                 if min_value == None:
                     return []
+                resolution = _date_resolution(min_value, max_value)
 
-                resolutions = {'year': 'YYYY',
-                               'month': 'YYYY Mon',
-                               'week': 'IYYY "-" "CW "IW',
-                               'day': 'Dy, Mon DD YYYY'}
+            while True:
+                # compute the buckets together with the min and max of all filtered values
+                pool.execute(cursor, f"""
+SELECT d, to_char(d, '{_date_resolutions[resolution]}'), n,
+       min(min_value) OVER (), max(max_value) OVER ()
+FROM (SELECT date_trunc('{resolution}', "{column_name}") AS d,
+             count(*) AS n,
+             min("{column_name}") :: TIMESTAMPTZ AS min_value,
+             max("{column_name}") :: TIMESTAMPTZ AS max_value
+      FROM {self._from_sql(sample_percent)}
+      {where}      GROUP BY 1) t
+ORDER BY d
+""", parameters)
+                rows = cursor.fetchall()
+                if not rows:
+                    return []
 
-                min_buckets = 5
+                # the statistics can be outdated or the filters can narrow down the range
+                actual_resolution = _date_resolution(rows[0][3], rows[0][4])
+                if actual_resolution == resolution:
+                    return [(d, label, _scale_count(n, sample_percent)) for d, label, n, _, _ in rows]
+                resolution = actual_resolution
 
-                for resolution in resolutions.keys():
-                    if len(list(arrow.Arrow.range(resolution, min_value, max_value))) >= min_buckets:
-                        break
+    def _estimated_date_range(self, column_name) -> (datetime.datetime, datetime.datetime):
+        """
+        The min and max of a date column according to the statistics catalog or the table statistics
+        (`pg_stats`), None when the table has not been analyzed yet
+        """
+        from . import statistics
+
+        column_statistics = statistics.load(self.data_set).get(column_name)
+        if column_statistics and column_statistics.min_value is not None:
+            return column_statistics.typed_min_value, column_statistics.typed_max_value
 
-                # compute buckets (tuples of min and max values)
+        try:
+            with governor.cursor_context(self.data_set) as cursor:
                 cursor.execute(f"""
-SELECT date_trunc('{resolution}', "{column_name}") as d,
-       to_char(date_trunc('{resolution}', "{column_name}"), '{resolutions[resolution]}'),
-       count(*) AS n
-FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
-WHERE "{column_name}" IS NOT NULL
-      {('AND ' + ' AND '.join([self.filter_to_sql(filter) for filter in self.filters])) if self.filters else ''}
-GROUP by d
-ORDER BY d
-""")
-                return cursor.fetchall()
+SELECT min(value), max(value)
+FROM pg_stats, unnest(coalesce(histogram_bounds, most_common_vals) :: TEXT :: TIMESTAMPTZ[]) value
+WHERE schemaname = {'%s'} AND tablename = {'%s'} AND attname = {'%s'}""",
+                               (self.data_set.database_schema, self.data_set.database_table, column_name))
+                (min_value, max_value) = cursor.fetchone()
+        except Exception:
+            # e.g. for time columns, which can not be cast to timestamps
+            return None
+        return (min_value, max_value) if min_value is not None else None
 
-    def text_distribution(self, column_name):
-        """Returns the most frequent values and their counts for a column"""
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            cursor.execute(f'''
+    def text_distribution(self, column_name, sample_percent: float = None):
+        """Returns the most frequent values and their counts for a column, computed from a sample of the table when
+        `sample_percent` is set (see `distribution_sample_percent`)"""
+        return self._distribution(column_name, sample_percent, self._text_distribution)
+
+    def _text_distribution(self, column_name, sample_percent):
+        distribution = self._rollup_distribution(column_name)
+        if distribution is not None:
+            return distribution
+
+        where, parameters = self.filters_to_sql(additional_conditions=[(f'"{column_name}" IS NOT NULL', [])])
+        with governor.cursor_context(self.data_set) as cursor:
+            pool.execute(cursor, f'''
 SELECT "{column_name}" AS value,
        count(*) AS n
-FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
-WHERE "{column_name}" IS NOT NULL 
-      {('AND ' + ' AND '.join([self.filter_to_sql(filter) for filter in self.filters])) if self.filters else ''}
-GROUP BY value
+FROM {self._from_sql(sample_percent)}
+{where}GROUP BY value
 ORDER BY n DESC
-LIMIT 10''')
-            return cursor.fetchall()
+LIMIT 10''', parameters)
+            return [(value, _scale_count(n, sample_percent)) for value, n in cursor.fetchall()]
 
-    def text_array_distribution(self, column_name):
-        """Returns the most frequent values and their counts for a text array column"""
-        with mara_db.postgresql.postgres_cursor_context(self.data_set.database_alias) as cursor:
-            cursor.execute(f'''
+    def text_array_distribution(self, column_name, sample_percent: float = None):
+        """Returns the most frequent values and their counts for a text array column, computed from a sample of
+        the table when `sample_percent` is set (see `distribution_sample_percent`)"""
+        return self._distribution(column_name, sample_percent, self._text_array_distribution)
+
+    def _text_array_distribution(self, column_name, sample_percent):
+        where, parameters = self.filters_to_sql(additional_conditions=[(f'"{column_name}" IS NOT NULL', [])])
+        with governor.cursor_context(self.data_set) as cursor:
+            pool.execute(cursor, f'''
 SELECT unnest("{column_name}") AS value,
        count(*) AS n
-FROM "{self.data_set.database_schema}"."{self.data_set.database_table}"
-WHERE "{column_name}" IS NOT NULL 
-      {('AND ' + ' AND '.join([self.filter_to_sql(filter) for filter in self.filters])) if self.filters else ''}
-GROUP BY value
+FROM {self._from_sql(sample_percent)}
+{where}GROUP BY value
+ORDER BY n DESC
+LIMIT 10''', parameters)
+            return [(value, _scale_count(n, sample_percent)) for value, n in cursor.fetchall()]
+
+    def _rollup_distribution(self, column_name) -> []:
+        """
+        The (exact) distribution of a text or date column from the rollup table of the data set. None when the
+        rollup table does not cover the filters and the column, or when the dates are too close to each other
+        for the daily granularity of the rollup table.
+        """
+        from . import rollup
+
+        type = self.data_set.columns[column_name].type
+        if type not in ['text', 'date'] or not self._rollup_covers(self.filters, [column_name]):
+            return None
+
+        table, count = rollup.table_name(self.data_set), f'sum("{rollup.COUNT_COLUMN_NAME}") :: BIGINT'
+        where, parameters = self.filters_to_sql(additional_conditions=[(f'"{column_name}" IS NOT NULL', [])])
+        with governor.cursor_context(self.data_set) as cursor:
+            if type == 'text':
+                pool.execute(cursor, f'''
+SELECT "{column_name}" AS value,
+       {count} AS n
+FROM {table}
+{where}GROUP BY value
 ORDER BY n DESC
-LIMIT 10''')
+LIMIT 10''', parameters)
+                return [(value, n) for value, n in cursor.fetchall()]
+
+            pool.execute(cursor, f"""
+SELECT min("{rollup.min_column_name(column_name)}") :: TIMESTAMPTZ,
+       max("{rollup.max_column_name(column_name)}") :: TIMESTAMPTZ
+FROM {table}
+{where}""", parameters)
+            (min_value, max_value) = cursor.fetchone()
+            if min_value is None:
+                return []
+            resolution = _date_resolution(min_value, max_value)
+            if resolution in ['hour', 'minute']:
+                return None
+
+            pool.execute(cursor, f"""
+SELECT date_trunc('{resolution}', "{column_name}") AS d,
+       to_char(date_trunc('{resolution}', "{column_name}"), '{_date_resolutions[resolution]}'),
+       {count}
+FROM {table}
+{where}GROUP BY 1
+ORDER BY d""", parameters)
             return cursor.fetchall()
 
+    def distributions(self, column_names: [str], sample_percent: float = None) -> {str: []}:
+        """
+        Computes the distributions of several columns with as few table scans as possible
+
+        The min and max values of all number and date columns are computed in a first pass. Then the
+        histograms of all number, date and text columns are computed in a second pass using grouping sets.
+        Text array columns need to be unnested and are computed separately.
+
+        Args:
+            column_names: The columns to compute distributions for
+            sample_percent: When set, then the distributions are computed from a sample of this percentage
+                            of the table rows and counts are scaled up accordingly
+
+        Returns: A dictionary of column names to distributions, in the format of the `*_distribution` methods
+        """
+        from . import statistics
+
+        distributions = {}
+        if not self.filters:
+            for column_name, column_statistics in statistics.load(self.data_set).items():
+                if column_name in column_names and column_statistics.distribution is not None:
+                    distributions[column_name] = column_statistics.to_distribution()
+
+        for column_name in column_names:
+            if column_name in distributions:
+                continue
+            found, distribution = cache.lookup(self.data_set, self._cache_key(
+                'distribution', column_name=column_name, sample_percent=sample_percent))
+            if found:
+                distributions[column_name] = distribution
+
+        missing_column_names = [column_name for column_name in column_names if column_name not in distributions]
+        for column_name in missing_column_names:
+            distribution = self._rollup_distribution(column_name)
+            if distribution is not None:
+                cache.store(self.data_set, self._cache_key(
+                    'distribution', column_name=column_name, sample_percent=sample_percent), distribution)
+                distributions[column_name] = distribution
+
+        missing_column_names = [column_name for column_name in column_names if column_name not in distributions]
+        if missing_column_names:
+            for column_name, distribution in self._distributions(missing_column_names, sample_percent).items():
+                cache.store(self.data_set, self._cache_key(
+                    'distribution', column_name=column_name, sample_percent=sample_percent), distribution)
+                distributions[column_name] = distribution
+        return distributions
+
+    def _distributions(self, column_names: [str], sample_percent: float) -> {str: []}:
+        """
+        Computes the distributions of number, date and text columns in two batched passes (see
+        `_batched_distributions`), and those of text array columns separately (time columns have none). When the batched passes
+        fail, then each column is computed on its own, so that a failing column only loses its own distribution.
+        """
+        import psycopg2.extensions
+
+        columns = [self.data_set.columns[column_name] for column_name in column_names]
+        # time columns can not be cast to timestamps
+        batched_columns = [column for column in columns
+                           if column.type in ['number', 'date', 'text'] and column.database_type not in _time_types]
+
+        distributions = {}
+        if batched_columns:
+            try:
+                distributions = self._batched_distributions(batched_columns, sample_percent)
+            except psycopg2.extensions.QueryCanceledError:
+                # statement timeouts and canceled requests concern all columns
+                raise
+            except psycopg2.Error:
+                logger.exception(f'Distributions of "{self.data_set.id}" could not be computed together')
+                distributions = {}
+
+        for column in columns:
+            if column.column_name not in distributions:
+                distributions[column.column_name] = self._column_distribution(column, sample_percent)
+        return distributions
+
+    def _column_distribution(self, column: 'data_set.Column', sample_percent: float) -> []:
+        """The distribution of a single column, empty when it can not be computed"""
+        import psycopg2.extensions
+
+        compute = {'number': self._number_distribution, 'date': self._date_distribution,
+                   'text': self._text_distribution, 'text[]': self._text_array_distribution}.get(column.type)
+        if not compute or column.database_type in _time_types:
+            # date distributions are bucketed by timestamps
+            return []
+        try:
+            return compute(column.column_name, sample_percent)
+        except psycopg2.extensions.QueryCanceledError:
+            raise
+        except psycopg2.Error:
+            logger.exception(f'Distribution of "{self.data_set.id}.{column.column_name}" could not be computed')
+            return []
+
+    def _batched_distributions(self, columns: ['data_set.Column'], sample_percent: float) -> {str: []}:
+        """The distributions of number, date and text columns with two table scans (see `distributions`)"""
+        distributions = {column.column_name: [] for column in columns}
+        table = self._from_sql(sample_percent)
+        where, parameters = self.filters_to_sql()
+
+        with governor.cursor_context(self.data_set) as cursor:
+            # min & max values of all number and date columns in one pass
+            ranges = {}
+            range_columns = [column for column in columns if column.type in ['number', 'date']]
+            if range_columns:
+                aggregates = []
+                for column in range_columns:
+                    cast = 'NUMERIC' if column.type == 'number' else 'TIMESTAMPTZ'
+                    aggregates.append(f'min("{column.column_name}") :: {cast}, max("{column.column_name}") :: {cast}, '
+                                      f'count("{column.column_name}")')
+                pool.execute(cursor, f"""
+SELECT """ + ',\n       '.join(aggregates) + f"""
+FROM {table}
+{where}""", parameters)
+                row = cursor.fetchone()
+                for i, column in enumerate(range_columns):
+                    ranges[column.column_name] = row[3 * i:3 * i + 3]
+
+            # the grouping expression of each column in the second pass, its SQL parameters and how its values are
+            # bucketed (the lower bound and width of number buckets, the resolution of dates)
+            grouping_sets = []
+            for column in columns:
+                if column.type == 'number':
+                    min_value, max_value, number_of_values = ranges[column.column_name]
+                    if min_value is None:
+                        continue
+                    elif min_value == max_value:
+                        distributions[column.column_name] = [
+                            (float(min_value), float(max_value),
+                             float(_scale_count(number_of_values, sample_percent)))]
+                    else:
+                        min_, max_, width = _number_buckets(min_value, max_value)
+                        grouping_sets.append(
+                            (column, f'width_bucket("{column.column_name}", %s::NUMERIC, %s::NUMERIC, %s::INTEGER)',
+                             [min_ * width, max_ * width, max_ - min_], (min_, width)))
+                elif column.type == 'date':
+                    min_value, max_value, _ = ranges[column.column_name]
+                    if min_value is not None:
+                        resolution = _date_resolution(min_value, max_value)
+                        grouping_sets.append(
+                            (column, f"""date_trunc('{resolution}', "{column.column_name}")""", [], resolution))
+                elif column.type == 'text':
+                    grouping_sets.append((column, f'"{column.column_name}"', [], None))
+
+            if grouping_sets:
+                # the grouping expressions are computed in a subquery, as expressions with parameters can not be
+                # referenced in GROUPING()
+                set_index = 'CASE ' + ' '.join(f'WHEN GROUPING(group_{i}) = 0 THEN {i}'
+                                               for i in range(len(grouping_sets))) + ' END'
+                is_null = 'CASE ' + ' '.join(f'WHEN GROUPING(group_{i}) = 0 THEN group_{i} IS NULL'
+                                             for i in range(len(grouping_sets))) + ' END'
+                values = []
+                for i, (column, _, _, resolution) in enumerate(grouping_sets):
+                    values.append(f'value_{i}')
+                    if column.type == 'date':
+                        values.append(f"to_char(value_{i}, '{_date_resolutions[resolution]}')")
+                text_set_indexes = [str(i) for i, (column, _, _, _) in enumerate(grouping_sets)
+                                    if column.type == 'text']
+
+                # only keep the 10 most frequent values of text columns
+                pool.execute(cursor, f"""
+SELECT set_index, n, {', '.join(values)}
+FROM (SELECT {set_index} AS set_index,
+             {is_null} AS is_null,
+             {', '.join(f'group_{i} AS value_{i}' for i in range(len(grouping_sets)))},
+             count(*) AS n,
+             row_number() OVER (PARTITION BY {set_index} ORDER BY {is_null}, count(*) DESC) AS rank
+      FROM (SELECT {', '.join(f'{expression} AS group_{i}' for i, (_, expression, _, _) in enumerate(grouping_sets))}
+            FROM {table}
+            {where}) t
+      GROUP BY GROUPING SETS ({', '.join(f'(group_{i})' for i in range(len(grouping_sets)))})) t
+WHERE NOT is_null
+      AND (rank <= 10 OR set_index <> ALL (ARRAY[{', '.join(text_set_indexes)}] :: INTEGER[]))
+""", [parameter for _, _, expression_parameters, _ in grouping_sets for parameter in expression_parameters]
+                             + parameters)
+                rows_by_set = {}
+                for row in cursor.fetchall():
+                    rows_by_set.setdefault(row[0], []).append((row[0], _scale_count(row[1], sample_percent)) + row[2:])
+
+                for i, (column, _, _, bucketing) in enumerate(grouping_sets):
+                    # position of the value in the result rows
+                    pos = 2 + sum(2 if c.type == 'date' else 1 for c, _, _, _ in grouping_sets[:i])
+                    rows = rows_by_set.get(i, [])
+                    if column.type == 'number':
+                        min_, width = bucketing
+                        distributions[column.column_name] = [
+                            (float((min_ + row[pos] - 1) * width), float((min_ + row[pos]) * width), row[1])
+                            for row in sorted(rows, key=lambda row: row[pos])]
+                    elif column.type == 'date':
+                        distributions[column.column_name] = [
+                            (row[pos], row[pos + 1], row[1]) for row in sorted(rows, key=lambda row: row[pos])]
+                    else:
+                        distributions[column.column_name] = [
+                            (row[pos], row[1]) for row in sorted(rows, key=lambda row: row[1], reverse=True)]
+
+        return distributions
+
     def save(self):
         """Saves a query in the database"""
-        with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        with pool.cursor_context('mara') as cursor:
             cursor.execute(f'''
 INSERT INTO data_set_query (query_id, data_set_id, column_names, sort_column_name, sort_order, filters, 
                             created_at, created_by, updated_at, updated_by)
@@ -372,7 +1128,7 @@ DO UPDATE SET
     @classmethod
     def load(cls, query_id, data_set_id):
         """Loads a query from the database"""
-        with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        with pool.cursor_context('mara') as cursor:
             cursor.execute(f'''
 SELECT data_set_id, query_id, column_names, sort_column_name, sort_order, filters, 
        created_at, created_by, updated_at, updated_by 
@@ -385,6 +1141,20 @@ WHERE data_set_id = {'%s'} AND query_id = {'%s'}''',
                          [Filter.from_dict(f) for f in filters],
                          created_at, created_by, updated_at, updated_by)
 
+    def _cache_key(self, method: str, filters: [Filter] = None, **arguments) -> []:
+        """
+        A canonical representation of a computation on the query for the result cache
+
+        Args:
+            method: The name of the computation
+            filters: The filters that the computation depends on, all filters of the query when None
+            arguments: Further parameters of the computation
+        """
+        return [method,
+                sorted(json.dumps(filter.to_dict(), sort_keys=True)
+                       for filter in (self.filters if filters is None else filters)),
+                arguments]
+
     def to_dict(self):
         return {'data_set_id': self.data_set.id,
                 'query_id': self.query_id,
@@ -407,15 +1177,154 @@ WHERE data_set_id = {'%s'} AND query_id = {'%s'}''',
         return f'<Query {self.to_sql()}>'
 
 
+# formats for displaying the buckets of date histograms by resolution (from coarse to fine)
+_date_resolutions = {'year': 'YYYY',
+                     'month': 'YYYY Mon',
+                     'week': 'IYYY "-" "CW "IW',
+                     'day': 'Dy, Mon DD YYYY',
+                     'hour': 'Mon DD YYYY HH24:00',
+                     'minute': 'Mon DD HH24:MI'}
+
+
+# database types of date columns that are not timestamps and can not be cast to them
+_time_types = ['time with time zone', 'time without time zone']
+
+# operators that can be used in filters on number and date columns
+_comparison_operators = ['>=', '>', '=', '!=', '<', '<=']
+
+
+def _sql_literal(value) -> str:
+    """Renders a query parameter as an SQL constant, assuming `standard_conforming_strings`"""
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, (list, tuple)):
+        return 'ARRAY[' + ', '.join(_sql_literal(item) for item in value) + ']' if value else "'{}'"
+    elif isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool) and math.isfinite(value):
+        return str(value)
+    else:
+        return "'" + str(value).replace("'", "''") + "'"
+
+
+def _partition_conditions(column_name: str, lower, upper, count: int) -> [(str, [])]:
+    """
+    Splits the values between `lower` and `upper` into `count` ranges of equal width (numbers, dates or
+    timestamps) and returns a condition with `%s` placeholders for each range, in ascending order.
+    The first and the last range are open ended, the last condition is for NULL values.
+    """
+    boundaries = []
+    if lower is not None and upper is not None:
+        for i in range(1, count):
+            # integer division for integer columns
+            boundary = lower + (upper - lower) * i // count if isinstance(lower, int) \
+                else lower + (upper - lower) * i / count
+            if boundary > lower and (not boundaries or boundary > boundaries[-1]):
+                boundaries.append(boundary)
+
+    conditions = []
+    for pos in range(len(boundaries) + 1):
+        if not boundaries:
+            conditions.append((f'"{column_name}" IS NOT NULL', []))
+        elif pos == 0:
+            conditions.append((f'"{column_name}" < %s', [boundaries[0]]))
+        elif pos == len(boundaries):
+            conditions.append((f'"{column_name}" >= %s', [boundaries[-1]]))
+        else:
+            conditions.append((f'"{column_name}" >= %s AND "{column_name}" < %s',
+                               [boundaries[pos - 1], boundaries[pos]]))
+    conditions.append((f'"{column_name}" IS NULL', []))
+    return conditions
+
+
+def _render_sql(sql: str, parameters: []) -> str:
+    """Replaces the `%s` placeholders of a statement with the literals of its parameters"""
+    return sql % tuple(_sql_literal(parameter) for parameter in parameters)
+
+
+def _google_sheet_value(value, array_format: str):
+    """Converts a value from the database for a Google sheet cell"""
+    if isinstance(value, str):
+        list_value_str = value.replace('\t', ' - ')
+        # no more than 50k characters for a single cell value (Google API limit reference)
+        return (list_value_str[:48995] + ' ... ') if len(list_value_str) > 50000 else value
+    elif isinstance(value, list):
+        list_value_str = str(value).replace('\t', ' - ') if len(value) > 0 else ''
+        # Adjust array format
+        if array_format == 'curly':
+            list_value_str = ('{' + list_value_str[1:-1] + '}').replace('{}', '')
+        elif array_format == 'tuple':
+            list_value_str = str(tuple(value)).replace('\t', ' - ') if len(value) > 0 else ''
+        return (list_value_str[:48995] + ' ... ') if len(list_value_str) > 50000 else list_value_str
+    elif isinstance(value, datetime.datetime):
+        return str(value.strftime("%d-%m-%Y"))
+    else:
+        return value
+
+
+def _scale_count(count: int, sample_percent: float = None) -> int:
+    """Extrapolates a count in a sample of `sample_percent` of the table rows to the whole table"""
+    return round(count * 100 / sample_percent) if sample_percent else count
+
+
+def _number_buckets(min_value: decimal.Decimal, max_value: decimal.Decimal) -> (int, int, decimal.Decimal):
+    """
+    Finds histogram buckets with a width of a power of 10 so that there are more than 5 buckets
+
+    Returns: A tuple of the lower bound and upper bound of the histogram (in multiples of the bucket width)
+             and the bucket width
+    """
+    min_buckets = 5
+    _10 = decimal.Decimal(10)
+
+    # find the highest magnitude of 10
+    exponent = math.ceil(max(abs(min_value).log10(), abs(max_value).log10()))
+
+    while True:
+        # truncate to the next lower magnitude of 10
+        min_ = math.floor(min_value / pow(_10, exponent))
+        max_ = math.ceil(max_value / pow(_10, exponent))
+
+        if (max_ - min_) > min_buckets:
+            return min_, max_, pow(_10, exponent)
+        else:
+            exponent += -1
+
+
+def _date_resolution(min_value: datetime.datetime, max_value: datetime.datetime) -> str:
+    """Returns the coarsest resolution that has at least 5 buckets between two dates"""
+    min_buckets = 5
+
+    resolutions = list(_date_resolutions.keys())
+    if min_value.time() == max_value.time() == datetime.time(0):
+        # most likely a date column, hours and minutes don't make sense
+        resolutions = resolutions[:resolutions.index('day') + 1]
+
+    for resolution in resolutions:
+        if _number_of_date_buckets(resolution, min_value, max_value) >= min_buckets:
+            break
+    return resolution
+
+
+def _number_of_date_buckets(resolution: str, min_value: datetime.datetime, max_value: datetime.datetime) -> int:
+    """How many steps of a resolution are needed for getting from `min_value` to `max_value` (including both)"""
+    if resolution in ['year', 'month']:
+        months = (max_value.year - min_value.year) * 12 + max_value.month - min_value.month
+        if (max_value.day, max_value.time()) < (min_value.day, min_value.time()):
+            months -= 1
+        return (months // 12 if resolution == 'year' else months) + 1
+    else:
+        seconds = {'week': 7 * 24 * 3600, 'day': 24 * 3600, 'hour': 3600, 'minute': 60}[resolution]
+        return int((max_value - min_value).total_seconds() // seconds) + 1
+
+
 def delete_query(data_set_id, query_id: str):
-    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+    with pool.cursor_context('mara') as cursor:
         cursor.execute(f'''
 DELETE FROM data_set_query
 WHERE data_set_id = {'%s'} AND query_id = {'%s'}''', (data_set_id, query_id))
 
 
 def list_queries(data_set_id: str):
-    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+    with pool.cursor_context('mara') as cursor:
         cursor.execute(f'''
 SELECT query_id, updated_at, updated_by 
 FROM data_set_query
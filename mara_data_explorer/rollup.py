@@ -0,0 +1,102 @@
+"""Pre-aggregated rollup tables, which answer row counts and distributions on a few dimensions of a data set
+without scanning its table"""
+
+import json
+
+from . import cache, pool
+
+# the name of the column with the number of rows of each group
+COUNT_COLUMN_NAME = '_row_count'
+
+
+def table_name(data_set: 'data_set.DataSet') -> str:
+    """The quoted name of the rollup table of a data set"""
+    return f'"{data_set.database_schema}"."{data_set.database_table}_rollup"'
+
+
+def dimensions(data_set: 'data_set.DataSet') -> [str]:
+    """
+    The dimensions of the current rollup table of a data set. Empty when the data set has no rollup, the table
+    has not been created yet or it has been created for other dimensions than `data_set.rollup_column_names`.
+    """
+    if not data_set.rollup_column_names:
+        return []
+    built_dimensions = cache.cached(data_set, ['rollup_dimensions'], lambda: _built_dimensions(data_set))
+    return built_dimensions if built_dimensions == sorted(data_set.rollup_column_names) else []
+
+
+def _built_dimensions(data_set: 'data_set.DataSet') -> [str]:
+    # the dimensions are stored as the comment of the table
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        cursor.execute(f"SELECT obj_description(to_regclass({'%s'}), 'pg_class')", (table_name(data_set),))
+        comment = cursor.fetchone()[0]
+    try:
+        return json.loads(comment)['dimensions'] if comment else []
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def covers(data_set: 'data_set.DataSet', column_names: [str]) -> bool:
+    """Whether the rollup table of a data set can answer queries that filter or group by these columns"""
+    rollup_dimensions = dimensions(data_set)
+    return bool(rollup_dimensions) and all(column_name in rollup_dimensions for column_name in column_names)
+
+
+def min_column_name(column_name: str) -> str:
+    """The column of the rollup table with the smallest value of a date dimension in each group"""
+    return f'_min_{column_name}'
+
+
+def max_column_name(column_name: str) -> str:
+    """The column of the rollup table with the largest value of a date dimension in each group"""
+    return f'_max_{column_name}'
+
+
+def refresh(data_set: 'data_set.DataSet'):
+    """
+    (Re-)creates the rollup table of a data set, e.g. after its table has been reloaded. The table has one row
+    with the number of rows for each combination of values of `data_set.rollup_column_names`. Date columns are
+    truncated to days, together with the exact min and max values of each group.
+
+    The new table is built next to the old one and swapped in within one transaction, so that queries
+    never see a partially built rollup.
+    """
+    from .query import _time_types
+
+    columns = []
+    for column_name in data_set.rollup_column_names:
+        column = data_set.columns.get(column_name)
+        if not column:
+            raise ValueError(f'Rollup column "{column_name}" does not exist in data set "{data_set.id}"')
+        # time columns can not be truncated to days
+        if column.type not in ['text', 'number', 'date'] or column.database_type in _time_types:
+            raise ValueError(f'Rollup column "{column_name}" of data set "{data_set.id}" has unsupported '
+                             f'type {column.database_type} (only text, number, date and timestamp columns '
+                             f'can be rolled up)')
+        columns.append(column)
+
+    new_table_name = f'"{data_set.database_schema}"."{data_set.database_table}_rollup_new"'
+    dimension_expressions, aggregates = [], []
+    for column in columns:
+        if column.type == 'date':
+            dimension_expressions.append(f'date_trunc(\'day\', "{column.column_name}") AS "{column.column_name}"')
+            aggregates.append(f'min("{column.column_name}") AS "{min_column_name(column.column_name)}"')
+            aggregates.append(f'max("{column.column_name}") AS "{max_column_name(column.column_name)}"')
+        else:
+            dimension_expressions.append(f'"{column.column_name}"')
+
+    with pool.cursor_context(data_set.database_alias) as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {new_table_name}')
+        cursor.execute(f'''
+CREATE TABLE {new_table_name} AS
+SELECT {', '.join(dimension_expressions + aggregates)}, count(*) AS "{COUNT_COLUMN_NAME}"
+FROM "{data_set.database_schema}"."{data_set.database_table}"
+GROUP BY {', '.join(str(i + 1) for i in range(len(columns)))}''')
+        cursor.execute(f'COMMENT ON TABLE {new_table_name} IS %s',
+                       (json.dumps({'dimensions': sorted(data_set.rollup_column_names)}),))
+        cursor.execute(f'DROP TABLE IF EXISTS {table_name(data_set)}')
+        cursor.execute(f'ALTER TABLE {new_table_name} RENAME TO "{data_set.database_table}_rollup"')
+        cursor.execute(f'ANALYZE {table_name(data_set)}')
+
+    # cached results can be based on the previous rollup
+    cache.invalidate(data_set.id)
@@ -23,12 +23,30 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
     /** The current page (needed in pagination) */
     var currentPage = 0;
 
+    /** Whether the data set supports keyset pagination (unique columns are defined) */
+    var keysetPagination = false;
+
+    /** Whether the last preview was paginated with a keyset (otherwise with an offset) */
+    var keysetActive = false;
+
+    /** For keyset pagination: the sort key of the last row before each page */
+    var pageCursors = [null];
+
     /** The total number of rows of the data set table */
     var dataSetRowCount = 0;
 
     /** The number of rows returned by the current query */
     var filteredRowCount = 0;
 
+    /** Whether row counts are estimated first (exact counts are computed on demand) */
+    var estimateRowCounts = false;
+
+    /** Whether `filteredRowCount` is an estimate */
+    var filteredRowCountIsEstimate = false;
+
+    /** When true, distribution charts are computed from all rows even when the data set is configured for sampling */
+    var exactDistributionCharts = false;
+
 
     /**
      * An ordered list of requests that need to be sent and processed,
@@ -37,6 +55,9 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
      */
     var queue = [];
 
+    /** Identifies the requests of this page, for cancelling the database queries of aborted requests on the server */
+    var pageKey = Math.random().toString(36).substring(2);
+
     /** All currently running Ajax requests by url */
     var runningRequests = {};
 
@@ -49,11 +70,34 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
      * @param highPrio when true, then the request is put at the front of the queue
      */
     function enqueueRequest(url, data, targets, handler, highPrio) {
+        cancelRequest(url);
+
+        // replace targets with spinners
+        targets.forEach(function (target) {
+            target.html('<div style="height:' + target.innerHeight() + 'px">' + spinner() + '</div>');
+        });
+
+        // queue request
+        var request = {'url': url, 'data': data, 'handler': handler, 'targets': targets};
+        if (highPrio) {
+            queue.unshift(request);
+        } else {
+            queue.push(request);
+        }
+        processQueue();
+    }
+
+    /**
+     * Aborts a running request for an url and removes queued requests for it
+     * @param url the url of the request
+     */
+    function cancelRequest(url) {
         // cancel a running ajax request for the url
         if (runningRequests[url] != undefined) {
             console.log('abort running request for ' + url);
             runningRequests[url].abort();
             delete runningRequests[url];
+            cancelQueries(url);
         }
 
         // remove previous request for url from queue
@@ -63,22 +107,34 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
                 queue.splice(i);
             }
         });
+    }
 
-        // replace targets with spinners
-        targets.forEach(function (target) {
-            target.html('<div style="height:' + target.innerHeight() + 'px">' + spinner() + '</div>');
-        });
+    /**
+     * Renders a row count (e.g. "20 Orders (3.2%)")
+     * @param count the number of rows
+     * @param isEstimate when true, the count is marked as approximate
+     */
+    function formatRowCount(count, isEstimate) {
+        return (isEstimate ? '≈ ' : '') + count + ' ' + dataSetName + ' ('
+            + (Math.round(1000.0 * count / dataSetRowCount) / 10.0) + '%)';
+    }
 
-        // queue request
-        var request = {'url': url, 'data': data, 'handler': handler, 'targets': targets};
-        if (highPrio) {
-            queue.unshift(request);
-        } else {
-            queue.push(request);
+    /**
+     * Cancels the database queries of an aborted request on the server
+     * @param url the url of the request
+     */
+    function cancelQueries(url) {
+        if (query && navigator.sendBeacon) {
+            navigator.sendBeacon(baseUrl + '/.cancel-query',
+                JSON.stringify({'data_set_id': query.data_set_id, 'key': pageKey + ' ' + url}));
         }
-        processQueue();
     }
 
+    // don't leave queries running when the page is closed
+    window.addEventListener('pagehide', function () {
+        Object.keys(runningRequests).forEach(cancelQueries);
+    });
+
     /** starts new requests if possible */
     function processQueue() {
         // don't run more than 4 requests concurrently
@@ -88,6 +144,7 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
             runningRequests[request.url] = $.ajax({
                 type: "POST",
                 url: request.url,
+                headers: {'X-Query-Key': pageKey + ' ' + request.url},
                 contentType: "application/json; charset=utf-8",
                 data: JSON.stringify(request.data),
                 success: function (data) {
@@ -148,10 +205,11 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
 
             dataSetName = data.data_set_name;
             dataSetRowCount = data.row_count;
+            keysetPagination = data.keyset_pagination;
+            estimateRowCounts = data.estimate_row_counts;
 
-            updateFilters();
-            updatePreview();
-            updateRowCount();
+            updateFilters(true);
+            updateQueryState(allFilterPositions());
             updateDistributionCharts(true);
 
 
@@ -245,10 +303,11 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
             };
             query.filters.push(filter);
             currentPage = 0;
-            updateFilterRow(query.filters.length - 1);
+            pageCursors = [null];
+            updateFilterRow(query.filters.length - 1, true);
             updateDistributionCharts(true);
             addColumn(columnName);
-            updateRowCount();
+            updateQueryState([query.filters.length - 1]);
         }
         $('html, body').animate({scrollTop: 0}, 500);
     }
@@ -256,10 +315,10 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
     /** Remove a filter from the query */
     function deleteFilter(pos) {
         query.filters.splice(pos, 1);
-        updateFilters();
+        updateFilters(true);
         currentPage = 0;
-        updatePreview();
-        updateRowCount();
+        pageCursors = [null];
+        updateQueryState(allFilterPositions());
         updateDistributionCharts(true);
 
     }
@@ -273,22 +332,45 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
     function changeFilter(pos, key, value) {
         query.filters[pos][key] = value;
         currentPage = 0;
-        updatePreview();
-        updateRowCount();
-        updateFilterRow(pos);
+        pageCursors = [null];
+        updateFilterRow(pos, true);
+        updateQueryState([pos]);
         updateDistributionCharts(true);
     }
 
-    /** Redraws the whole filters table */
-    function updateFilters() {
+    /**
+     * Redraws the whole filters table
+     * @param withoutRowCounts when true, the row counts of the filters are not requested (see `updateQueryState`)
+     */
+    function updateFilters(withoutRowCounts) {
         $('#filters').empty().append($('<table class="mara-table table table-condensed table-sm"><tbody/></table>'));
         query.filters.forEach(function (filter, pos) {
-            updateFilterRow(pos);
+            updateFilterRow(pos, withoutRowCounts);
         });
     }
 
-    /** Redraws one row of the filters table */
-    function updateFilterRow(pos) {
+    /**
+     * Displays the number of rows that match a single filter
+     * @param pos the position of the filter
+     * @param filterCount the number of rows and whether it is estimated (`{count: .., estimated: ..}`)
+     */
+    function showFilterRowCount(pos, filterCount) {
+        $('#filter-counts-' + pos).empty().append(formatRowCount(filterCount.count, filterCount.estimated));
+    }
+
+    /** The positions of all filters of the query */
+    function allFilterPositions() {
+        return query.filters.map(function (filter, pos) {
+            return pos;
+        });
+    }
+
+    /**
+     * Redraws one row of the filters table
+     * @param pos the position of the filter
+     * @param withoutRowCount when true, the row count of the filter is not requested (see `updateQueryState`)
+     */
+    function updateFilterRow(pos, withoutRowCount) {
         var type = columnTypesByColumnName[query.filters[pos].column_name];
         var operators = {
             'number': ['>=', '>', '=', '<', '<='],
@@ -332,11 +414,13 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
         }
 
         // update filter row count
-        enqueueRequest(baseUrl + '/.filter-row-count-' + pos, query, [$('#filter-counts-' + pos)],
-            function (filterCount) {
-                $('#filter-counts-' + pos).empty().append('' + filterCount + ' ' + dataSetName + ' ('
-                    + (Math.round(1000.0 * filterCount / dataSetRowCount) / 10.0) + '%)');
-            }, false);
+        if (!withoutRowCount) {
+            enqueueRequest(baseUrl + '/.filter-row-count-' + pos + (estimateRowCounts ? '?estimate=true' : ''),
+                query, [$('#filter-counts-' + pos)],
+                function (filterCount) {
+                    showFilterRowCount(pos, filterCount);
+                }, false);
+        }
 
         // add auto-completion and event handlers
         if (type == 'text' || type == 'text[]') {
@@ -414,98 +498,267 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
 
     /** replace the content of the preview card */
     function updatePreview() {
+        var page = currentPage;
         enqueueRequest(
             baseUrl + '/.preview',
-            {query: query, limit: pageSize, offset: pageSize * currentPage},
+            {
+                query: query, limit: pageSize, offset: pageSize * page,
+                keyset: keysetPagination, cursor: pageCursors[page], format: 'json'
+            },
             [$("#preview")],
             function (data) {
-                $("#preview").html(data);
-                $("#preview th a").click(function () {
-                    column_name = $(this)[0].name;
-                    if (query.sort_column_name == column_name) {
-                        query.sort_order = (query.sort_order == 'ASC' ? 'DESC' : query.sort_order == 'DESC' ? null : 'ASC');
+                showPreview(data, page);
+            }, true);
+
+    }
+
+    /** Escapes a text for inserting it into html */
+    function escapeHtml(text) {
+        return String(text).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+            .replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+    }
+
+    /**
+     * Renders a page of the preview table from its columnar json representation
+     * @param data a dictionary with the column metadata and the values of each column (see `_preview_payload`)
+     * @returns {string} the html of the table
+     */
+    function renderPreviewTable(data) {
+        var html = ['<table class="mara-table table table-hover table-condensed table-sm mara-table-float-header"><thead><tr>'];
+        data.columns.forEach(function (column) {
+            var columnName = escapeHtml(column.column_name);
+            if (column.sortable) {
+                var icon = '';
+                if (data.sort_column_name == column.column_name && data.sort_order == 'ASC') {
+                    icon = '<span class="fa fa-sort-amount-asc"></span>';
+                } else if (data.sort_column_name == column.column_name && data.sort_order == 'DESC') {
+                    icon = '<span class="fa fa-sort-amount-desc"></span>';
+                }
+                html.push('<th><a href="#" name="' + columnName + '">' + icon + ' ' + columnName + '</a></th>');
+            } else {
+                html.push('<th>' + columnName + '</th>');
+            }
+        });
+        html.push('</tr></thead><tbody>');
+
+        var numberOfRows = 0;
+        data.values.concat(Object.values(data.rendered)).forEach(function (values) {
+            if (values) {
+                numberOfRows = Math.max(numberOfRows, values.length);
+            }
+        });
+
+        for (var row = 0; row < numberOfRows; row++) {
+            html.push('<tr>');
+            data.columns.forEach(function (column, pos) {
+                var cell = '';
+                if (column.restricted) {
+                    cell = data.restricted_html;
+                } else if (pos in data.rendered) {
+                    cell = data.rendered[pos][row];
+                } else {
+                    var value = data.values[pos][row];
+                    if (value === null || value === undefined) {
+                        cell = '';
+                    } else if (column.type == 'text[]') {
+                        cell = '<ul>' + value.map(function (element) {
+                            return '<li><span class="preview-value">' + escapeHtml(element) + '</span></li>';
+                        }).join('') + '</ul>';
+                    } else if (column.type == 'json') {
+                        cell = '<pre class="preview-value">' + escapeHtml(JSON.stringify(value, null, 2)) + '</pre>';
                     } else {
-                        query.sort_column_name = column_name;
-                        query.sort_order = 'ASC';
+                        cell = '<span class="preview-value">' + escapeHtml(value) + '</span>';
                     }
-                    updatePreview();
-                });
-                query.column_names.forEach(function (columnName, i) {
-                    var columnType = columnTypesByColumnName[columnName];
-                    var valueContainers = $("#preview td:nth-child(" + (i + 1) + ") span.preview-value");
-                    valueContainers.each(function (i, valueContainer) {
-                        var value = $(valueContainer).contents().get(0).nodeValue;
-                        var controls = $('<div class="hover-controls"/>');
-
-                        var filterFunction = null;
-
-
-                        if (columnType == 'text' || columnType == 'text[]') {
-                            filterFunction = function () {
-                                addFilter(columnName, [value], true);
-                            };
-                        } else if (columnType == 'date') {
-                            filterFunction = function () {
-                                addFilter(columnName, new Date(value).toJSON().slice(0, 10), true);
-                            };
-                        } else if (columnType == 'number') {
-                            filterFunction = function () {
-                                addFilter(columnName, value, true);
-                            };
-                        }
-                        if (filterFunction) {
-                            var filterLink = $('<a href="#"><span class="fa fa-filter"> </span> Filter</a>')
-                                .click(filterFunction);
-                            controls.append(filterLink);
-                            $(valueContainer).click(filterFunction);
-                        }
-                        controls.append($('<a href="#"><span class="fa fa-copy"> </span> Copy to clipboard</a>')
-                            .click(function () {
-                                copyToClipboard(value);
-                                return false;
-                            }));
+                }
+                html.push('<td>' + cell + '</td>');
+            });
+            html.push('</tr>');
+        }
+        html.push('</tbody></table>');
+        return html.join('');
+    }
 
+    /**
+     * Displays a page of the preview table
+     * @param data the rendered preview table, or its columnar json representation (see `renderPreviewTable`)
+     * @param page the number of the page
+     */
+    function showPreview(data, page) {
+        if (data !== null && typeof data == 'object') {
+            $("#preview").html(renderPreviewTable(data));
+
+            // remember where the next page starts
+            keysetActive = 'next_cursor' in data;
+            if (keysetActive) {
+                pageCursors[page + 1] = data.next_cursor;
+            }
+        } else {
+            $("#preview").html(data);
+
+            // remember where the next page starts
+            var nextCursor = $("#preview [data-next-cursor]");
+            keysetActive = nextCursor.length > 0;
+            if (keysetActive) {
+                pageCursors[page + 1] = JSON.parse(nextCursor.attr('data-next-cursor'));
+            }
+        }
+
+        $("#preview th a").click(function () {
+            column_name = $(this)[0].name;
+            if (query.sort_column_name == column_name) {
+                query.sort_order = (query.sort_order == 'ASC' ? 'DESC' : query.sort_order == 'DESC' ? null : 'ASC');
+            } else {
+                query.sort_column_name = column_name;
+                query.sort_order = 'ASC';
+            }
+            // sort keys of a different order are not valid anymore
+            currentPage = 0;
+            pageCursors = [null];
+            paginate();
+        });
+        query.column_names.forEach(function (columnName, i) {
+            var columnType = columnTypesByColumnName[columnName];
+            var valueContainers = $("#preview td:nth-child(" + (i + 1) + ") span.preview-value");
+            valueContainers.each(function (i, valueContainer) {
+                var value = $(valueContainer).contents().get(0).nodeValue;
+                var controls = $('<div class="hover-controls"/>');
+
+                var filterFunction = null;
+
+
+                if (columnType == 'text' || columnType == 'text[]') {
+                    filterFunction = function () {
+                        addFilter(columnName, [value], true);
+                    };
+                } else if (columnType == 'date') {
+                    filterFunction = function () {
+                        addFilter(columnName, new Date(value).toJSON().slice(0, 10), true);
+                    };
+                } else if (columnType == 'number') {
+                    filterFunction = function () {
+                        addFilter(columnName, value, true);
+                    };
+                }
+                if (filterFunction) {
+                    var filterLink = $('<a href="#"><span class="fa fa-filter"> </span> Filter</a>')
+                        .click(filterFunction);
+                    controls.append(filterLink);
+                    $(valueContainer).click(filterFunction);
+                }
+                controls.append($('<a href="#"><span class="fa fa-copy"> </span> Copy to clipboard</a>')
+                    .click(function () {
+                        copyToClipboard(value);
+                        return false;
+                    }));
 
-                        $(valueContainer).append(controls);
-                    });
-                });
-                floatMaraTableHeaders();
-            }, true);
 
+                $(valueContainer).append(controls);
+            });
+        });
+        floatMaraTableHeaders();
     }
 
     /** Redraws the left and right title of the preview card */
     function updateRowCount() {
+        // an exact count of a previous query is not valid anymore
+        cancelRequest(baseUrl + '/.row-count');
+
         enqueueRequest(
-            baseUrl + '/.row-count', query, [$('#row-counts'), $('#pagination')],
-            function (_filteredRowCount) {
-                filteredRowCount = _filteredRowCount;
-
-                $('#row-counts').empty().append(
-                    '' + filteredRowCount + ' ' + dataSetName + ' ('
-                    + (Math.round(1000.0 * filteredRowCount / dataSetRowCount) / 10.0) + '%)');
-
-                // reset pagination
-                $('#pagination').empty().append('Rows <span id="pagination-from">1</span> - <span id="pagination-to">'
-                    + Math.min(pageSize, filteredRowCount) + '</span>');
-
-                if (filteredRowCount > pageSize) {
-                    $('#pagination').append('&#160;&#160;').append(
-                        $('<a id="pagination-backward-button" href="#" style="display:none" title="Previous page (Previous page (⇠ key))"><span class="fa fa-angle-left"> </span> Previous</a>').click(paginateBackward)
-                    );
-                    $('#pagination').append('&#160;&#160;').append(
-                        $('<a href="#" id="pagination-forward-button" title="Next page (⇢ key)">Next <span class="fa fa-angle-right"> </span></a>').click(paginateForward)
-                    );
-                }
+            baseUrl + '/.row-count' + (estimateRowCounts ? '?estimate=true' : ''), query,
+            [$('#row-counts'), $('#pagination')],
+            showRowCountAndPagination, false);
+    }
+
+    /**
+     * Displays the number of rows of the current query and resets the pagination
+     * @param _filteredRowCount the number of rows and whether it is estimated (`{count: .., estimated: ..}`)
+     */
+    function showRowCountAndPagination(_filteredRowCount) {
+        showRowCount(_filteredRowCount.count, _filteredRowCount.estimated);
+
+        // reset pagination
+        $('#pagination').empty().append('Rows <span id="pagination-from">1</span> - <span id="pagination-to">'
+            + Math.min(pageSize, filteredRowCount) + '</span>');
+
+        if (filteredRowCount > pageSize || filteredRowCountIsEstimate) {
+            $('#pagination').append('&#160;&#160;').append(
+                $('<a id="pagination-backward-button" href="#" style="display:none" title="Previous page (Previous page (⇠ key))"><span class="fa fa-angle-left"> </span> Previous</a>').click(paginateBackward)
+            );
+            $('#pagination').append('&#160;&#160;').append(
+                $('<a href="#" id="pagination-forward-button" title="Next page (⇢ key)">Next <span class="fa fa-angle-right"> </span></a>').click(paginateForward)
+            );
+        }
+    }
+
+    /**
+     * Updates the preview, the row count and the row counts of some filters with a single request
+     * @param filterPositions the positions of the filters whose row counts need to be updated
+     */
+    function updateQueryState(filterPositions) {
+        // separate requests for a previous query are not valid anymore
+        cancelRequest(baseUrl + '/.preview');
+        cancelRequest(baseUrl + '/.row-count');
+
+        var page = currentPage;
+        enqueueRequest(
+            baseUrl + '/.query-state',
+            {
+                query: query, limit: pageSize, offset: pageSize * page,
+                keyset: keysetPagination, cursor: pageCursors[page], format: 'json',
+                estimate: estimateRowCounts, filter_positions: filterPositions
+            },
+            [$('#preview'), $('#row-counts'), $('#pagination')].concat(filterPositions.map(function (pos) {
+                return $('#filter-counts-' + pos);
+            })),
+            function (data) {
+                showPreview(data.preview, page);
+                showRowCountAndPagination(data.row_count);
+                filterPositions.forEach(function (pos) {
+                    showFilterRowCount(pos, data.filter_row_counts[pos]);
+                });
+            }, true);
+    }
 
+    /** Counts the rows of the current query exactly (when row counts are estimated) */
+    function updateExactRowCount() {
+        enqueueRequest(
+            baseUrl + '/.row-count', query, [$('#row-counts')],
+            function (_filteredRowCount) {
+                showRowCount(_filteredRowCount.count, false);
+                $('#pagination-forward-button').css('display', (currentPage + 1) * pageSize < filteredRowCount ? 'inline' : 'none');
             }, false);
     }
 
+    /**
+     * Displays the number of rows of the current query in the left title of the preview card
+     * @param count the number of rows
+     * @param isEstimate when true, a link for computing the exact count is shown
+     */
+    function showRowCount(count, isEstimate) {
+        filteredRowCount = count;
+        filteredRowCountIsEstimate = isEstimate;
+
+        $('#row-counts').empty().append(formatRowCount(filteredRowCount, isEstimate));
+        if (isEstimate) {
+            $('#row-counts').append('&#160;&#160;').append(
+                $('<a href="#" title="Count the rows exactly">exact count</a>').click(function () {
+                    updateExactRowCount();
+                    return false;
+                }));
+        }
+    }
+
+    /** Positions of the distribution charts that have been requested, but not been received yet */
+    var pendingDistributionCharts = {};
+
     /**
      * Updates the column distribution charts at the bottom of the page according
      * @param reloadAll When true, also reload contents of visible cards
      */
     function updateDistributionCharts(reloadAll) {
+        // all charts are computed in a single request, charts of an aborted request are requested again
+        var positions = [];
+        var newPositions = [];
         allColumns.forEach(function (column, i) {
             var div = $("#distribution-chart-" + i);
             if ($.inArray(column['column_name'], query.column_names) != -1) {
@@ -515,32 +768,86 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
                 }
 
                 if (!isVisible || reloadAll) {
-                    var cardBody = div.find('.chart-container');
-
-                    enqueueRequest(baseUrl + '/.distribution-chart-' + i, query, [cardBody],
-                        function (data) {
-                            if (!data.data || data.data.length < 1) {
-                                cardBody.html('∅');
-                            } else {
-                                switch (data.column.type) {
-                                    case 'number':
-                                        drawNumberDistributionChart(cardBody[0], data.column.column_name, data.data);
-                                        break;
-                                    case 'text':
-                                    case 'text[]':
-                                        drawTextDistributionChart(cardBody[0], data.column.column_name, data.data);
-                                        break;
-                                    case 'date':
-                                        drawDateDistributionChart(cardBody[0], data.column.column_name, data.data);
-                                        break;
-                                }
-                            }
-                        });
+                    newPositions.push(i);
+                } else if (pendingDistributionCharts[i]) {
+                    positions.push(i);
                 }
             } else {
+                delete pendingDistributionCharts[i];
                 div.slideUp();
             }
         });
+
+        if (newPositions.length == 0) {
+            return;
+        }
+        positions = positions.concat(newPositions);
+        positions.forEach(function (i) {
+            pendingDistributionCharts[i] = true;
+        });
+
+        enqueueRequest(baseUrl + '/.distribution-charts',
+            {query: query, positions: positions, exact: exactDistributionCharts},
+            positions.map(function (i) {
+                return $("#distribution-chart-" + i).find('.chart-container');
+            }),
+            function (charts) {
+                positions.forEach(function (i) {
+                    delete pendingDistributionCharts[i];
+                    var cardBody = $("#distribution-chart-" + i).find('.chart-container');
+                    var chart = charts[i];
+                    showDistributionSample($("#distribution-chart-" + i).find('.distribution-sample'), chart);
+                    if (chart.permission_denied) {
+                        cardBody.html(chart.permission_denied);
+                    } else if (!chart.data || chart.data.length < 1) {
+                        cardBody.html('∅');
+                    } else {
+                        switch (chart.column.type) {
+                            case 'number':
+                                drawNumberDistributionChart(cardBody[0], chart.column.column_name, chart.data);
+                                break;
+                            case 'text':
+                            case 'text[]':
+                                drawTextDistributionChart(cardBody[0], chart.column.column_name, chart.data);
+                                break;
+                            case 'date':
+                                drawDateDistributionChart(cardBody[0], chart.column.column_name, chart.data);
+                                break;
+                        }
+                    }
+                });
+            });
+    }
+
+    /**
+     * Marks a distribution chart as approximate when it has been computed from a sample of the table
+     * @param container the right header of the chart card
+     * @param chart the chart as returned by the server
+     */
+    function showDistributionSample(container, chart) {
+        container.empty();
+        if (!chart.sample_percent) {
+            return;
+        }
+
+        // the counts of the data are extrapolated, the smallest bar has the largest relative error
+        var title = 'Counts are extrapolated from a random sample of ' + chart.sample_percent + '% of the rows.';
+        if (chart.data && chart.data.length > 0) {
+            var smallestSampleCount = Math.min.apply(null, chart.data.map(function (row) {
+                return row[row.length - 1] * chart.sample_percent / 100;
+            }));
+            title += ' The 95% confidence interval of the smallest bar is about ±'
+                + Math.round(200 / Math.sqrt(Math.max(smallestSampleCount, 1))) + '%.';
+        }
+
+        container.append($('<span class="text-muted"></span>').attr('title', title)
+            .text('≈ ' + chart.sample_percent + '% sample'))
+            .append('&#160;&#160;').append(
+            $('<a href="#" title="Compute all charts from all rows">exact</a>').click(function () {
+                exactDistributionCharts = true;
+                updateDistributionCharts(true);
+                return false;
+            }));
     }
 
     /** Update the output columns of the query */
@@ -565,14 +872,18 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
     function paginate() {
         $('#pagination-from').html(currentPage * pageSize + 1);
         $('#pagination-to').html((currentPage + 1) * pageSize);
-        $('#pagination-forward-button').css('display', (currentPage + 1) * pageSize < filteredRowCount ? 'inline' : 'none');
+        $('#pagination-forward-button').css('display', (currentPage + 1) * pageSize < filteredRowCount || filteredRowCountIsEstimate ? 'inline' : 'none');
         $('#pagination-backward-button').css('display', currentPage > 0 ? 'inline' : 'none');
         updatePreview();
     }
 
     /** Shows the next rows in the preview table */
     function paginateForward() {
-        if ((currentPage + 1) * pageSize < filteredRowCount) {
+        if (keysetActive && pageCursors[currentPage + 1] === undefined) {
+            // the current page has not been loaded yet
+            return false;
+        }
+        if ((currentPage + 1) * pageSize < filteredRowCount || filteredRowCountIsEstimate) {
             currentPage++;
             paginate();
         }
@@ -632,6 +943,16 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
     /** downloads the curreny query a CSV file */
     function downloadCSV() {
         $('#download-csv-dialog input[name=query]').val(JSON.stringify(query));
+
+        // only offer the compressions of the selected format, select its default compression
+        $('#download-csv-dialog input[name=format]').off('change').on('change', function () {
+            var compressions = $(this).attr('data-compressions').split(' ');
+            $('#download-csv-dialog input[name=compression]').each(function () {
+                $(this).prop('disabled', compressions.indexOf(this.value) == -1);
+            });
+            $('#download-csv-dialog input[name=compression][value=' + compressions[0] + ']').prop('checked', true);
+        });
+
         $('#download-csv-dialog').modal();
     }
 
@@ -782,4 +1103,66 @@ function DataSetPage(baseUrl, args, pageSize, chartColor) {
         'displayQuery': displayQuery,
         'exportToGoogleSheet': exportToGoogleSheet
     };
-}
\ No newline at end of file
+}
+
+/**
+ * Shows the export jobs of the current user and reloads them while some of them are running
+ * @param tableUrl The url of the rendered table of export jobs
+ * @constructor
+ */
+function ExportsPage(tableUrl) {
+    function reload() {
+        $.get(tableUrl, function (html) {
+            $('#exports').html(html);
+            if ($('#exports tr[data-running]').length > 0) {
+                setTimeout(reload, 2000);
+            }
+        });
+    }
+
+    reload();
+}
+
+/**
+ * Fills the preview cards of the index page from a stream of newline delimited json objects
+ * (one per data set, in the order in which the previews are finished)
+ * @param previewsUrl The url of the endpoint that streams the previews of all data sets
+ * @constructor
+ */
+function IndexPage(previewsUrl) {
+    function showDataSetPreview(line) {
+        if (line) {
+            var preview = JSON.parse(line);
+            $('.data-set-preview').filter(function () {
+                return $(this).attr('data-data-set-id') == preview.data_set_id;
+            }).html(preview.html);
+        }
+    }
+
+    fetch(previewsUrl, {credentials: 'same-origin'}).then(function (response) {
+        if (!response.ok) {
+            throw new Error(response.status + ' ' + response.statusText);
+        }
+        var reader = response.body.getReader();
+        var decoder = new TextDecoder();
+        var buffer = '';
+
+        function read() {
+            return reader.read().then(function (result) {
+                buffer += decoder.decode(result.value || new Uint8Array(), {stream: !result.done});
+                var lines = buffer.split('\n');
+                buffer = lines.pop();
+                lines.forEach(showDataSetPreview);
+                if (result.done) {
+                    showDataSetPreview(buffer);
+                } else {
+                    return read();
+                }
+            });
+        }
+
+        return read();
+    }).catch(function (error) {
+        showAlert('Could not load previews: ' + error.message, 'danger');
+    });
+}
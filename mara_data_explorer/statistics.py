@@ -0,0 +1,233 @@
+"""A catalog of precomputed column statistics, which answers unfiltered distributions and counts without
+scanning the tables of data sets"""
+
+import datetime
+import decimal
+import json
+import logging
+
+import sqlalchemy
+
+from . import cache, config, governor, pool
+from .query import Base
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnStatistics(Base):
+    """Precomputed statistics of a column of a data set (across all rows)"""
+    __tablename__ = 'data_set_column_statistics'
+
+    data_set_id = sqlalchemy.Column(sqlalchemy.TEXT, primary_key=True)
+    column_name = sqlalchemy.Column(sqlalchemy.TEXT, primary_key=True)
+    column_type = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False)
+    row_count = sqlalchemy.Column(sqlalchemy.BIGINT, nullable=False)
+    null_fraction = sqlalchemy.Column(sqlalchemy.FLOAT)
+    distinct_count = sqlalchemy.Column(sqlalchemy.BIGINT)
+    min_value = sqlalchemy.Column(sqlalchemy.TEXT)
+    max_value = sqlalchemy.Column(sqlalchemy.TEXT)
+    distribution = sqlalchemy.Column(sqlalchemy.JSON)
+    computed_at = sqlalchemy.Column(sqlalchemy.TIMESTAMP(timezone=True), nullable=False)
+
+    def __init__(self, data_set_id: str, column_name: str, column_type: str, row_count: int,
+                 null_fraction: float = None, distinct_count: int = None, min_value: str = None,
+                 max_value: str = None, distribution: [] = None, computed_at: datetime.datetime = None):
+        """
+        Statistics of a column of a data set, computed by `refresh`
+
+        Args:
+            data_set_id: The id of the data set
+            column_name: The name of the column
+            column_type: The type of the column when the statistics were computed
+            row_count: The number of rows of the data set table
+            null_fraction: The fraction of rows in which the column is NULL
+            distinct_count: The estimated number of distinct values (from `pg_stats`, None when not analyzed)
+            min_value: The smallest value of a number or date column (as text)
+            max_value: The largest value of a number or date column (as text)
+            distribution: The histogram of a number or date column or the most frequent values of a text or
+                          text array column (in the json format of the `distribution` column)
+            computed_at: When the statistics were computed
+        """
+        self.data_set_id = data_set_id
+        self.column_name = column_name
+        self.column_type = column_type
+        self.row_count = row_count
+        self.null_fraction = null_fraction
+        self.distinct_count = distinct_count
+        self.min_value = min_value
+        self.max_value = max_value
+        self.distribution = distribution
+        self.computed_at = computed_at
+
+    @property
+    def typed_min_value(self):
+        """The smallest value as a `Decimal` or `datetime`"""
+        return _parse_value(self.column_type, self.min_value)
+
+    @property
+    def typed_max_value(self):
+        """The largest value as a `Decimal` or `datetime`"""
+        return _parse_value(self.column_type, self.max_value)
+
+    def to_distribution(self) -> []:
+        """The distribution in the format of the `Query.*_distribution` methods"""
+        if self.distribution is None:
+            return None
+        elif self.column_type == 'date':
+            return [(datetime.datetime.fromisoformat(d), label, n) for d, label, n in self.distribution]
+        else:
+            return [tuple(row) for row in self.distribution]
+
+    def __repr__(self):
+        return f'<ColumnStatistics "{self.data_set_id}"."{self.column_name}">'
+
+
+def load(data_set: 'data_set.DataSet') -> {str: ColumnStatistics}:
+    """
+    The statistics of the columns of a data set by column name. Outdated statistics (older than
+    `config.column_statistics_max_age()`) and those of columns that changed their type are left out.
+    """
+    if not config.column_statistics_max_age():
+        return {}
+    return cache.cached(data_set, ['column_statistics'], lambda: _load(data_set))
+
+
+def _load(data_set: 'data_set.DataSet') -> {str: ColumnStatistics}:
+    with pool.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+SELECT data_set_id, column_name, column_type, row_count, null_fraction, distinct_count,
+       min_value, max_value, distribution, computed_at
+FROM data_set_column_statistics
+WHERE data_set_id = {'%s'} AND computed_at > now() - {'%s'} * INTERVAL '1 second\'''',
+                       (data_set.id, config.column_statistics_max_age()))
+        column_statistics = {}
+        for row in cursor.fetchall():
+            statistics = ColumnStatistics(*row)
+            column = data_set.columns.get(statistics.column_name)
+            if column and column.type == statistics.column_type:
+                column_statistics[statistics.column_name] = statistics
+        return column_statistics
+
+
+def row_count(data_set: 'data_set.DataSet') -> int:
+    """The number of rows of a data set according to its statistics, None when there are no statistics"""
+    for statistics in load(data_set).values():
+        return statistics.row_count
+    return None
+
+
+def refresh(data_set: 'data_set.DataSet'):
+    """
+    (Re-)computes the statistics of all number, date, text and text array columns of a data set, e.g. after its
+    table has been reloaded. Needs three scans of the table (one more when there are text array columns).
+    Columns whose statistics can not be computed are left out (time columns have none). Like the other
+    maintenance jobs, all queries run without the statement timeout of the data set.
+    """
+    with governor.without_statement_timeout():
+        _refresh(data_set)
+
+
+def _refresh(data_set: 'data_set.DataSet'):
+    import psycopg2.extensions
+    from .query import Query, _time_types
+
+    columns = [column for column in data_set.columns.values()
+               if column.type in ['number', 'date', 'text', 'text[]'] and column.database_type not in _time_types]
+    table = f'"{data_set.database_schema}"."{data_set.database_table}"'
+
+    # column name -> number of values, min value, max value
+    aggregates = {}
+    try:
+        with governor.cursor_context(data_set) as cursor:
+            cursor.execute('SELECT ' + ',\n       '.join(['count(*)'] + [expression for column in columns
+                                                             for expression in _aggregate_expressions(column)])
+                           + f'\nFROM {table}')
+            row = list(cursor.fetchone())
+        row_count = row.pop(0)
+        for column in columns:
+            aggregates[column.column_name] = [row.pop(0) for _ in _aggregate_expressions(column)]
+    except psycopg2.extensions.QueryCanceledError:
+        raise
+    except psycopg2.Error:
+        # one scan per column, so that a failing column only loses its own statistics
+        logger.exception(f'Statistics of "{data_set.id}" could not be computed together')
+        row_count = None
+        for column in columns:
+            try:
+                with governor.cursor_context(data_set) as cursor:
+                    cursor.execute('SELECT ' + ', '.join(['count(*)'] + _aggregate_expressions(column))
+                                   + f'\nFROM {table}')
+                    row_count, *aggregates[column.column_name] = cursor.fetchone()
+            except psycopg2.extensions.QueryCanceledError:
+                raise
+            except psycopg2.Error:
+                logger.exception(f'Statistics of "{data_set.id}"."{column.column_name}" could not be computed')
+        columns = [column for column in columns if column.column_name in aggregates]
+
+    with governor.cursor_context(data_set) as cursor:
+        # estimated number of distinct values (negative values are fractions of the row count)
+        cursor.execute(f'''
+SELECT attname, n_distinct
+FROM pg_stats
+WHERE schemaname = {'%s'} AND tablename = {'%s'}''', (data_set.database_schema, data_set.database_table))
+        n_distinct = dict(cursor.fetchall())
+
+    # bypasses the catalog and the result cache
+    distributions = Query(data_set.id)._distributions([column.column_name for column in columns], None)
+
+    column_statistics = []
+    for column in columns:
+        number_of_values, *min_max = aggregates[column.column_name]
+        min_value, max_value = min_max or (None, None)
+        distinct_count = n_distinct.get(column.column_name)
+        if distinct_count is not None and distinct_count < 0:
+            distinct_count = round(-distinct_count * row_count)
+
+        column_statistics.append(ColumnStatistics(
+            data_set_id=data_set.id, column_name=column.column_name, column_type=column.type, row_count=row_count,
+            null_fraction=1 - number_of_values / row_count if row_count else None,
+            distinct_count=int(distinct_count) if distinct_count is not None else None,
+            min_value=_format_value(min_value), max_value=_format_value(max_value),
+            distribution=[[_format_value(value) if isinstance(value, datetime.datetime) else value
+                           for value in row_] for row_ in distributions[column.column_name]]))
+
+    with pool.cursor_context('mara') as cursor:
+        cursor.execute(f'DELETE FROM data_set_column_statistics WHERE data_set_id = {"%s"}', (data_set.id,))
+        for statistics in column_statistics:
+            cursor.execute(f'''
+INSERT INTO data_set_column_statistics (data_set_id, column_name, column_type, row_count, null_fraction,
+                                        distinct_count, min_value, max_value, distribution, computed_at)
+VALUES ({'%s, %s, %s, %s, %s, %s, %s, %s, %s, now()'})''',
+                           (statistics.data_set_id, statistics.column_name, statistics.column_type,
+                            statistics.row_count, statistics.null_fraction, statistics.distinct_count,
+                            statistics.min_value, statistics.max_value, json.dumps(statistics.distribution)))
+
+    # cached results can be based on the previous statistics
+    cache.invalidate(data_set.id)
+
+
+def _aggregate_expressions(column: 'data_set.Column') -> [str]:
+    """The number of values of a column, and its min and max values for number and date columns"""
+    expressions = [f'count("{column.column_name}")']
+    if column.type in ['number', 'date']:
+        cast = 'NUMERIC' if column.type == 'number' else 'TIMESTAMPTZ'
+        expressions.append(f'min("{column.column_name}") :: {cast}')
+        expressions.append(f'max("{column.column_name}") :: {cast}')
+    return expressions
+
+
+def _format_value(value) -> str:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value) if value is not None else None
+
+
+def _parse_value(column_type: str, value: str):
+    if value is None:
+        return None
+    elif column_type == 'date':
+        return datetime.datetime.fromisoformat(value)
+    elif column_type == 'number':
+        return decimal.Decimal(value)
+    else:
+        return value
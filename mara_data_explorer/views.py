@@ -1,11 +1,14 @@
 """Flasked based UI"""
 import datetime
+import functools
+import hmac
 import json
 import os
+import time
 import flask
 from mara_page import acl, navigation, response, bootstrap, _, html
 
-from . import config
+from . import config, profiling
 
 SCOPES = ['https://www.googleapis.com/auth/userinfo.profile', 'openid',
           'https://www.googleapis.com/auth/drive.file',
@@ -17,6 +20,7 @@ blueprint = flask.Blueprint('mara_data_explorer', __name__, static_folder='stati
 
 acl_resource = acl.AclResource(name='Explore')
 personal_data_acl_resource = acl.AclResource(name='Personal Data')
+profiling_acl_resource = acl.AclResource(name='Query Profiling')
 data_set_acl_resources = {}
 
 
@@ -28,25 +32,84 @@ def _create_acl_resource_for_each_data_set():
         acl_resource.add_child(resource)
 
 
+@blueprint.before_app_first_request
+def _warm_up_column_metadata():
+    """Loads the columns of all data sets in the background, so that the first requests don't have to wait"""
+    import threading
+    from . import data_set
+
+    threading.Thread(target=data_set.warm_up_column_metadata, daemon=True).start()
+
+
+@blueprint.before_request
+def _start_request_timer():
+    flask.g.mara_data_explorer_request_started_at = time.monotonic()
+
+
+@blueprint.after_request
+def _record_request_duration(response):
+    """Records the duration of each request (until the response is returned, without streaming)"""
+    started_at = flask.g.pop('mara_data_explorer_request_started_at', None)
+    if started_at is not None:
+        profiling.record('request', (flask.request.view_args or {}).get('data_set_id'),
+                         time.monotonic() - started_at)
+    return response
+
+
 def navigation_entry():
     return navigation.NavigationEntry(
         label='Explore', uri_fn=lambda: flask.url_for('mara_data_explorer.index_page'), icon='table',
         description='Raw data access & segmentation',
         children=[navigation.NavigationEntry(label='Overview', icon='list',
-                                             uri_fn=lambda: flask.url_for('mara_data_explorer.index_page'))]
+                                             uri_fn=lambda: flask.url_for('mara_data_explorer.index_page')),
+                  navigation.NavigationEntry(label='Exports', icon='download',
+                                             uri_fn=lambda: flask.url_for('mara_data_explorer.exports_page')),
+                  navigation.NavigationEntry(label='Profiling', icon='tachometer',
+                                             uri_fn=lambda: flask.url_for('mara_data_explorer.profiling_page'))]
                  + [navigation.NavigationEntry(label=ds.name, icon='table',
                                                uri_fn=lambda id=ds.id: flask.url_for('mara_data_explorer.data_set_page',
                                                                                      data_set_id=id))
                     for ds in config.data_sets()])
 
 
+def _governed(view: callable) -> callable:
+    """
+    Runs an expensive view within the concurrency limits of the current user (see `governor.concurrency_slot`).
+    Queries of an earlier request with the same `X-Query-Key` header are canceled (see `governor.superseding`).
+    """
+
+    @functools.wraps(view)
+    def governed_view(*args, **kwargs):
+        import psycopg2.extensions
+        from . import governor
+
+        user = acl.current_user_email()
+        try:
+            with governor.concurrency_slot(user), \
+                    governor.superseding(user, flask.request.headers.get('X-Query-Key')):
+                return view(*args, **kwargs)
+        except governor.QueueTimeout as e:
+            return flask.make_response(str(e), 503)
+        except psycopg2.extensions.QueryCanceledError as e:
+            # statement timeout or superseded by a newer request
+            return flask.make_response(str(e), 504)
+
+    return governed_view
+
+
 @blueprint.route('')
 def index_page():
+    # the previews of all data sets are streamed by a single request
+    cards = [bootstrap.card(
+        header_left=_.a(href=flask.url_for('mara_data_explorer.data_set_page', data_set_id=ds.id))[ds.name],
+        body=_.div(**{'class': 'data-set-preview', 'data-data-set-id': ds.id})[html.spinner()])
+        for ds in config.data_sets()]
     return response.Response(
-        html=[bootstrap.card(
-            header_left=_.a(href=flask.url_for('mara_data_explorer.data_set_page', data_set_id=ds.id))[ds.name],
-            body=[html.asynchronous_content(flask.url_for('mara_data_explorer.data_set_preview', data_set_id=ds.id))])
-            for i, ds in enumerate(config.data_sets())],
+        html=cards + [_.script[f"""
+document.addEventListener('DOMContentLoaded', function() {{
+    IndexPage('{flask.url_for('mara_data_explorer.data_set_previews')}');
+}});
+"""]],
         title='Data sets',
         js_files=[flask.url_for('mara_data_explorer.static', filename='data-sets.js')],
         css_files=[flask.url_for('mara_data_explorer.static', filename='data-sets.css')])
@@ -55,6 +118,7 @@ def index_page():
 @blueprint.route('/<data_set_id>', defaults={'query_id': None})
 @blueprint.route('/<data_set_id>/<query_id>')
 def data_set_page(data_set_id, query_id):
+    from . import arrow_export, compression
     from .data_set import find_data_set
     ds = find_data_set(data_set_id)
     if not ds:
@@ -65,7 +129,7 @@ def data_set_page(data_set_id, query_id):
 
     action_buttons.append(response.ActionButton(action='javascript:dataSetPage.downloadCSV()',
                                                 icon='download',
-                                                label='CSV', title='Download as CSV'))
+                                                label='Download', title='Download as CSV, Parquet or Arrow file'))
     if config.google_sheet_oauth2_client_config():
         action_buttons.append(response.ActionButton(action='javascript:dataSetPage.exportToGoogleSheet()',
                                                     icon='cloud-upload',
@@ -123,7 +187,8 @@ document.addEventListener('DOMContentLoaded', function() {{
             """],
               html.spinner_js_function(),
               _.div(class_='col-xl-4 col-lg-6', id='distribution-chart-template', style='display: none')[
-                  bootstrap.card(header_left=html.spinner(), body=_.div(class_='chart-container google-chart')[
+                  bootstrap.card(header_left=html.spinner(), header_right=_.div(class_='distribution-sample')[''],
+                                 body=_.div(class_='chart-container google-chart')[
                       html.spinner()])],
               _.div(class_='modal fade', id='load-query-dialog', tabindex="-1")[
                   _.div(class_='modal-dialog', role='document')[
@@ -149,16 +214,29 @@ document.addEventListener('DOMContentLoaded', function() {{
                       ]
                   ]
               ],
-              _.form(action=flask.url_for('mara_data_explorer.download_csv', data_set_id=data_set_id), method='post')[
+              _.form(action=flask.url_for('mara_data_explorer.export_csv', data_set_id=data_set_id), method='post',
+                     target='_blank')[
                   _.div(class_="modal fade", id="download-csv-dialog", tabindex="-1")[
                       _.div(class_="modal-dialog", role='document')[
                           _.div(class_="modal-content")[
                               _.div(class_="modal-header")[
-                                  _.h5(class_='modal-title')['Download as CSV'],
+                                  _.h5(class_='modal-title')['Download'],
                                   _.button(**{'type': "button", 'class': "close", 'data-dismiss': "modal",
                                               'aria-label': "Close"})[
                                       _.span(**{'aria-hidden': 'true'})['&times']]],
                               _.div(class_="modal-body")[
+                                  'Format: &nbsp',
+                                  # the supported compressions of each format, the first one is the default
+                                  _.input(type="radio", value="csv", name="format", checked="checked",
+                                          **{'data-compressions': ' '.join(compression.CSV_COMPRESSIONS)}),
+                                  ' CSV &nbsp&nbsp',
+                                  _.input(type="radio", value="parquet", name="format",
+                                          **{'data-compressions': ' '.join(arrow_export.COMPRESSIONS['parquet'])}),
+                                  ' Parquet &nbsp&nbsp',
+                                  _.input(type="radio", value="arrow", name="format",
+                                          **{'data-compressions': ' '.join(arrow_export.COMPRESSIONS['arrow'])}),
+                                  ' Arrow IPC &nbsp&nbsp',
+                                  _.hr,
                                   'Delimiter: &nbsp',
                                   _.input(type="radio", value="\t", name="delimiter",
                                           checked="checked"), ' tab &nbsp&nbsp',
@@ -170,10 +248,25 @@ document.addEventListener('DOMContentLoaded', function() {{
                                   _.input(type="radio", value=".", name="decimal-mark",
                                           checked="checked"), ' 42.7 &nbsp&nbsp',
                                   _.input(type="radio", value=",", name="decimal-mark"), ' 42,7 &nbsp&nbsp',
+                                  _.hr,
+                                  'Compression: &nbsp',
+                                  # the compressions of all formats, those of the selected format are enabled
+                                  [[_.input(type="radio", value=codec, name="compression",
+                                            **({'checked': 'checked'} if codec == _default_compression('csv')
+                                               else {} if codec in compression.CSV_COMPRESSIONS
+                                               else {'disabled': 'disabled'})),
+                                    f' {codec} &nbsp&nbsp']
+                                   for codec in _all_download_compressions()],
                                   _.input(type="hidden", name="query")],
                               _.div(class_="modal-footer")[
-                                  _.button(id="csv-download-button", type="submit", class_="btn btn-primary")[
-                                      'Download']]]]]],
+                                  _.button(type="submit", class_="btn btn-secondary", formtarget='_self',
+                                           formaction=flask.url_for('mara_data_explorer.download_csv',
+                                                                    data_set_id=data_set_id),
+                                           title='Stream the file directly (for small results)')[
+                                      'Download now'],
+                                  _.button(id="csv-download-button", type="submit", class_="btn btn-primary",
+                                           title='Export in the background and download when done')[
+                                      'Export']]]]]],
 
               _.form(action=flask.url_for('mara_data_explorer.oauth2_export_to_google_sheet', data_set_id=data_set_id),
                      method='post',
@@ -202,9 +295,10 @@ document.addEventListener('DOMContentLoaded', function() {{
                                   _.br,
                                   _.ul[
                                       _.li['Google authentication will be required.'],
-                                      _.li['A maximum limit of 100.000 rows will be applied.'],
+                                      _.li[f'A maximum limit of {config.google_sheet_max_rows():,} rows will be applied, '
+                                           f'split into sheets of {config.google_sheet_rows_per_sheet():,} rows.'],
                                       _.li['A maximum limit of 50.000 characters per cell will be applied.'],
-                                      _.li['A Google sheet with the selected data will be available in a new tab.']
+                                      _.li['The export runs in the background, the Google sheet will be linked on the exports page.']
                                   ],
                                   _.input(type="hidden", name="query")
                               ],
@@ -239,8 +333,10 @@ def initialize_query():
 
     return flask.jsonify({'query': query.to_dict(),
                           'all_columns': [column.to_dict() for column in query.data_set.columns.values()],
-                          'row_count': query.data_set.row_count(),
-                          'data_set_name': query.data_set.name})
+                          'row_count': query.data_set.row_count(estimate=query.data_set.estimate_row_counts),
+                          'estimate_row_counts': query.data_set.estimate_row_counts,
+                          'data_set_name': query.data_set.name,
+                          'keyset_pagination': bool(query.data_set.unique_column_names)})
 
 
 def _render_preview_row(query, row):
@@ -268,25 +364,80 @@ def data_set_preview(data_set_id):
     query = Query(data_set_id=data_set_id)
     if query.column_names:
         if current_user_has_permission(query):
-            rows = [_render_preview_row(query, row) for row
-                    in query.run(limit=7, offset=0,
-                                 include_personal_data=acl.current_user_has_permission(personal_data_acl_resource))]
+            result = query.run(limit=7, offset=0,
+                               include_personal_data=acl.current_user_has_permission(personal_data_acl_resource),
+                               stale_while_revalidate=True)
+            with profiling.span('render rows', data_set_id):
+                rows = [_render_preview_row(query, row) for row in result]
         else:
             rows = _.tr[_.td(colspan=len(query.column_names))[acl.inline_permission_denied_message()]]
 
-        return str(
-            bootstrap.table(headers=[flask.escape(column_name) for column_name in query.column_names], rows=rows))
+        with profiling.span('render html', data_set_id):
+            return str(
+                bootstrap.table(headers=[flask.escape(column_name) for column_name in query.column_names], rows=rows))
 
     else:
         return '∅'
 
 
+@blueprint.route('/.previews')
+def data_set_previews():
+    """
+    Streams the previews of all data sets as newline delimited json (one `{"data_set_id": .., "html": ..}` object
+    per data set) in the order in which they are finished. The previews are computed concurrently, with at most
+    `config.preview_concurrency()` queries per database alias at the same time.
+    """
+    import concurrent.futures
+
+    data_sets = config.data_sets()
+
+    def render(data_set_id: str) -> str:
+        try:
+            preview = data_set_preview(data_set_id)
+        except Exception as e:
+            preview = _.div(class_='alert alert-danger')[flask.escape(str(e) or repr(e))]
+        return json.dumps({'data_set_id': data_set_id, 'html': str(preview)}) + '\n'
+
+    def generate():
+        executors = {alias: concurrent.futures.ThreadPoolExecutor(max_workers=config.preview_concurrency(),
+                                                                  thread_name_prefix='preview')
+                     for alias in {ds.database_alias for ds in data_sets}}
+        # each thread needs its own copy of the request context (for permissions)
+        futures = [executors[ds.database_alias].submit(flask.copy_current_request_context(render), ds.id)
+                   for ds in data_sets]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            # e.g. when the client has closed the connection
+            for future in futures:
+                future.cancel()
+            for executor in executors.values():
+                executor.shutdown(wait=False)
+
+    return flask.Response(flask.stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @blueprint.route('/.preview', methods=['POST'])
+@_governed
 def preview():
     from .query import Query
-    from .data_set import Column
 
-    query = Query.from_dict(flask.request.json['query'])
+    preview = _render_preview(Query.from_dict(flask.request.json['query']), flask.request.json)
+    return flask.jsonify(preview) if isinstance(preview, dict) else preview
+
+
+def _render_preview(query: 'Query', args: {}) -> str:
+    """
+    Renders a page of the preview table
+
+    Args:
+        query: The query to preview
+        args: The `limit` and `offset` of the page, for keyset pagination `keyset` and `cursor`. With
+              `format` = `json`, the rows are returned as a dictionary for rendering in the browser
+              (see `_preview_payload`)
+    """
+    from .data_set import Column
 
     def header(column: Column):
         if column.sortable():
@@ -303,43 +454,181 @@ def preview():
         else:
             return flask.escape(column.column_name)
 
-    if current_user_has_permission(query):
-        rows = [_render_preview_row(query, row)
-                for row in query.run(limit=flask.request.json['limit'], offset=flask.request.json['offset'],
-                                     include_personal_data=acl.current_user_has_permission(personal_data_acl_resource))]
-    else:
+    include_personal_data = acl.current_user_has_permission(personal_data_acl_resource)
+    keyset = args.get('keyset') and query.keyset_column_names(include_personal_data)
+    next_cursor = None
+    if not current_user_has_permission(query):
         rows = _.tr[_.td(colspan=len(query.column_names))[acl.inline_permission_denied_message()]]
+    else:
+        if keyset:
+            # continue after the last row of the previous page instead of skipping `offset` rows
+            result, next_cursor = query.run_keyset_page(limit=args['limit'], after=args.get('cursor'),
+                                                        include_personal_data=include_personal_data)
+        else:
+            result = query.run(limit=args['limit'], offset=args['offset'],
+                               include_personal_data=include_personal_data)
+        if args.get('format') == 'json' and result:
+            with profiling.span('render json', query.data_set_id):
+                return _preview_payload(query, result, include_personal_data, keyset, next_cursor)
+        with profiling.span('render rows', query.data_set_id):
+            rows = [_render_preview_row(query, row) for row in result]
 
     if rows:
-        return str(bootstrap.table(headers=[header(query.data_set.columns[c]) for c in query.column_names], rows=rows))
+        with profiling.span('render html', query.data_set_id):
+            table = bootstrap.table(headers=[header(query.data_set.columns[c]) for c in query.column_names],
+                                    rows=rows)
+            if keyset:
+                return str(_.div(**{'data-next-cursor': flask.escape(json.dumps(next_cursor))})[table])
+            else:
+                return str(table)
     else:
         return '∅'
 
 
+def _preview_payload(query: 'Query', rows: [], include_personal_data: bool, keyset: bool, next_cursor: []) -> {}:
+    """
+    A page of the preview table in a compact columnar format, which is rendered by `showPreview` in the browser:
+    the metadata of each column once and the values of each column as an array (as strings, like in the
+    rendered table). Custom column renderers are applied on the server, but only to the columns that define them.
+
+    Returns: A dictionary with the keys `columns`, `values` (None for columns with restricted personal data or
+             custom renderers), `rendered` (by column position), `restricted_html`, `sort_column_name`,
+             `sort_order` and, for keyset pagination, `next_cursor`
+    """
+    columns, values, rendered = [], [], {}
+    for pos, column_name in enumerate(query.column_names):
+        column = query.data_set.columns[column_name]
+        restricted = not include_personal_data and column_name in query.data_set.personal_data_column_names
+        columns.append({'column_name': column_name, 'type': column.type, 'sortable': column.sortable(),
+                        'restricted': restricted})
+        column_values = [row[pos] for row in rows]
+        if restricted:
+            values.append(None)
+        elif column_name in query.data_set.custom_column_renderers:
+            renderer = query.data_set.custom_column_renderers[column_name]
+            rendered[pos] = [str(renderer(value)) for value in column_values]
+            values.append(None)
+        elif column.type == 'text[]':
+            values.append([None if value is None else [str(element) for element in value]
+                           for value in column_values])
+        elif column.type in ['text', 'json']:
+            values.append(column_values)
+        else:
+            values.append([None if value is None else str(value) for value in column_values])
+
+    payload = {'columns': columns, 'values': values, 'rendered': rendered,
+               'restricted_html': str(acl.inline_permission_denied_message('Restricted personal data')),
+               'sort_column_name': query.sort_column_name, 'sort_order': query.sort_order}
+    if keyset:
+        payload['next_cursor'] = next_cursor
+    return payload
+
+
+@blueprint.route('/.query-state', methods=['POST'])
+@_governed
+def query_state():
+    """
+    Computes the preview, the row count and the row counts of some filters of a query with a single request.
+    The parts are computed concurrently on separate connections.
+
+    Returns: A dictionary with the keys `preview` (html), `row_count` and `filter_row_counts` (by position)
+    """
+    import concurrent.futures
+    import contextvars
+    from . import governor
+    from .query import Query
+
+    query = Query.from_dict(flask.request.json['query'])
+    if not current_user_has_permission(query):
+        return flask.make_response(acl.inline_permission_denied_message(), 403)
+
+    estimate = bool(flask.request.json.get('estimate'))
+    filter_positions = []
+    for pos in flask.request.json.get('filter_positions', []):
+        if isinstance(pos, int) and not isinstance(pos, bool) and 0 <= pos < len(query.filters) \
+                and pos not in filter_positions:
+            filter_positions.append(pos)
+    user = acl.current_user_email()
+    key = flask.request.headers.get('X-Query-Key')
+
+    if key:
+        # the parts of an earlier request, also those of filters that are not counted anymore
+        governor.cancel(query.data_set, user, key)
+
+    def compute(part: str, function: callable):
+        # the concurrent queries must not cancel each other, but are canceled together with the key of the request
+        with governor.superseding(user, key, part):
+            return function()
+
+    parts = {'preview': lambda: _render_preview(query, flask.request.json),
+             'row_count': lambda: _row_count_result(query.row_count(estimate=estimate),
+                                                    query.row_count_is_estimate(estimate))}
+    for pos in filter_positions:
+        parts[pos] = lambda pos=pos: _row_count_result(query.filter_row_count(pos, estimate=estimate),
+                                                       query.filter_row_count_is_estimate(pos, estimate))
+
+    # the request holds a single concurrency slot, so it runs at most as many queries at once as a user may run
+    max_workers = min(len(parts), config.max_concurrent_queries_per_user() or len(parts))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query-state') as executor:
+        # each thread needs its own copy of the request context (for permissions) and of the context variables
+        futures = {part: executor.submit(contextvars.copy_context().run,
+                                         flask.copy_current_request_context(compute), str(part), function)
+                   for part, function in parts.items()}
+        results = {part: future.result() for part, future in futures.items()}
+
+    return flask.jsonify({'preview': results['preview'], 'row_count': results['row_count'],
+                          'filter_row_counts': {pos: results[pos] for pos in filter_positions}})
+
+
 @blueprint.route('/.row-count', methods=['POST'])
+@_governed
 def row_count():
     from .query import Query
 
     query = Query.from_dict(flask.request.json)
 
     if current_user_has_permission(query):
-        return flask.jsonify(query.row_count())
+        estimate = flask.request.args.get('estimate') == 'true'
+        return flask.jsonify(_row_count_result(query.row_count(estimate=estimate),
+                                               query.row_count_is_estimate(estimate)))
     else:
         return flask.make_response(acl.inline_permission_denied_message(), 403)
 
 
 @blueprint.route('/.filter-row-count-<int:filter_pos>', methods=['POST'])
+@_governed
 def filter_row_count(filter_pos):
     from .query import Query
 
     query = Query.from_dict(flask.request.json)
 
     if current_user_has_permission(query):
-        return flask.jsonify(query.filter_row_count(filter_pos))
+        estimate = flask.request.args.get('estimate') == 'true'
+        return flask.jsonify(_row_count_result(query.filter_row_count(filter_pos, estimate=estimate),
+                                               query.filter_row_count_is_estimate(filter_pos, estimate)))
     else:
         return flask.make_response(acl.inline_permission_denied_message(), 403)
 
 
+def _row_count_result(count: int, estimated: bool) -> {}:
+    """A row count as returned to the client, `estimated` tells whether it is approximate"""
+    return {'count': count, 'estimated': estimated}
+
+
+@blueprint.route('/.cancel-query', methods=['POST'])
+def cancel_query():
+    """Cancels the running queries of a request that has been aborted by the client (see `_governed`)"""
+    from . import governor
+    from .data_set import find_data_set
+
+    # also sent with `navigator.sendBeacon`, which can not set the content type
+    request = flask.request.get_json(force=True)
+    data_set = find_data_set(request['data_set_id'])
+    if not data_set:
+        return flask.abort(404, 'Data set does not exist')
+    return flask.jsonify(governor.cancel(data_set, acl.current_user_email(), request['key']))
+
+
 @blueprint.route('/.auto-complete')
 def auto_complete():
     from .data_set import find_data_set
@@ -356,22 +645,115 @@ def auto_complete():
 
 @blueprint.route('/<data_set_id>/.download-csv', methods=['POST'])
 def download_csv(data_set_id):
+    """
+    Streams the result of a query as a csv file (optionally `gzip` or `zstd` compressed), or as a Parquet
+    or Arrow file for `format` = `parquet`/`arrow`
+    """
     from .query import Query
 
     query = Query.from_dict(json.loads(flask.request.form['query']))
     if not current_user_has_permission(query):
         return flask.abort(403, 'Not enough permissions to download this data set')
     else:
+        file_format = flask.request.form.get('format', 'csv')
+        codec = flask.request.form.get('compression', _default_compression(file_format))
+        error = _check_download_format(file_format, codec)
+        if error:
+            return error
+
         file_name = query.data_set_id + ('-' + query.query_id if query.query_id else '') \
-                    + '-' + datetime.date.today().isoformat() + '.csv'
-        response = flask.make_response(query.as_csv(flask.request.form['delimiter'], flask.request.form['decimal-mark'],
-                                                    acl.current_user_has_permission(personal_data_acl_resource)))
-        response.headers['Content-type'] = 'text/csv; charset = utf-8'
+                    + '-' + datetime.date.today().isoformat()
+        from . import governor
+
+        content_encoding = None
+        if file_format == 'csv':
+            from . import compression
+
+            file_name += '.csv'
+            content_type = 'text/csv; charset = utf-8'
+            chunks = query.as_csv(flask.request.form['delimiter'], flask.request.form['decimal-mark'],
+                                  acl.current_user_has_permission(personal_data_acl_resource))
+            chunks = compression.compress(chunks, codec)
+            if codec == 'gzip':
+                # decompressed by the browser
+                content_encoding = 'gzip'
+            elif codec != 'none':
+                # browsers don't support all encodings, the file is saved compressed
+                file_name += '.' + compression.FILE_EXTENSIONS[codec]
+                content_type = 'application/' + codec
+        else:
+            from . import arrow_export
+
+            file_name += '.' + arrow_export.FORMATS[file_format][0]
+            content_type = arrow_export.FORMATS[file_format][1]
+            chunks = arrow_export.as_file(query, file_format,
+                                          acl.current_user_has_permission(personal_data_acl_resource),
+                                          codec)
+        user = acl.current_user_email()
+
+        def generate():
+            # counts as a running query until the download is finished (or aborted)
+            with governor.concurrency_slot(user):
+                yield from chunks
+
+        # stream the file in chunks instead of buffering the whole result in the worker
+        response = flask.Response(generate())
+        response.headers['Content-type'] = content_type
         response.headers['Content-disposition'] = f'attachment; filename="{file_name}"'
+        if content_encoding:
+            response.headers['Content-Encoding'] = content_encoding
+        # don't let reverse proxies (nginx) buffer the download
+        response.headers['X-Accel-Buffering'] = 'no'
 
         return response
 
 
+def _all_download_compressions() -> [str]:
+    """The compressions of all download formats, without duplicates (in the order of the formats)"""
+    from . import arrow_export, compression
+
+    codecs = []
+    for format_codecs in [compression.CSV_COMPRESSIONS] + list(arrow_export.COMPRESSIONS.values()):
+        for codec in format_codecs:
+            if codec not in codecs:
+                codecs.append(codec)
+    return codecs
+
+
+def _default_compression(file_format: str) -> str:
+    """The compression of a download format when none is chosen (the first supported one of the format)"""
+    from . import arrow_export, compression
+
+    if file_format == 'csv':
+        return compression.CSV_COMPRESSIONS[0]
+    return arrow_export.COMPRESSIONS.get(file_format, ['none'])[0]
+
+
+def _check_download_format(file_format: str, codec: str) -> flask.Response:
+    """Validates the format and the compression of a download, returns an error response if invalid"""
+    from . import arrow_export, compression
+
+    if file_format == 'csv':
+        if codec not in compression.CSV_COMPRESSIONS:
+            return flask.abort(400, f'Unsupported compression "{codec}" for format csv')
+        if codec == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                return flask.make_response(
+                    str(_.tt(style='color:red')["Please install the package 'zstandard'"]), 500)
+        return None
+
+    if file_format not in arrow_export.FORMATS:
+        return flask.abort(400, f'Unsupported format "{file_format}"')
+    if codec not in arrow_export.COMPRESSIONS[file_format]:
+        return flask.abort(400, f'Unsupported compression "{codec}" for format {file_format}')
+    try:
+        import pyarrow
+    except ImportError:
+        return flask.make_response(str(_.tt(style='color:red')["Please install the package 'pyarrow'"]), 500)
+
+
 @blueprint.route('/.oauth2_export_to_google_sheet', methods=['POST'])
 def oauth2_export_to_google_sheet():
     try:
@@ -448,74 +830,191 @@ def google_sheet_oauth2callback():
     authorization_response = flask.request.url
     flow.fetch_token(authorization_response=authorization_response)
 
-    spreadsheet_title = query.data_set_id + ('-' + query.query_id if query.query_id else '') \
-                        + '-' + datetime.date.today().isoformat()
-
     decimal_mark = flask.session.pop('decimal_mark')
     array_format = flask.session.pop('array_format')
 
     credentials = flow.credentials
-    service = googleapiclient.discovery.build('sheets', 'v4', credentials=credentials)
-    spreadsheet_body = {
-        'properties': {
-            'title': spreadsheet_title,
-            # Determine decimal-mark through the Google sheet locale
-            'locale': 'de_DE' if decimal_mark == ',' else 'en_US'
-        }
-    }
-
-    spreadsheet = service.spreadsheets().create(body=spreadsheet_body, fields='spreadsheetId')
-    api_response = spreadsheet.execute()
-    spreadsheet_id = api_response.get('spreadsheetId')
-
-    # Upload data from generator in batches of 10K rows each. Each batch is a request
-    # Api limits: https://developers.google.com/sheets/api/limits
-    data_batch = []
-    google_sheet_rows = query.as_rows_for_google_sheet(
-        array_format=array_format,
-        limit=100000,
-        include_personal_data=acl.current_user_has_permission(personal_data_acl_resource))
-    row_count = 0
-    batch_length = 10000
-    for row in google_sheet_rows:
-        row_count += 1
-        data_batch.append(row)
-        if row_count % batch_length == 0:
-            body = {
-                "data": [
-                    {
-                        "values": data_batch,
-                        "range": "A" + str(row_count - batch_length + 1),
-                        "majorDimension": "ROWS"
-                    }
-                ],
-                # USER_ENTERED: The values will be parsed as if the user typed them into the UI.
-                # Numbers will stay as numbers, but strings may be converted to numbers, dates, etc.
-                # RAW: The values the user has entered will not be parsed and will be stored as-is.
-                "valueInputOption": "USER_ENTERED"
-            }
-
-            # Request of the current batch
-            service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
-
-            # Initialize next batch
-            data_batch = []
-
-    # Append remaining or less batch_length data if any
-    if row_count < batch_length:
-        body = {"data": [{"values": data_batch, "range": "A1", "majorDimension": "ROWS"}],
-                "valueInputOption": "USER_ENTERED"}
-        service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
-    elif row_count % batch_length > 0:
-        body = {"data": [{"values": data_batch, "range": "A" + str(row_count - len(data_batch) + 1),
-                          "majorDimension": "ROWS"}],
-                "valueInputOption": "USER_ENTERED"}
-        service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
-
-    return flask.redirect('https://docs.google.com/spreadsheets/d/' + str(spreadsheet_id))
+
+    # the upload runs in the background, the progress is shown on the exports page
+    from . import export
+    try:
+        export.submit_google_sheet_export(
+            query, lambda: googleapiclient.discovery.build('sheets', 'v4', credentials=credentials),
+            decimal_mark=decimal_mark, array_format=array_format,
+            include_personal_data=acl.current_user_has_permission(personal_data_acl_resource))
+    except export.ExportLimitExceeded as e:
+        flask.flash(str(e), 'danger')
+    return flask.redirect(flask.url_for('mara_data_explorer.exports_page'))
+
+
+@blueprint.route('/<data_set_id>/.export-csv', methods=['POST'])
+def export_csv(data_set_id):
+    """Starts a background export of a query to a csv file (or a Parquet or Arrow file, see `download_csv`)"""
+    from . import export
+    from .query import Query
+
+    query = Query.from_dict(json.loads(flask.request.form['query']))
+    if not current_user_has_permission(query):
+        return flask.abort(403, 'Not enough permissions to download this data set')
+
+    # csv exports are always stored gzip compressed (and decompressed by the browser when downloaded)
+    file_format = flask.request.form.get('format', 'csv')
+    if file_format != 'csv':
+        error = _check_download_format(file_format,
+                                       flask.request.form.get('compression', _default_compression(file_format)))
+        if error:
+            return error
+
+    try:
+        if file_format == 'csv':
+            export.submit_csv_export(query, flask.request.form['delimiter'], flask.request.form['decimal-mark'],
+                                     acl.current_user_has_permission(personal_data_acl_resource))
+        else:
+            export.submit_arrow_export(query, file_format,
+                                       flask.request.form.get('compression', _default_compression(file_format)),
+                                       acl.current_user_has_permission(personal_data_acl_resource))
+    except export.ExportLimitExceeded as e:
+        flask.flash(str(e), 'danger')
+    return flask.redirect(flask.url_for('mara_data_explorer.exports_page'))
+
+
+@blueprint.route('/.exports')
+def exports_page():
+    """The export jobs of the current user"""
+    return response.Response(
+        html=[bootstrap.card(header_left='Exports of the last ' + str(round(config.export_retention() / 3600))
+                                         + ' hours',
+                             body=_.div(id='exports')[html.spinner()]),
+              _.script[f"""
+document.addEventListener('DOMContentLoaded', function() {{
+    ExportsPage('{flask.url_for('mara_data_explorer.exports_table')}');
+}});
+"""]],
+        title='Exports',
+        js_files=[flask.url_for('mara_data_explorer.static', filename='data-sets.js')],
+        css_files=[flask.url_for('mara_data_explorer.static', filename='data-sets.css')])
+
+
+@blueprint.route('/.exports/.table')
+def exports_table():
+    from . import export
+
+    jobs = export.list_jobs(acl.current_user_email())
+    if not jobs:
+        return 'No exports yet'
+
+    rows = []
+    for job in jobs:
+        if job.status == 'done' and job.has_file:
+            result = _.a(href=flask.url_for('mara_data_explorer.download_export', job_id=job.job_id))[
+                _.span(class_='fa fa-download')[' '], ' Download']
+        elif job.status == 'done':
+            result = _.a(href=job.url, target='_blank')[_.span(class_='fa fa-external-link')[' '], ' Open sheet']
+        elif job.status == 'failed':
+            result = _.span(class_='text-danger')[flask.escape(job.error or '')]
+        else:
+            result = html.spinner()
+        rows.append(_.tr(**({'data-running': 'true'} if not job.finished else {}))[
+                        _.td[flask.escape(job.file_name)],
+                        _.td[datetime.datetime.fromtimestamp(job.created_at).strftime('%Y-%m-%d %H:%M:%S')],
+                        _.td[job.status],
+                        _.td[f'{job.rows_written:,}'],
+                        _.td[f'{job.bytes_written / 1024 / 1024:,.1f} MB' if job.has_file else ''],
+                        _.td[result]])
+    return str(bootstrap.table(headers=['Export', 'Started', 'Status', 'Rows', 'Size', ''], rows=rows))
+
+
+@blueprint.route('/.exports/<job_id>')
+def export_status(job_id):
+    """The state of an export job as json, for polling"""
+    job = _current_user_export_job(job_id)
+    return flask.jsonify(job.to_dict())
+
+
+@blueprint.route('/.exports/<job_id>/download')
+def download_export(job_id):
+    job = _current_user_export_job(job_id)
+    if not job.has_file or job.status != 'done':
+        return flask.abort(404, 'The export is not finished')
+
+    if job.kind == 'csv':
+        # the file is sent compressed and decompressed by the browser
+        response = flask.send_file(job.file_path, mimetype='text/csv')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        from . import arrow_export
+
+        response = flask.send_file(job.file_path, mimetype=arrow_export.FORMATS[job.kind][1])
+    response.headers['Content-disposition'] = f'attachment; filename="{job.file_name}"'
+    return response
+
+
+def _current_user_export_job(job_id: str) -> 'export.ExportJob':
+    """Loads an export job of the current user, aborts when it does not exist"""
+    from . import export
+
+    job = export.ExportJob.load(job_id)
+    if not job or job.user != acl.current_user_email():
+        return flask.abort(404, 'Export does not exist')
+    return job
+
+
+@blueprint.route('/.profiling')
+@acl.require_permission(profiling_acl_resource)
+def profiling_page():
+    """Latency percentiles by endpoint, data set and kind of work and the slowest query shapes"""
+    def seconds(value: float) -> str:
+        return f'{value * 1000:,.1f} ms' if value is not None else ''
+
+    latency_rows = [_.tr[_.td[flask.escape(row['endpoint'])],
+                         _.td[flask.escape(row['data_set_id'] or '')],
+                         _.td[row['kind']],
+                         _.td[f"{row['count']:,}"],
+                         _.td[seconds(row['p50'])], _.td[seconds(row['p90'])], _.td[seconds(row['p99'])],
+                         _.td[seconds(row['max'])]]
+                    for row in profiling.latencies()]
+
+    shape_rows = [_.tr[_.td[_.tt[shape.shape]],
+                       _.td[flask.escape(shape.data_set_id)],
+                       _.td[flask.escape(', '.join(sorted(shape.endpoints)))],
+                       _.td[f'{shape.count:,}'],
+                       _.td[seconds(shape.mean_seconds)], _.td[seconds(shape.max_seconds)],
+                       _.td[seconds(shape.total_seconds)],
+                       _.td[_.pre[flask.escape(shape.sql[:2000])],
+                            _.pre[flask.escape(shape.plan)] if shape.plan else '']]
+                  for shape in profiling.slowest_query_shapes()]
+
+    return response.Response(
+        html=[bootstrap.card(header_left='Latencies (recent requests of this process)',
+                             body=bootstrap.table(headers=['Endpoint', 'Data set', 'Kind', 'Count', 'p50', 'p90',
+                                                           'p99', 'Max'],
+                                                  rows=latency_rows) if latency_rows else 'Nothing recorded yet'),
+              bootstrap.card(header_left='Slowest query shapes',
+                             body=bootstrap.table(headers=['Shape', 'Data set', 'Endpoints', 'Count', 'Mean', 'Max',
+                                                           'Total', 'Query (and plan of a slow execution)'],
+                                                  rows=shape_rows) if shape_rows else 'Nothing recorded yet')],
+        title='Query profiling',
+        css_files=[flask.url_for('mara_data_explorer.static', filename='data-sets.css')])
+
+
+@blueprint.route('/.metrics')
+def metrics():
+    """
+    The recorded durations and the connection pool metrics in the Prometheus text format, for scraping. Requires
+    the "Query Profiling" ACL resource or the `config.metrics_token()` as a bearer token.
+    """
+    token = config.metrics_token()
+    authorization = flask.request.headers.get('Authorization', '')
+    if not (token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())) \
+            and not acl.current_user_has_permission(profiling_acl_resource):
+        return flask.abort(403, "Sorry, but you don't have enough permissions to view this page.")
+    if not config.profiling():
+        return flask.abort(404, 'Profiling is disabled')
+    return flask.Response(profiling.prometheus_metrics(), mimetype='text/plain; version=0.0.4')
 
 
 @blueprint.route('/.distribution-chart-<int:pos>', methods=['POST'])
+@_governed
 def distribution_chart(pos: int):
     from .query import Query
 
@@ -528,19 +1027,56 @@ def distribution_chart(pos: int):
         return flask.make_response(
             acl.inline_permission_denied_message('Restricted personal data'), 403)
     else:
+        sample_percent = None if flask.request.args.get('exact') == 'true' \
+            else query.distribution_sample_percent(column.column_name)
 
         if column.type == 'number':
-            data = query.number_distribution(column.column_name)
+            data = query.number_distribution(column.column_name, sample_percent)
         elif column.type == 'text':
-            data = query.text_distribution(column.column_name)
+            data = query.text_distribution(column.column_name, sample_percent)
         elif column.type == 'text[]':
-            data = query.text_array_distribution(column.column_name)
+            data = query.text_array_distribution(column.column_name, sample_percent)
         elif column.type == 'date':
-            data = query.date_distribution(column.column_name)
+            data = query.date_distribution(column.column_name, sample_percent)
         else:
             data = []
 
-        return flask.jsonify({'column': column.to_dict(), 'data': data})
+        return flask.jsonify({'column': column.to_dict(), 'data': data, 'sample_percent': sample_percent})
+
+
+@blueprint.route('/.distribution-charts', methods=['POST'])
+@_governed
+def distribution_charts():
+    """
+    Computes the distribution charts of several columns (by position) with as few table scans as possible.
+    Charts are computed from a sample of the table when the data set is configured for that and `exact` is not set.
+    """
+    from .query import Query
+
+    query = Query.from_dict(flask.request.json['query'])
+    if not current_user_has_permission(query):
+        return flask.make_response(acl.inline_permission_denied_message(), 403)
+
+    all_columns = list(query.data_set.columns.values())
+    columns = {pos: all_columns[pos] for pos in flask.request.json['positions']}
+
+    charts = {}
+    if not acl.current_user_has_permission(personal_data_acl_resource):
+        for pos, column in columns.items():
+            if column.column_name in query.data_set.personal_data_column_names:
+                charts[pos] = {'column': column.to_dict(),
+                               'permission_denied': str(
+                                   acl.inline_permission_denied_message('Restricted personal data'))}
+
+    sample_percent = None if flask.request.json.get('exact') else query.distribution_sample_percent()
+    distributions = query.distributions([column.column_name for pos, column in columns.items() if pos not in charts],
+                                        sample_percent)
+    for pos, column in columns.items():
+        if pos not in charts:
+            charts[pos] = {'column': column.to_dict(), 'data': distributions[column.column_name],
+                           'sample_percent': sample_percent}
+
+    return flask.jsonify(charts)
 
 
 @blueprint.route('/.save', methods=['POST'])
@@ -9,9 +9,13 @@ setup(
     install_requires=[
         'mara-db>=4.0.0',
         'mara-page>=1.4.1',
-        'arrow',
     ],
 
+    extras_require={
+        'arrow': ['pyarrow'],
+        'zstd': ['zstandard'],
+    },
+
     dependency_links=[
     ],
 